@@ -0,0 +1,222 @@
+import re
+
+"""
+Bencode codec dùng trong project (thay cho bencodepy).
+- Decode trực tiếp trên bytes / bytearray / memoryview / mmap: không cắt nhỏ buffer trong lúc parse,
+  mỗi chuỗi chỉ được copy một lần thành bytes khi tạo kết quả.
+- decode_torrent() trả về thêm byte gốc của info dict để tính info_hash mà không cần encode lại.
+- StreamDecoder decode dần dữ liệu nhận theo từng đoạn (socket, file đọc theo chunk).
+Chuỗi được trả về dạng bytes, key của dict cũng là bytes (giống bencodepy).
+"""
+
+# Một lần match cho mỗi token: độ dài chuỗi, số nguyên, hoặc l/d/e
+_TOKEN = re.compile(rb'(0|[1-9][0-9]*):|i(0|-?[1-9][0-9]*)e|([lde])')
+_INT = re.compile(rb'i(0|-?[1-9][0-9]*)e')
+_LENGTH = re.compile(rb'(0|[1-9][0-9]*):')
+
+_L = ord('l')
+_D = ord('d')
+_E = ord('e')
+_I = ord('i')
+_ZERO = ord('0')
+_NINE = ord('9')
+
+MAX_DEPTH = 256
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def _decode(data, pos, end, info_key=None):
+    """
+    Decode không đệ quy một giá trị bắt đầu tại `pos`.
+    Trả về (giá trị, vị trí ngay sau giá trị, span của `info_key` trong dict gốc hoặc None).
+    """
+    match = _TOKEN.match
+    copy = type(data) is not bytes   # Slice của bytes đã là bytes, các buffer khác cần copy
+    stack = []       # (container, key đang chờ value) của các container cha
+    top = None       # Container đang mở
+    key = None       # Key của dict đang chờ value
+    info_start = None
+    info_span = None
+
+    while True:
+        token = match(data, pos, end)
+        if token is None:
+            if pos >= end:
+                raise BencodeError("Unexpected end of data")
+            raise BencodeError(f"Invalid bencode at {pos}")
+        kind = token.lastindex
+        pos = token.end()
+
+        if kind == 1:
+            stop = pos + int(token.group(1))
+            if stop > end:
+                raise BencodeError("Unexpected end of data")
+            value = bytes(data[pos:stop]) if copy else data[pos:stop]
+            pos = stop
+        elif kind == 2:
+            value = int(token.group(2))
+        else:
+            char = token.group(3)
+            if char != b'e':
+                if top is not None and type(top) is dict and key is None:
+                    raise BencodeError(f"Dictionary key must be a string at {pos - 1}")
+                if len(stack) >= MAX_DEPTH:
+                    raise BencodeError("Bencode nested too deeply")
+                stack.append((top, key))
+                top = [] if char == b'l' else {}
+                key = None
+                continue
+            if top is None or key is not None:
+                raise BencodeError(f"Unexpected end marker at {pos - 1}")
+            value = top
+            top, key = stack.pop()
+
+        if top is None:
+            return value, pos, info_span
+        if type(top) is list:
+            top.append(value)
+        elif key is None:
+            if kind != 1:
+                raise BencodeError(f"Dictionary key must be a string at {pos}")
+            key = value
+            if info_key is not None and not stack[1:] and value == info_key:
+                info_start = pos
+        else:
+            top[key] = value
+            if info_start is not None and not stack[1:]:
+                info_span = (info_start, pos)
+                info_start = None
+            key = None
+
+
+def decode_prefix(data, start=0, end=None):
+    """Decode giá trị đầu tiên trong `data[start:end]`, trả về (giá trị, vị trí kết thúc)."""
+    end = len(data) if end is None else end
+    value, pos, _ = _decode(data, start, end)
+    return value, pos
+
+
+def decode(data):
+    """Decode toàn bộ `data`, dữ liệu thừa phía sau là lỗi."""
+    value, end = decode_prefix(data)
+    if end != len(data):
+        raise BencodeError(f"Trailing data after position {end}")
+    return value
+
+
+def decode_torrent(data):
+    """
+    Decode file .torrent, trả về (metadata, info_bytes) với info_bytes là đúng các byte
+    của info dict trong file, dùng để tính info_hash và trả lời ut_metadata.
+    """
+    metadata, end, info_span = _decode(data, 0, len(data), info_key=b'info')
+    if end != len(data):
+        raise BencodeError(f"Trailing data after position {end}")
+    if not isinstance(metadata, dict) or info_span is None:
+        raise BencodeError("Torrent has no info dictionary")
+    start, stop = info_span
+    return metadata, bytes(data[start:stop])
+
+
+class StreamDecoder:
+    """
+    Decode dần một chuỗi các giá trị bencode nối tiếp nhau.
+    feed() trả về các giá trị đã đủ byte; phần dữ liệu còn thiếu được giữ lại, và vị trí
+    đã quét được nhớ để lần feed sau không phải quét lại từ đầu.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scan_pos = 0   # Vị trí đã quét trong giá trị hiện tại
+        self.depth = 0      # Số list/dict đang mở tại scan_pos
+
+    def feed(self, data):
+        self.buffer += data
+        values = []
+        while True:
+            end = self._scan()
+            if end is None:
+                return values
+            values.append(decode_prefix(self.buffer, 0, end)[0])
+            del self.buffer[:end]
+            self.scan_pos = 0
+            self.depth = 0
+
+    def pending(self):
+        """Số byte đang chờ thêm dữ liệu."""
+        return len(self.buffer)
+
+    def _scan(self):
+        """Tìm vị trí kết thúc của giá trị đầu tiên trong buffer, None nếu chưa đủ dữ liệu."""
+        data = self.buffer
+        pos = self.scan_pos
+        while pos < len(data):
+            token = data[pos]
+            if _ZERO <= token <= _NINE:
+                match = _LENGTH.match(data, pos)
+                if match is None:
+                    if data.find(b':', pos) != -1 or len(data) - pos > 20:
+                        raise BencodeError(f"Invalid string length at {pos}")
+                    break
+                stop = match.end() + int(match.group(1))
+                if stop > len(data):
+                    break
+                pos = stop
+            elif token == _I:
+                match = _INT.match(data, pos)
+                if match is None:
+                    if data.find(b'e', pos) != -1:
+                        raise BencodeError(f"Invalid integer at {pos}")
+                    break
+                pos = match.end()
+            elif token in (_L, _D):
+                self.depth += 1
+                pos += 1
+                continue
+            elif token == _E and self.depth > 0:
+                self.depth -= 1
+                pos += 1
+            else:
+                raise BencodeError(f"Invalid bencode token {chr(token)!r} at {pos}")
+
+            if self.depth == 0:
+                return pos
+        self.scan_pos = pos
+        return None
+
+
+def encode(value):
+    parts = []
+    _encode(value, parts.append)
+    return b''.join(parts)
+
+
+def _encode(value, write):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        write(b'%d:' % len(value))
+        write(value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        write(b'%d:' % len(encoded))
+        write(encoded)
+    elif isinstance(value, int):
+        write(b'i%de' % value)
+    elif isinstance(value, (list, tuple)):
+        write(b'l')
+        for item in value:
+            _encode(item, write)
+        write(b'e')
+    elif isinstance(value, dict):
+        # Key được sắp xếp theo byte thô (BEP 3), bất kể là str hay bytes
+        items = sorted((key.encode('utf-8') if isinstance(key, str) else bytes(key), item)
+                       for key, item in value.items())
+        write(b'd')
+        for key, item in items:
+            write(b'%d:' % len(key))
+            write(key)
+            _encode(item, write)
+        write(b'e')
+    else:
+        raise BencodeError(f"Cannot bencode {type(value).__name__}")
@@ -0,0 +1,81 @@
+import os
+import threading
+import weakref
+
+"""
+Chỉ mục nội dung dùng chung cho mọi torrent của một Session (content-addressed):
+- SHA-1 của piece -> Piece đang nằm trong FileManager của một torrent nào đó,
+- 'x-pieces root' (gốc Merkle SHA-256) của file -> các file có nội dung đó trên đĩa (file đã share hoặc đã export).
+Torrent mới share hoặc tải về lấy lại dữ liệu đã có thay vì hash lại hoặc tải lại,
+file giống hệt nhau được hardlink khi export.
+"""
+
+
+class ContentIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # SHA-1 -> Piece, tự bỏ khi không còn torrent nào giữ piece đó
+        self.pieces = weakref.WeakValueDictionary()
+        # pieces root -> {đường dẫn tuyệt đối: (mtime_ns, size)}
+        self.files = {}
+        # đường dẫn tuyệt đối -> (mtime_ns, size, pieces root), để share lại không phải hash lại file
+        self.roots = {}
+
+    def add_piece(self, piece):
+        with self.lock:
+            self.pieces[piece.hash_value] = piece
+
+    def find_piece(self, digest):
+        with self.lock:
+            return self.pieces.get(digest)
+
+    def add_file(self, root, path, stat=None):
+        """Ghi nhận file `path` (đã đầy đủ trên đĩa) có 'pieces root' là `root`."""
+        if root is None:
+            return
+        path = os.path.abspath(path)
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            self.files.setdefault(root, {})[path] = key
+            self.roots[path] = key + (root,)
+
+    def find_file(self, root, length):
+        """Một file trên đĩa có nội dung `root`, bỏ các file đã bị sửa hoặc xoá kể từ lúc ghi nhận."""
+        with self.lock:
+            paths = list(self.files.get(root, {}).items())
+        for path, key in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and (stat.st_mtime_ns, stat.st_size) == key and stat.st_size == length:
+                return path
+            self.remove_file(path)
+        return None
+
+    def get_file_root(self, path, stat=None):
+        """'pieces root' đã biết của `path` nếu file chưa thay đổi (cùng mtime và kích thước)."""
+        path = os.path.abspath(path)
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            cached = self.roots.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        return None
+
+    def remove_file(self, path):
+        with self.lock:
+            cached = self.roots.pop(path, None)
+            if cached is None:
+                return
+            paths = self.files.get(cached[2], {})
+            paths.pop(path, None)
+            if not paths:
+                self.files.pop(cached[2], None)
@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+from enum import IntEnum
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUE = 64
+
+"""
+Hàng đợi công việc đĩa (đọc/ghi/hash/flush) chạy trên một pool thread riêng,
+để các thread mạng của PeerHandler không bị chặn khi đĩa bận.
+"""
+
+
+class JobType(IntEnum):
+    READ = 0
+    WRITE = 1
+    HASH = 2
+    FLUSH = 3
+
+
+class DiskJob:
+    def __init__(self, job_type, fn, args, callback=None):
+        self.job_type = job_type
+        self.fn = fn
+        self.args = args
+        self.callback = callback
+
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+        self.finish()
+
+    def cancel(self, error):
+        """Job không bao giờ được chạy (pool đã dừng): báo lỗi cho người chờ và callback."""
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.done.set()
+
+        if self.callback:
+            try:
+                self.callback(self.result, self.error)
+            except Exception as e:
+                print(f"Error in disk job callback ({self.job_type.name}): {e}")
+
+    def wait(self, timeout=None):
+        """Chờ job chạy xong và trả về kết quả, ném lại lỗi nếu job thất bại."""
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Disk job {self.job_type.name} did not finish in time")
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class DiskIOPool:
+    def __init__(self, num_workers=DEFAULT_WORKERS, max_queue=DEFAULT_MAX_QUEUE):
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        # Hàng đợi có giới hạn: submit() bị chặn khi đầy, tạo back-pressure cho tầng mạng
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.workers = []
+        self.lock = threading.Lock()
+        self.is_running = False
+        # Đã stop(): submit() không tự khởi động lại pool, phải gọi start() tường minh
+        self.stopped = False
+
+    def start(self):
+        with self.lock:
+            if self.is_running:
+                return
+            self.is_running = True
+            self.stopped = False
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self.work, name=f"disk-io-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def stop(self):
+        with self.lock:
+            if not self.is_running:
+                return
+            self.is_running = False
+            self.stopped = True
+            workers, self.workers = self.workers, []
+        for _ in workers:
+            self.jobs.put(None)
+        for worker in workers:
+            worker.join()
+        # Job được submit trong lúc đang dừng: không còn worker nào chạy
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.cancel(RuntimeError("Disk I/O pool has been stopped"))
+
+    def submit(self, job_type, fn, *args, callback=None, timeout=None):
+        """
+        Đưa một job vào hàng đợi. callback(result, error) được gọi trên thread đĩa khi xong.
+        Chặn nếu hàng đợi đầy (tối đa `timeout` giây). Ném RuntimeError nếu pool đã bị stop().
+        """
+        if self.stopped:
+            raise RuntimeError("Disk I/O pool has been stopped")
+        if not self.is_running:
+            self.start()
+        job = DiskJob(job_type, fn, args, callback)
+        self.jobs.put(job, timeout=timeout)
+        return job
+
+    def is_congested(self):
+        return self.jobs.qsize() >= self.max_queue * 3 // 4
+
+    def wait_for_capacity(self, timeout=None):
+        """Chờ tới khi hàng đợi xuống dưới ngưỡng nửa đầy trước khi sinh thêm việc."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.jobs.qsize() >= self.max_queue // 2:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job.run()
@@ -1,9 +1,26 @@
+import contextlib
 import hashlib
+import io
 import math
 import os
+import threading
+from enum import IntEnum
 from pathlib import Path
 from typing import List, Dict, Any
 
+import HashCache
+import MerkleTree
+from DiskIO import JobType
+from FileStorage import FileStorage
+
+RECHECK_CHUNK_SIZE = 8 * 1024 * 1024    # Đọc file theo chunk lớn, tuần tự khi recheck
+
+class FilePriority(IntEnum):
+    SKIP = 0
+    NORMAL = 1
+    HIGH = 2
+
+
 class Piece:
     def __init__(self, piece_id: int, data: bytes, hash_value):
         self.piece_id = piece_id
@@ -17,35 +34,164 @@ class Piece:
     def get_data(self):
         return self.data
 
-class FileManager:
-    def __init__(self, save_path= None, info= None):
-        if info:
-            print(info)
-            self.piece_length = info[b'pieceLength']
-            self.total_length = info[b'length']
-            self.piece_file_map = self.build_piece_file_map_from_torrent(info)
-            pieces = info[b'pieces']
-            self.total_pieces = len(pieces) // 40
-            self.name = info[b'name'].decode('utf-8')
+class FilePiece(Piece):
+    """Piece của torrent đang share: không giữ dữ liệu, đọc từ file gốc mỗi khi cần (None nếu file đã đổi)."""
+    def __init__(self, piece_id: int, storage, length, hash_value):
+        self.piece_id = piece_id
+        self.storage = storage
+        self.hash_value = hash_value
+        self.length = length
 
+    def get_data(self):
+        return self.storage.read(self.piece_id)
+
+class PieceStream(io.RawIOBase):
+    """
+    File-like object đọc một file của torrent trực tiếp từ các piece của FileManager.
+    read() chỉ chặn cho tới khi piece chứa vị trí đang đọc được xác thực.
+    """
+    def __init__(self, file_manager, file_name, timeout=None):
+        self.file_manager = file_manager
+        self.file_name = file_name
+        self.start, self.length = file_manager.get_file_offset(file_name)
+        self.position = 0
+        self.timeout = timeout
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
         else:
-            self.piece_length = 524288
-            self.total_length = 0
-            self.piece_file_map = {}
-            self.total_pieces = 0
-            self.name = ''
+            raise ValueError(f"Invalid whence: {whence}")
+        self.position = max(0, min(position, self.length))
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.length or len(buffer) == 0:
+            return 0
+
+        piece_length = self.file_manager.get_piece_length()
+        global_offset = self.start + self.position
+        index = global_offset // piece_length
+        begin = global_offset % piece_length
+
+        # Dời con trỏ đọc để piece picker ưu tiên các piece sắp cần
+        self.file_manager.set_read_cursor(index)
+        piece = self.file_manager.wait_for_piece(index, self.timeout)
+        if piece is None:
+            raise TimeoutError(f"Piece {index} is not available yet")
+
+        data = piece.get_data()
+        if data is None:
+            # FilePiece: file trên đĩa đã bị sửa hoặc xoá kể từ lúc share/recheck
+            raise OSError(f"Cannot read piece {index}: source file changed")
+        size = min(len(buffer), len(data) - begin, self.length - self.position)
+        buffer[:size] = data[begin:begin + size]
+        self.position += size
+        return size
+
 
+class FileManager:
+    def __init__(self, save_path= None, torrent= None, content_index=None, hash_cache=None):
+        self.piece_length = 524288
+        self.total_length = 0
+        self.files = []
+        self.piece_file_map = {}
+        self.total_pieces = 0
+        self.piece_hashes = []
+        self.name = ''
+
+        # Key riêng 'x-piece layer'/'x-pieces root': gốc Merkle SHA-256 của từng piece và của từng file (lá 16 KiB)
+        self.piece_layer = None
+        self.piece_roots: Dict[int, bytes] = {}
+        self.file_roots: Dict[str, bytes] = {}
+
+        # Chỉ mục nội dung chung của Session (nếu có): dùng lại piece/file đã có ở torrent khác
+        self.content_index = content_index
+        # File của torrent có bản giống hệt trên đĩa (cùng 'pieces root'): tên file -> đường dẫn nguồn
+        self.source_files: Dict[str, str] = {}
+        # Hash của piece từ lần share trước (HashCache), share lại chỉ hash phần đã thay đổi
+        self.hash_cache = hash_cache
+        # Share: dữ liệu nằm ở file gốc của người dùng (FileStorage), không nằm trong RAM
+        self.storage = None
+
+        # Recheck: các piece đã đúng sẵn trong thư mục lưu, và tiến độ (đã kiểm tra, tổng) khi đang chạy
+        self.pieces_on_disk = set()
+        self.recheck_state = None
+
+        # Tải bằng magnet: chưa có info dict cho tới khi nhận được metadata từ peer
+        self.metadata_ready = False
+        self.save_root = save_path
+        self.save_path = self.resolve_save_path(save_path)
+
+        # Kho piece có lock riêng, tách khỏi lock của piece picker và của danh sách kết nối
+        self.lock = threading.RLock()
+        self.pieces: Dict[int, Piece] = {}  # piece_id -> Piece
+
+        # Độ ưu tiên của từng file và của từng piece suy ra từ piece_file_map
+        self.file_priorities: Dict[str, FilePriority] = {}
+        self.piece_priorities: List[FilePriority] = []
+        # Độ ưu tiên đặt trước khi có metadata (magnet), áp dụng trong load_info
+        self.requested_priorities: Dict[str, FilePriority] = {}
+
+        # Streaming: vị trí piece mà người đọc đang chờ, và điều kiện để báo khi có piece mới
+        self.read_cursor = None
+        self.piece_available = threading.Condition(self.lock)
+
+        if torrent is not None and torrent.has_info():
+            self.load_info(torrent)
+        else:
+            self.update_piece_priorities()
+
+    def load_info(self, torrent, save_path=None):
+        """
+        Nạp metadata từ Torrent (đọc từ file .torrent, hoặc info dict nhận qua ut_metadata khi tải bằng magnet).
+        Raise KeyError (chưa nạp gì) nếu độ ưu tiên đặt trước có tên file không có trong torrent.
+        """
+        names = {file['file'] for file in torrent.files}
+        with self.lock:
+            unknown = [name for name in self.requested_priorities if name not in names]
+            if unknown:
+                raise KeyError(f"Unknown file: {', '.join(unknown)}")
+            self.piece_length = torrent.piece_length
+            self.total_length = torrent.length
+            self.files = list(torrent.files)
+            self.piece_file_map = self.build_piece_file_map_from_torrent(torrent.info)
+            # Hash của piece được giải mã khi cần, không dựng list cho mọi piece
+            self.piece_hashes = torrent.piece_hashes
+            self.piece_layer = torrent.piece_layer
+            self.total_pieces = len(self.piece_hashes)
+            self.name = torrent.name
+            self.save_path = self.resolve_save_path(save_path or self.save_root)
+            self.file_priorities = {file['file']: FilePriority.NORMAL for file in self.files}
+            self.file_priorities.update(self.requested_priorities)
+            self.requested_priorities = {}
+            self.metadata_ready = True
+        self.update_piece_priorities()
+
+    def resolve_save_path(self, save_path):
         if save_path:
             if "." in os.path.basename(self.name):
-                self.save_path = save_path
-            else:
-                self.save_path = f'{save_path}/{self.name}'
-        else:
-            if os.path.isdir(self.name):
-                self.save_path = 'download'
-            else:
-                self.save_path = f'download/{self.name}'
-        self.pieces = []
+                return save_path
+            return f'{save_path}/{self.name}'
+        if os.path.isdir(self.name):
+            return 'download'
+        return f'download/{self.name}'
+
+    def has_metadata(self):
+        return self.metadata_ready
 
     def __len__(self):
         return len(self.pieces)
@@ -61,71 +207,118 @@ class FileManager:
             return self.total_length - (total_pieces - 1) * self.piece_length
 
     def split_file(self, file_path):
-        self.total_length = os.path.getsize(file_path)
-
         try:
-            with open(file_path, 'rb') as f:
-                piece_id = 0
-                while data := f.read(self.piece_length):
-                    hash_value = hashlib.sha1(data).digest()
-                    piece = Piece(piece_id=piece_id, data=data, hash_value=hash_value)
-                    self.pieces.append(piece)
-                    piece_id += 1
-            self.total_pieces = len(self.pieces)
+            self.split_files([(file_path, os.path.basename(file_path), os.stat(file_path))])
         except OSError:
             raise FileNotFoundError(f"Unable to open file: {file_path}")
 
     def split_dir(self, dir_path):
-
-        self.total_length = os.path.getsize(dir_path)
-
-
-        piece_id = 0
-        buffer = b''
-
         try:
             # Duyệt qua tất cả các file trong thư mục theo thứ tự
-            for file_path in sorted(Path(dir_path).rglob('*')):
-                if file_path.is_file():
-                    with open(file_path, 'rb') as f:
-                        while data := f.read(self.piece_length - len(buffer)):
-                            buffer += data
-                            # Nếu buffer đạt kích thước piece_length, tạo mảnh mới
-                            if len(buffer) == self.piece_length:
-                                hash_value = hashlib.sha1(buffer).digest()  # SHA-1 với độ dài 20 bytes
-                                piece = Piece(piece_id=piece_id, data=buffer, hash_value=hash_value)
-                                self.pieces.append(piece)
-                                piece_id += 1
-                                buffer = b''  # Reset buffer
-
-            # Xử lý phần dữ liệu còn lại nếu có
-            if buffer:
-                hash_value = hashlib.sha1(buffer).digest()  # Dùng SHA-1 cho mảnh cuối
-                piece = Piece(piece_id=piece_id, data=buffer, hash_value=hash_value)
-                self.pieces.append(piece)
-
-            self.total_pieces = len(self.pieces)
+            files = [(file_path, '/'.join(file_path.relative_to(dir_path).parts), file_path.stat())
+                     for file_path in sorted(Path(dir_path).rglob('*')) if file_path.is_file()]
+            self.split_files(files)
         except OSError:
             raise FileNotFoundError(f"Unable to open directory: {dir_path}")
 
+    def split_files(self, files):
+        """
+        Share các file (path, tên trong torrent, stat) nối tiếp nhau mà không nạp vào RAM:
+        piece được đọc từ file gốc khi peer cần (FileStorage). Piece mà mọi đoạn file trong nó chưa đổi
+        (cùng size, mtime, inode) lấy hash từ hash cache, chỉ piece chạm vào file đã thay đổi mới phải đọc và hash lại.
+        """
+        self.storage = FileStorage([(file_path, stat) for file_path, _, stat in files], self.piece_length)
+        self.total_length = self.storage.total_length
+
+        # File đã share trước đó và chưa thay đổi thì không cần tính lại 'pieces root'
+        hashers = {}
+        for file_index, (file_path, file_name, stat) in enumerate(files):
+            root = self.get_cached_file_root(file_path, stat)
+            if root is None and stat.st_size:
+                hashers[file_index] = MerkleTree.LeafHasher()
+            self.file_roots[file_name] = root
+
+        for piece_id in range(self.storage.get_total_pieces()):
+            segments = self.storage.get_segments(piece_id)
+            cache_key = [HashCache.segment(files[file_index][0], files[file_index][2], offset, length)
+                         for file_index, offset, length in segments]
+            cached = self.hash_cache.get(self.piece_length, cache_key) if self.hash_cache else None
+
+            if cached is None or any(file_index in hashers for file_index, _, _ in segments):
+                data = self.storage.read(piece_id, check=False)
+                if data is None:
+                    raise OSError(f"Unable to read piece {piece_id}")
+                position = 0
+                for file_index, _, length in segments:
+                    if file_index in hashers:
+                        hashers[file_index].update(data[position:position + length])
+                    position += length
+                if cached is None:
+                    hash_value = hashlib.sha1(data).digest()  # SHA-1 với độ dài 20 bytes
+                    cached = hash_value, MerkleTree.piece_root(data, self.piece_length)
+                    if self.hash_cache:
+                        self.hash_cache.put(self.piece_length, cache_key, *cached)
+
+            hash_value, piece_root = cached
+            piece = FilePiece(piece_id, self.storage, sum(length for _, _, length in segments), hash_value)
+            self.pieces[piece_id] = piece
+            self.piece_roots[piece_id] = piece_root
+            if self.content_index:
+                self.content_index.add_piece(piece)
+
+        for file_index, (file_path, file_name, stat) in enumerate(files):
+            if file_index in hashers:
+                self.file_roots[file_name] = hashers[file_index].root()
+                if self.hash_cache:
+                    self.hash_cache.put_file_root(file_path, stat, self.file_roots[file_name])
+            if self.content_index:
+                self.content_index.add_file(self.file_roots[file_name], file_path, stat)
+
+        if self.hash_cache:
+            self.hash_cache.save()
+        self.total_pieces = len(self.pieces)
+        self.metadata_ready = True
+        self.update_piece_priorities()
+
+    def check_storage(self):
+        """Torrent đang share từ file gốc: True nếu các file vẫn như lúc share (có thể seed)."""
+        return self.storage is None or self.storage.check()
+
+    def get_cached_file_root(self, file_path, stat):
+        root = self.hash_cache.get_file_root(file_path, stat) if self.hash_cache else None
+        if root is None and self.content_index:
+            root = self.content_index.get_file_root(file_path, stat)
+        return root
+
     def get_piece(self, index) -> Piece:
-        for piece in self.pieces:
-            if piece.piece_id == index:
-                return piece
+        return self.pieces.get(index)
 
-    def has_piece(self, piece_id):
-        for piece in self.pieces:
-            if piece.piece_id == piece_id:
-                return True
+    def read_piece(self, index):
+        """Dữ liệu của piece `index`, None nếu chưa có hoặc file gốc đã thay đổi."""
+        piece = self.get_piece(index)
+        return None if piece is None else piece.get_data()
 
-        return False
+    def close(self):
+        if self.storage:
+            self.storage.close()
+
+    def has_piece(self, piece_id):
+        return piece_id in self.pieces
 
     def get_pieces_code(self):
-        result = ""
-        for piece in self.pieces:
-            result += f"{piece.hash_value.hex()}"
+        with self.lock:
+            return "".join(self.pieces[piece_id].hash_value.hex() for piece_id in sorted(self.pieces))
 
-        return result
+    def get_piece_layer(self):
+        """Piece layer ('x-piece layer'): gốc Merkle của các piece nối liền nhau, theo thứ tự piece."""
+        with self.lock:
+            return b''.join(self.piece_roots[piece_id] for piece_id in sorted(self.piece_roots))
+
+    def get_file_root(self, file_name):
+        return self.file_roots.get(file_name)
+
+    def get_blocks_per_piece(self):
+        return self.piece_length // MerkleTree.BLOCK_SIZE
 
     def get_bitfield(self):
 
@@ -134,9 +327,11 @@ class FileManager:
         bitfield = [0] * num_bytes  # Initialize as list of zeroed bytes
 
         # Set each downloaded piece in the bitfield
-        for piece in self.pieces:
-            byte_index = piece.piece_id // 8
-            bit_index = piece.piece_id % 8
+        with self.lock:
+            piece_ids = list(self.pieces)
+        for piece_id in piece_ids:
+            byte_index = piece_id // 8
+            bit_index = piece_id % 8
             bitfield[byte_index] |= (1 << (7 - bit_index))
 
         # Ensure spare bits in the last byte are cleared if not a full byte
@@ -152,29 +347,322 @@ class FileManager:
 
     def is_interested(self, bitfield):
         num_pieces = math.ceil(self.total_length / self.piece_length)
-        current_piece_ids = {piece.piece_id for piece in self.pieces}
+        current_piece_ids = self.pieces
 
-        for piece_id in range(num_pieces):
+        # Peer tải bằng magnet chưa có metadata gửi bitfield rỗng
+        for piece_id in range(min(num_pieces, len(bitfield) * 8)):
             byte_index = piece_id // 8
             bit_index = piece_id % 8
             # Check if the piece is available in the bitfield
             if bitfield[byte_index] & (1 << (7 - bit_index)):
-                # Check if we don't have this piece
-                if piece_id not in current_piece_ids:
+                # Check if we don't have this piece and still want it
+                if piece_id not in current_piece_ids and self.is_wanted(piece_id):
                     return True
 
         return False
 
     def add_piece(self, piece: Piece):
-        for has_piece in self.pieces:
-            if has_piece.piece_id == piece.piece_id:
+        with self.piece_available:
+            if piece.piece_id in self.pieces:
                 return
-        self.pieces.append(piece)
+            self.pieces[piece.piece_id] = piece
+            self.missing_wanted.discard(piece.piece_id)
+            self.piece_available.notify_all()
+        if self.content_index:
+            self.content_index.add_piece(piece)
+
+    def reuse_content(self):
+        """
+        Lấy sẵn các piece còn thiếu từ dữ liệu Session đã có: piece có cùng SHA-1 ở torrent khác,
+        hoặc đọc từ file trên đĩa có cùng 'pieces root'. Trả về số piece không cần tải nữa.
+        """
+        if self.content_index is None or not self.metadata_ready:
+            return 0
+
+        sources = {}
+        for file in self.files:
+            if file.get('pieces_root'):
+                path = self.content_index.find_file(file['pieces_root'], file['length'])
+                if path:
+                    sources[file['file']] = path
+        self.source_files = sources
+
+        with self.lock:
+            missing = sorted(self.missing_wanted)
+        reused = 0
+        with contextlib.ExitStack() as stack:
+            handles = {}
+            for index in missing:
+                digest = self.piece_hashes[index]
+                piece = self.content_index.find_piece(digest)
+                data = None
+                if piece is not None and piece.get_length() == self.get_exact_piece_length(index):
+                    data = piece.get_data()
+                if data is None:
+                    data = self.read_from_sources(index, stack, handles)
+                    if data is None or not self.verify_piece(index, data):
+                        continue
+                self.add_piece(Piece(index, data, digest))
+                reused += 1
+        return reused
+
+    def recheck(self, disk_io, on_progress=None):
+        """
+        Kiểm tra dữ liệu đã có trong thư mục lưu: các file được đọc tuần tự theo chunk lớn trên thread này,
+        hash của piece được kiểm tra song song trên `disk_io`, piece đúng được thêm vào như đã tải xong
+        nhưng không giữ trong RAM: được đọc lại từ thư mục lưu khi cần (FilePiece).
+        on_progress(checked, total) được gọi sau mỗi piece. Trả về số piece hợp lệ.
+        """
+        if not self.metadata_ready:
+            return 0
+        if self.storage is None:
+            self.storage = self.open_save_storage()
+        storage = self.storage
+        indexes = [index for index in range(self.total_pieces) if not self.has_piece(index)]
+        total = len(indexes)
+        progress = threading.Condition()
+        state = {'checked': 0, 'valid': 0}
+        self.recheck_state = (0, total)
+
+        def finish(index, data, ok):
+            added = False
+            try:
+                if ok:
+                    hash_value = hashlib.sha1(data).digest()
+                    if storage.covers(index):
+                        with self.lock:
+                            self.pieces_on_disk.add(index)
+                        self.add_piece(FilePiece(index, storage, len(data), hash_value))
+                    else:
+                        # Nằm trong file dài hơn trong torrent: giữ trong RAM, export ghi lại file đó như bình thường
+                        self.add_piece(Piece(index, data, hash_value))
+                    added = True
+            finally:
+                # Luôn đếm piece đã kiểm tra, nếu không recheck() chờ mãi (lỗi trong callback chỉ được in ra)
+                with progress:
+                    state['checked'] += 1
+                    state['valid'] += added
+                    checked = state['checked']
+                    self.recheck_state = (checked, total)
+                    progress.notify_all()
+                    if on_progress:
+                        # Gọi trong lock để tiến độ được báo theo đúng thứ tự
+                        on_progress(checked, total)
+
+        for index, data in self.read_pieces_from_disk(indexes):
+            if data is None:
+                finish(index, None, False)
+                continue
+            # Hàng đợi của pool có giới hạn: thread đọc tự chậm lại khi hash không kịp
+            disk_io.submit(JobType.HASH, self.verify_piece, index, data,
+                           callback=lambda ok, error, index=index, data=data: finish(index, data, ok and not error))
+
+        with progress:
+            progress.wait_for(lambda: state['checked'] >= total)
+        self.recheck_state = None
+        return state['valid']
+
+    def open_save_storage(self):
+        """FileStorage trên các file trong thư mục lưu, file thiếu hoặc sai kích thước coi như chưa có."""
+        files = []
+        for file in self.files:
+            path = os.path.join(self.save_path, file['file'])
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            files.append((path, stat if stat is not None and stat.st_size == file['length'] else None))
+        return FileStorage(files, self.piece_length, [file['length'] for file in self.files])
+
+    def read_pieces_from_disk(self, indexes):
+        """Sinh (index, dữ liệu) của các piece theo thứ tự, dữ liệu là None nếu file thiếu hoặc ngắn hơn."""
+        name, handle = None, None
+        try:
+            for index in indexes:
+                parts = []
+                for mapping in self.piece_file_map[index]:
+                    if mapping['file'] != name:
+                        # Các file nằm nối tiếp nhau trong torrent, chỉ cần mở một file tại một thời điểm
+                        if handle:
+                            handle.close()
+                        name = mapping['file']
+                        try:
+                            handle = open(os.path.join(self.save_path, name), 'rb', buffering=RECHECK_CHUNK_SIZE)
+                        except OSError:
+                            handle = None
+                    if handle is None:
+                        parts = None
+                        break
+                    if handle.tell() != mapping['offset']:
+                        handle.seek(mapping['offset'])
+                    part = handle.read(mapping['length'])
+                    if len(part) != mapping['length']:
+                        parts = None
+                        break
+                    parts.append(part)
+                yield index, None if parts is None else b''.join(parts)
+        finally:
+            if handle:
+                handle.close()
+
+    def get_recheck_progress(self):
+        """Phần trăm đã recheck, None nếu không recheck."""
+        state = self.recheck_state
+        if state is None:
+            return None
+        checked, total = state
+        return checked / total * 100 if total else 100.0
+
+    def read_from_sources(self, index, stack, handles):
+        """Ghép piece `index` từ các file nguồn, None nếu có phần nằm trong file không có nguồn."""
+        mappings = self.piece_file_map[index] if index < len(self.piece_file_map) else []
+        if not mappings or any(mapping['file'] not in self.source_files for mapping in mappings):
+            return None
+        parts = []
+        for mapping in mappings:
+            file_name = mapping['file']
+            if file_name not in handles:
+                try:
+                    handles[file_name] = stack.enter_context(open(self.source_files[file_name], 'rb'))
+                except OSError:
+                    return None
+            handles[file_name].seek(mapping['offset'])
+            parts.append(handles[file_name].read(mapping['length']))
+        return b''.join(parts)
+
+    def verify_piece(self, index, data):
+        """
+        So sánh dữ liệu với hash trong torrent (nếu có): torrent có piece layer thì dùng
+        gốc Merkle SHA-256 của piece, không thì SHA-1 (v1).
+        """
+        if index >= len(self.piece_hashes):
+            return not self.piece_hashes
+        if self.piece_layer is not None:
+            return MerkleTree.piece_root(data, self.piece_length) == self.piece_layer[index]
+        return hashlib.sha1(data).digest() == self.piece_hashes[index]
+
+    def find_bad_blocks(self, index, data, leaves):
+        """
+        Hash lá của piece nhận từ peer khớp với piece layer thì trả về các block hỏng
+        (chỉ số block trong piece), không khớp thì trả về None.
+        """
+        if self.piece_layer is None or index >= len(self.piece_layer):
+            return None
+        if MerkleTree.merkle_root(leaves, self.get_blocks_per_piece()) != self.piece_layer[index]:
+            return None
+        if len(leaves) != MerkleTree.num_blocks(self.get_exact_piece_length(index)):
+            return None
+        return MerkleTree.bad_blocks(data, leaves)
+
+    def wait_for_piece(self, index, timeout=None):
+        """Chặn tới khi piece `index` đã được xác thực và thêm vào, trả về Piece hoặc None nếu hết timeout."""
+        with self.piece_available:
+            self.piece_available.wait_for(lambda: self.has_piece(index), timeout)
+            return self.get_piece(index)
+
+    def set_read_cursor(self, index):
+        self.read_cursor = index
+
+    def get_file_offset(self, file_name):
+        """Vị trí bắt đầu của file trong dòng dữ liệu liên tục của torrent."""
+        offset = 0
+        for file in self.files:
+            if file['file'] == file_name:
+                return offset, file['length']
+            offset += file['length']
+        raise KeyError(f"Unknown file: {file_name}")
+
+    def open_stream(self, file_name=None):
+        """
+        Mở một file-like object để đọc file trong khi đang tải.
+        Nếu không truyền file_name thì đọc file đầu tiên của torrent.
+        """
+        if not self.metadata_ready or not self.files:
+            # Magnet: chưa biết danh sách file cho tới khi nhận được info dict từ peer
+            raise RuntimeError("Torrent metadata is not available yet")
+        if file_name is None:
+            file_name = self.files[0]['file']
+        if self.file_priorities.get(file_name) == FilePriority.SKIP:
+            self.set_file_priority(file_name, FilePriority.NORMAL)
+        return io.BufferedReader(PieceStream(self, file_name), buffer_size=self.piece_length)
+
+    def iter_file(self, file_name=None, chunk_size=None):
+        """Generator trả về dữ liệu của file theo thứ tự, mỗi lần một chunk."""
+        with self.open_stream(file_name) as stream:
+            while chunk := stream.read(chunk_size or self.piece_length):
+                yield chunk
 
     def check_complete(self):
-        if len(self.pieces) == self.total_pieces:
-            return True
-        return False
+        return self.metadata_ready and not self.missing_wanted
+
+    def get_progress(self):
+        if not self.metadata_ready:
+            return 0.0
+        with self.lock:
+            wanted = len(self.wanted_pieces)
+            missing = len(self.missing_wanted)
+        if not wanted:
+            return 100.0
+        return (wanted - missing) / wanted * 100
+
+    def get_bytes_left(self):
+        with self.lock:
+            missing = list(self.missing_wanted)
+        return sum(self.get_exact_piece_length(piece_id) for piece_id in missing)
+
+    def get_files(self):
+        return [file['file'] for file in self.files]
+
+    def set_file_priority(self, file_name, priority):
+        self.set_file_priorities({file_name: priority})
+
+    def set_file_priorities(self, priorities: Dict[str, int]):
+        """
+        Đặt độ ưu tiên cho nhiều file cùng lúc, tên file sai thì raise KeyError và không đổi gì.
+        Chưa có metadata (magnet) thì lưu lại, tên file được kiểm tra khi metadata tới (load_info).
+        """
+        priorities = {file_name: FilePriority(priority) for file_name, priority in priorities.items()}
+        with self.lock:
+            if not self.metadata_ready:
+                self.requested_priorities.update(priorities)
+                return
+            unknown = [file_name for file_name in priorities if file_name not in self.file_priorities]
+            if unknown:
+                raise KeyError(f"Unknown file: {', '.join(unknown)}")
+            self.file_priorities.update(priorities)
+        self.update_piece_priorities()
+
+    def update_piece_priorities(self):
+        """
+        Piece nằm giữa hai file (boundary piece) lấy độ ưu tiên cao nhất
+        của các file mà nó chứa, nên vẫn được tải nếu một trong các file đó cần.
+        """
+        if not self.piece_file_map:
+            piece_priorities = [FilePriority.NORMAL] * self.total_pieces
+        else:
+            piece_priorities = [
+                max((self.file_priorities.get(mapping['file'], FilePriority.NORMAL) for mapping in mappings),
+                    default=FilePriority.SKIP)
+                for mappings in self.piece_file_map
+            ]
+
+        # Giữ sẵn tập piece cần mà chưa có để check_complete là O(1)
+        with self.lock:
+            self.piece_priorities = piece_priorities
+            self.wanted_pieces = {piece_id for piece_id, priority in enumerate(piece_priorities)
+                                  if priority != FilePriority.SKIP}
+            self.missing_wanted = self.wanted_pieces - self.pieces.keys()
+
+    def get_piece_priority(self, index):
+        if index < len(self.piece_priorities):
+            return self.piece_priorities[index]
+        return FilePriority.NORMAL
+
+    def is_wanted(self, index):
+        return self.get_piece_priority(index) != FilePriority.SKIP
+
+    def get_wanted_pieces(self):
+        return sorted(self.wanted_pieces)
 
     def export(self):
         # Tạo thư mục 'download' nếu chưa tồn tại
@@ -182,9 +670,23 @@ class FileManager:
         if not os.path.exists(self.save_path):
             os.makedirs(self.save_path)
 
+        # File có bản giống hệt trên đĩa được hardlink, không ghi lại
+        linked = {file_name for file_name in self.source_files if self.link_source_file(file_name)}
+        # File mà mọi piece đều đã đúng sẵn trên đĩa (recheck) cũng không cần ghi lại
+        on_disk = {}
+        with self.lock:
+            for piece_id, mappings in enumerate(self.piece_file_map):
+                for mapping in mappings:
+                    on_disk[mapping['file']] = on_disk.get(mapping['file'], True) and piece_id in self.pieces_on_disk
+        linked |= {file_name for file_name, verified in on_disk.items() if verified}
+        # File chỉ đúng một phần: ghi tiếp vào file, không xoá dữ liệu của các piece đã đúng sẵn
+        partial = {mapping['file'] for piece_id in self.pieces_on_disk for mapping in self.piece_file_map[piece_id]}
+
         # Khởi tạo bộ đệm cho mỗi file
         file_buffers = {}
-        for piece in self.pieces:
+        with self.lock:
+            pieces = [piece for piece in self.pieces.values() if piece.piece_id not in self.pieces_on_disk]
+        for piece in pieces:
             piece_data = piece.get_data()
             piece_id = piece.piece_id
 
@@ -197,13 +699,24 @@ class FileManager:
                 offset = mapping['offset']
                 length = mapping['length']
 
+                # Bỏ qua phần dữ liệu thuộc file không được chọn (boundary piece) hoặc đã hardlink
+                if self.file_priorities.get(file_name) == FilePriority.SKIP or file_name in linked:
+                    piece_data = piece_data[length:]
+                    continue
+
                 # Đảm bảo file buffer được mở và sẵn sàng để ghi
                 if file_name not in file_buffers:
                     path = os.path.join(self.save_path, file_name)
                     dir_path = os.path.dirname(path)
                     if not os.path.exists(dir_path):
                         os.makedirs(dir_path)
-                    file_buffers[file_name] = open(path, 'wb')
+                    if file_name in partial and os.path.exists(path):
+                        file_buffers[file_name] = open(path, 'r+b')
+                    else:
+                        # Không ghi đè qua hardlink, sẽ làm hỏng file nguồn của torrent khác
+                        if os.path.exists(path) and os.stat(path).st_nlink > 1:
+                            os.remove(path)
+                        file_buffers[file_name] = open(path, 'wb')
 
                 # Ghi dữ liệu của piece vào file đích tại vị trí offset
                 file_buffers[file_name].seek(offset)
@@ -216,17 +729,50 @@ class FileManager:
         for file in file_buffers.values():
             file.close()
 
+        # Piece đã đúng sẵn được đọc từ chính các file vừa ghi thêm: nhận stat mới của chúng
+        if self.storage:
+            for file_index, file in enumerate(self.files):
+                if file['file'] in file_buffers:
+                    self.storage.refresh(file_index)
+
+        # File vừa export trở thành nguồn cho các torrent khác có cùng nội dung
+        if self.content_index:
+            for file in self.files:
+                if file['file'] in file_buffers or file['file'] in linked:
+                    self.content_index.add_file(file.get('pieces_root'), os.path.join(self.save_path, file['file']))
+
         print("Export completed successfully.")
 
+    def link_source_file(self, file_name):
+        """Hardlink file nguồn có cùng nội dung vào thư mục lưu, False nếu không được (khác ổ đĩa, nguồn đã đổi...)."""
+        if self.file_priorities.get(file_name) == FilePriority.SKIP:
+            return False
+        file = next((file for file in self.files if file['file'] == file_name), None)
+        source = self.source_files[file_name]
+        if file is None or self.content_index.get_file_root(source) != file['pieces_root']:
+            return False
+
+        path = os.path.join(self.save_path, file_name)
+        try:
+            if os.path.exists(path):
+                # Tải vào đúng chỗ đang chứa file nguồn: không có gì phải làm
+                if os.path.samefile(source, path):
+                    return True
+                os.remove(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            os.link(source, path)
+        except OSError as e:
+            print(f"Cannot link {source} to {path}: {e}")
+            return False
+        print(f"Linked {path} to existing file {source}")
+        return True
+
     def build_piece_file_map_from_torrent(self, torrent_info):
 
         piece_length = torrent_info[b'pieceLength']
         pieces = torrent_info[b'pieces']
         total_pieces = len(pieces) // 40  # Mỗi piece có một SHA1 hash dài 20 bytes
-        print(f"Length of pieces: {len(pieces)}")
-        print(f"Total pieces calculated: {total_pieces}")
-        print(f"Pieces (hex): {pieces.hex()}")
-        print(f"Piece length: {piece_length}")
+        print(f"Total pieces: {total_pieces}, piece length: {piece_length}")
         piece_file_map = []
 
         # Kiểm tra nếu có 'files' thì là multi-file, ngược lại là single-file
@@ -236,7 +782,6 @@ class FileManager:
                 {'length': file[b'length'], 'path': [part.decode() for part in file[b'path']]}
                 for file in torrent_info[b'files']
             ]
-            print(f"Files: {files}")
             current_file_index = 0
             current_file_offset = 0
 
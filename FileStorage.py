@@ -0,0 +1,144 @@
+import bisect
+import os
+import threading
+from collections import OrderedDict
+
+MAX_OPEN_FILES = 64
+
+"""
+Dữ liệu của torrent đang share, đọc thẳng từ file gốc của người dùng thay vì giữ cả torrent trong RAM.
+Mỗi file được ghi nhận (size, mtime_ns, inode) lúc share. Khi một file bị sửa, xoá hoặc thay thế,
+việc đọc trả về None (seeding tạm dừng) cho tới khi file trở lại đúng như lúc share hoặc được share lại.
+Khi tải về, các piece đã đúng sẵn trong thư mục lưu (recheck) cũng được đọc từ đó theo cách này.
+"""
+
+
+def _stat_key(stat):
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class FileStorage:
+    def __init__(self, files, piece_length, sizes=None):
+        """
+        :param files: list (đường dẫn, stat) theo đúng thứ tự các file nối tiếp nhau trong torrent,
+                      stat là None nếu file chưa có trên đĩa (đọc piece nằm trong file đó luôn trả về None)
+        :param sizes: độ dài của từng file trong torrent, mặc định lấy từ stat
+        """
+        self.paths = [os.path.abspath(path) for path, _ in files]
+        self.keys = [None if stat is None else _stat_key(stat) for _, stat in files]
+        self.sizes = list(sizes) if sizes is not None else [stat.st_size for _, stat in files]
+        self.piece_length = piece_length
+
+        # Vị trí bắt đầu của từng file trong dòng dữ liệu liên tục của torrent
+        self.offsets = []
+        offset = 0
+        for size in self.sizes:
+            self.offsets.append(offset)
+            offset += size
+        self.total_length = offset
+
+        self.lock = threading.Lock()
+        self.handles = OrderedDict()   # chỉ số file -> file đang mở (LRU)
+        self.changed = set()           # chỉ số các file đã khác lúc share
+
+    def get_total_pieces(self):
+        return (self.total_length + self.piece_length - 1) // self.piece_length
+
+    def get_segments(self, index):
+        """Các đoạn (chỉ số file, offset trong file, độ dài) tạo nên piece `index`."""
+        start = index * self.piece_length
+        end = min(start + self.piece_length, self.total_length)
+        segments = []
+        file_index = bisect.bisect_right(self.offsets, start) - 1
+        while start < end and file_index < len(self.paths):
+            file_end = self.offsets[file_index] + self.sizes[file_index]
+            length = min(end, file_end) - start
+            if length > 0:
+                segments.append((file_index, start - self.offsets[file_index], length))
+                start += length
+            file_index += 1
+        return segments
+
+    def covers(self, index):
+        """True nếu mọi file chứa piece `index` đều có trên đĩa."""
+        return all(self.keys[file_index] is not None for file_index, _, _ in self.get_segments(index))
+
+    def read(self, index, check=True):
+        """Dữ liệu của piece `index`, None nếu một file của piece đã thay đổi hoặc không đọc được."""
+        segments = self.get_segments(index)
+        if check and not all(self.check_file(file_index) for file_index, _, _ in segments):
+            return None
+        parts = []
+        try:
+            with self.lock:
+                for file_index, offset, length in segments:
+                    handle = self.get_handle(file_index)
+                    handle.seek(offset)
+                    parts.append(handle.read(length))
+        except OSError as e:
+            print(f"Cannot read piece {index}: {e}")
+            return None
+        data = b''.join(parts)
+        if len(data) != sum(length for _, _, length in segments):
+            return None
+        return data
+
+    def get_handle(self, file_index):
+        handle = self.handles.get(file_index)
+        if handle is None:
+            handle = open(self.paths[file_index], 'rb')
+            self.handles[file_index] = handle
+            while len(self.handles) > MAX_OPEN_FILES:
+                self.handles.popitem(last=False)[1].close()
+        self.handles.move_to_end(file_index)
+        return handle
+
+    def check_file(self, file_index):
+        """So stat hiện tại của file với lúc share, ghi nhận khi file đổi hoặc trở lại như cũ."""
+        path = self.paths[file_index]
+        if self.keys[file_index] is None:
+            return False
+        try:
+            unchanged = _stat_key(os.stat(path)) == self.keys[file_index]
+        except OSError:
+            unchanged = False
+        with self.lock:
+            if unchanged and file_index in self.changed:
+                self.changed.discard(file_index)
+                print(f"Source file {path} is back to its shared state")
+            elif not unchanged and file_index not in self.changed:
+                self.changed.add(file_index)
+                # File bị thay thế: handle cũ còn trỏ tới inode cũ
+                handle = self.handles.pop(file_index, None)
+                if handle:
+                    handle.close()
+                print(f"Source file {path} changed since it was shared")
+        return unchanged
+
+    def check(self):
+        """Kiểm tra mọi file đang có, trả về True nếu có thể tiếp tục seed."""
+        return all([self.check_file(file_index) for file_index in range(len(self.paths))
+                    if self.keys[file_index] is not None])
+
+    def refresh(self, file_index):
+        """File vừa được chính torrent ghi lại (export): ghi nhận stat mới thay vì coi là đã thay đổi."""
+        try:
+            stat = os.stat(self.paths[file_index])
+        except OSError:
+            stat = None
+        with self.lock:
+            self.keys[file_index] = _stat_key(stat) if stat and stat.st_size == self.sizes[file_index] else None
+            self.changed.discard(file_index)
+            handle = self.handles.pop(file_index, None)
+            if handle:
+                handle.close()
+
+    def is_paused(self):
+        with self.lock:
+            return bool(self.changed)
+
+    def close(self):
+        with self.lock:
+            for handle in self.handles.values():
+                handle.close()
+            self.handles.clear()
@@ -0,0 +1,114 @@
+import os
+import threading
+from collections import OrderedDict
+
+import Bencode
+
+HASH_CACHE_VERSION = 1
+MAX_CACHED_PIECES = 200000     # ~100 GB dữ liệu với piece 512 KiB
+MAX_CACHED_FILES = 100000
+
+"""
+Cache hash của piece khi share, lưu ra đĩa giữa các lần chạy.
+Một piece được nhận diện bằng các đoạn file nằm trong nó: (đường dẫn, size, mtime_ns, inode, offset, length).
+Share lại một thư mục chỉ phải hash các piece chứa file đã thay đổi (hoặc bị dời vị trí vì
+file phía trước đổi kích thước), còn lại lấy SHA-1 và piece root từ cache.
+"""
+
+
+def segment(path, stat, offset, length):
+    """Đoạn [offset, offset + length) của file `path` có thông tin `stat` (os.stat_result)."""
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, offset, length
+
+
+def _file_key(path, stat):
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class HashCache:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()   # Hai lần share cùng lúc không ghi chung file tạm
+        # (piece_length, (segment, ...)) -> (SHA-1, piece root)
+        self.pieces = OrderedDict()
+        # (đường dẫn, size, mtime_ns, inode) -> pieces root của file
+        self.files = OrderedDict()
+        self.dirty = False
+        if path and os.path.exists(path):
+            self.load()
+
+    def get(self, piece_length, segments):
+        key = (piece_length, tuple(segments))
+        with self.lock:
+            cached = self.pieces.get(key)
+            if cached:
+                self.pieces.move_to_end(key)
+            return cached
+
+    def put(self, piece_length, segments, hash_value, piece_root):
+        with self.lock:
+            self._put(self.pieces, (piece_length, tuple(segments)), (hash_value, piece_root), MAX_CACHED_PIECES)
+
+    def get_file_root(self, path, stat):
+        key = _file_key(path, stat)
+        with self.lock:
+            root = self.files.get(key)
+            if root:
+                self.files.move_to_end(key)
+            return root
+
+    def put_file_root(self, path, stat, root):
+        if root is None:
+            return
+        with self.lock:
+            self._put(self.files, _file_key(path, stat), root, MAX_CACHED_FILES)
+
+    def _put(self, entries, key, value, limit):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > limit:
+            entries.popitem(last=False)
+        self.dirty = True
+
+    def load(self):
+        """Cache hỏng hoặc khác phiên bản thì bỏ qua, lần share sau sẽ hash lại."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = Bencode.decode(f.read())
+            if data.get(b'version') != HASH_CACHE_VERSION:
+                raise ValueError(f"Unsupported hash cache version in {self.path}")
+            for piece_length, segments, hash_value, piece_root in data[b'pieces']:
+                key = tuple((os.fsdecode(path), *fields) for path, *fields in segments)
+                self.pieces[(piece_length, key)] = (hash_value, piece_root)
+            for path, size, mtime_ns, inode, root in data[b'files']:
+                self.files[(os.fsdecode(path), size, mtime_ns, inode)] = root
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring hash cache {self.path}: {e}")
+            self.pieces.clear()
+            self.files.clear()
+
+    def save(self):
+        """Ghi file tạm rồi os.replace để không bao giờ để lại cache dở dang."""
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {
+                b'version': HASH_CACHE_VERSION,
+                b'pieces': [[piece_length, [[os.fsencode(path), *fields] for path, *fields in segments],
+                             hash_value, piece_root]
+                            for (piece_length, segments), (hash_value, piece_root) in self.pieces.items()],
+                b'files': [[os.fsencode(path), *fields, root] for (path, *fields), root in self.files.items()],
+            }
+            self.dirty = False
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self.save_lock:
+            with open(tmp_path, 'wb') as f:
+                f.write(Bencode.encode(data))
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,189 @@
+import os
+import re
+import selectors
+import socket
+import struct
+import threading
+import time
+
+LSD_GROUP = '239.192.152.143'
+LSD_PORT = 6771
+LSD_INTERVAL = 300           # BEP 14: announce lại mỗi 5 phút
+LSD_MAX_MESSAGE = 1400       # Giữ mỗi datagram trong một MTU
+LSD_MAX_HASHES = 20          # Số Infohash tối đa trong một message
+
+"""
+Local Service Discovery (BEP 14): announce info_hash qua multicast trong mạng LAN,
+các peer cùng mạng nghe được thì thêm nhau vào pool ứng viên mà không cần hỏi tracker.
+Peer mới announce ngay khi thêm torrent; peer đã có torrent trả lời unicast về socket gửi
+của peer mới, nên hai bên tìm thấy nhau ngay thay vì phải chờ chu kỳ 5 phút.
+"""
+
+
+def make_search_message(port, info_hashes, cookie):
+    lines = ['BT-SEARCH * HTTP/1.1', f'Host: {LSD_GROUP}:{LSD_PORT}', f'Port: {port}']
+    lines += [f'Infohash: {info_hash.hex()}' for info_hash in info_hashes]
+    lines.append(f'cookie: {cookie}')
+    return ('\r\n'.join(lines) + '\r\n\r\n\r\n').encode()
+
+
+def parse_search_message(data):
+    """Trả về (port, [info_hash], cookie), hoặc None nếu không phải BT-SEARCH hợp lệ."""
+    try:
+        text = data.decode('ascii')
+    except UnicodeDecodeError:
+        return None
+    lines = text.split('\r\n')
+    if not lines[0].startswith('BT-SEARCH * HTTP/1.1'):
+        return None
+
+    port = None
+    cookie = None
+    info_hashes = []
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'port' and value.isdigit():
+            port = int(value)
+        elif name == 'infohash' and re.fullmatch(r'[0-9a-fA-F]{40}', value):
+            info_hashes.append(bytes.fromhex(value))
+        elif name == 'cookie':
+            cookie = value
+    if not port or not 0 < port < 65536 or not info_hashes:
+        return None
+    return port, info_hashes, cookie
+
+
+class LocalDiscovery:
+    """
+    Một instance cho mỗi Session. `on_peer(info_hash, (ip, port))` được gọi
+    trên thread của LocalDiscovery mỗi khi nghe thấy peer trong LAN có torrent đang chạy.
+    """
+    def __init__(self, port, on_peer, interface='0.0.0.0', group=LSD_GROUP, group_port=LSD_PORT):
+        self.port = port
+        self.on_peer = on_peer
+        self.interface = interface
+        self.group = group
+        self.group_port = group_port
+        # Nhận diện và bỏ qua message của chính mình (multicast loop)
+        self.cookie = os.urandom(8).hex()
+
+        self.lock = threading.Lock()
+        self.info_hashes = set()
+
+        self.is_running = False
+        self.thread = None
+        self.listen_socket = None
+        self.send_socket = None
+
+    def start(self):
+        """Mở socket multicast, trả về False nếu mạng không hỗ trợ (LSD khi đó bị tắt)."""
+        if self.is_running:
+            return True
+        try:
+            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.listen_socket.bind(('', self.group_port))
+            membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(self.interface))
+            self.listen_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+            # Socket gửi riêng có cổng ngẫu nhiên: trả lời unicast về đây luôn tới đúng instance,
+            # kể cả khi nhiều Session trên cùng máy cùng nghe cổng 6771
+            self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.interface != '0.0.0.0':
+                self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                            socket.inet_aton(self.interface))
+            self.send_socket.bind((self.interface, 0))
+        except OSError as e:
+            print(f"Local peer discovery disabled: {e}")
+            self.close_sockets()
+            return False
+
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.is_running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.close_sockets()
+
+    def close_sockets(self):
+        for sock in (self.listen_socket, self.send_socket):
+            if sock:
+                sock.close()
+        self.listen_socket = None
+        self.send_socket = None
+
+    def add(self, info_hash):
+        with self.lock:
+            self.info_hashes.add(info_hash)
+        # Announce ngay để peer trong LAN biết trong vòng một giây
+        self.announce([info_hash])
+
+    def remove(self, info_hash):
+        with self.lock:
+            self.info_hashes.discard(info_hash)
+
+    def announce(self, info_hashes=None, addr=None):
+        """Gửi BT-SEARCH tới nhóm multicast, hoặc unicast tới `addr` khi trả lời."""
+        if not self.is_running:
+            return
+        if info_hashes is None:
+            with self.lock:
+                info_hashes = list(self.info_hashes)
+        info_hashes = list(info_hashes)
+        for i in range(0, len(info_hashes), LSD_MAX_HASHES):
+            message = make_search_message(self.port, info_hashes[i:i + LSD_MAX_HASHES], self.cookie)
+            try:
+                self.send_socket.sendto(message, addr or (self.group, self.group_port))
+            except OSError as e:
+                print(f"Local discovery announce failed: {e}")
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.listen_socket, selectors.EVENT_READ, data=True)
+        selector.register(self.send_socket, selectors.EVENT_READ, data=False)
+        next_announce = time.monotonic() + LSD_INTERVAL
+
+        while self.is_running:
+            timeout = max(0.0, min(next_announce - time.monotonic(), 1.0))
+            for key, _ in selector.select(timeout):
+                self.receive(key.fileobj, multicast=key.data)
+
+            if time.monotonic() >= next_announce:
+                self.announce()
+                next_announce = time.monotonic() + LSD_INTERVAL
+
+        selector.close()
+
+    def receive(self, sock, multicast):
+        try:
+            data, addr = sock.recvfrom(LSD_MAX_MESSAGE)
+        except OSError:
+            return
+        message = parse_search_message(data)
+        if message is None:
+            return
+        port, info_hashes, cookie = message
+        if cookie == self.cookie:
+            return
+
+        with self.lock:
+            matched = [info_hash for info_hash in info_hashes if info_hash in self.info_hashes]
+        if not matched:
+            return
+
+        for info_hash in matched:
+            self.on_peer(info_hash, (addr[0], port))
+        # Chỉ trả lời announce multicast, không trả lời một câu trả lời (tránh lặp vô hạn)
+        if multicast:
+            self.announce(matched, addr)
@@ -0,0 +1,88 @@
+import hashlib
+
+BLOCK_SIZE = 16384      # BEP 52: lá của cây Merkle là SHA-256 của từng block 16 KiB
+HASH_SIZE = 32
+ZERO_HASH = bytes(HASH_SIZE)
+
+"""
+Cây Merkle SHA-256 kiểu BitTorrent v2 (BEP 52): lá là hash của các block 16 KiB,
+lá thiếu được đệm bằng hash 0 cho tới luỹ thừa của 2, mỗi nút cha là SHA-256(trái + phải).
+Mỗi piece có một gốc riêng (piece layer), nên khi piece hỏng chỉ cần lấy hash lá của piece đó
+để biết block nào sai và tải lại riêng các block này.
+"""
+
+# _PAD_HASHES[h] là gốc của cây con toàn lá 0 cao h
+_PAD_HASHES = [ZERO_HASH]
+
+
+def _pad_hash(height):
+    while len(_PAD_HASHES) <= height:
+        _PAD_HASHES.append(hashlib.sha256(_PAD_HASHES[-1] * 2).digest())
+    return _PAD_HASHES[height]
+
+
+def hash_block(block):
+    return hashlib.sha256(block).digest()
+
+
+def block_hashes(data):
+    """Hash lá của `data`: SHA-256 của từng block 16 KiB (block cuối có thể ngắn hơn)."""
+    view = memoryview(data)
+    return [hashlib.sha256(view[i:i + BLOCK_SIZE]).digest() for i in range(0, len(view), BLOCK_SIZE)]
+
+
+def num_blocks(length):
+    return (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+
+def merkle_root(leaves, num_leaves=None):
+    """
+    Gốc của cây có `num_leaves` lá (mặc định: luỹ thừa của 2 nhỏ nhất chứa đủ `leaves`),
+    phần lá còn thiếu là hash 0.
+    """
+    count = max(len(leaves), num_leaves or 1)
+    width = 1
+    while width < count:
+        width *= 2
+
+    layer = list(leaves) or [ZERO_HASH]
+    height = 0
+    while width > 1:
+        if len(layer) % 2:
+            layer.append(_pad_hash(height))
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+        width //= 2
+        height += 1
+    return layer[0]
+
+
+def piece_root(data, piece_length):
+    """Gốc cây con của một piece, dùng trong piece layer (piece cuối được đệm đủ piece_length)."""
+    return merkle_root(block_hashes(data), piece_length // BLOCK_SIZE)
+
+
+def bad_blocks(data, leaves):
+    """Chỉ số các block của `data` không khớp hash lá tương ứng."""
+    return [index for index, digest in enumerate(block_hashes(data))
+            if index >= len(leaves) or digest != leaves[index]]
+
+
+class LeafHasher:
+    """Tính hash lá của một file được đọc theo từng đoạn có độ dài bất kỳ."""
+    def __init__(self):
+        self.buffer = b''
+        self.leaves = []
+
+    def update(self, data):
+        self.buffer += data
+        full = len(self.buffer) - len(self.buffer) % BLOCK_SIZE
+        if full:
+            self.leaves.extend(block_hashes(self.buffer[:full]))
+            self.buffer = self.buffer[full:]
+
+    def root(self):
+        """'pieces root' của file (BEP 52), file rỗng không có root."""
+        leaves = self.leaves + ([hash_block(self.buffer)] if self.buffer else [])
+        if not leaves:
+            return None
+        return merkle_root(leaves)
@@ -1,25 +1,30 @@
 from datetime import datetime
 from info import *
-import bencodepy
+import Bencode
 class MetaInfo:
     def __init__(self, info: Info,
                  announce: str,
                  creation_date: datetime,
                  comment: str,
-                 author: str) -> None:
+                 author: str,
+                 announce_list: list = None) -> None:
 
         self.info = info
         self.announce = announce
         self.creationDate = creation_date
         self.comment = comment
         self.author = author
+        self.announce_list = announce_list
 
     def get_all_info(self) -> dict:
-        return {'info': self.info.get_all_info(),
-                'announce': self.announce,
-                'creationDate': str(self.creationDate),
-                'comment': self.comment,
-                'author': self.author}
+        all_info = {'info': self.info.get_all_info(),
+                    'announce': self.announce,
+                    'creationDate': str(self.creationDate),
+                    'comment': self.comment,
+                    'author': self.author}
+        if self.announce_list:
+            all_info['announce-list'] = self.announce_list
+        return all_info
 
     def get_bencode(self):
         """
@@ -27,7 +32,7 @@ class MetaInfo:
         :return: encoded bencode object
         """
         info_dict = self.get_all_info()
-        encoded = bencodepy.encode(info_dict)
+        encoded = Bencode.encode(info_dict)
         return encoded
 
 
@@ -0,0 +1,129 @@
+import hashlib
+import threading
+import time
+
+import Bencode
+
+UT_METADATA = 'ut_metadata'
+
+METADATA_PIECE_SIZE = 16384       # BEP 9: metadata được chia thành các mảnh 16 KiB
+MAX_METADATA_SIZE = 16 * 1024 * 1024
+METADATA_REQUEST_TIMEOUT = 10     # Mảnh chưa nhận được sau thời gian này thì xin peer khác
+MAX_METADATA_REQUESTS_PER_PEER = 4
+
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+
+"""
+Trao đổi metadata (BEP 9 - ut_metadata) để tải bằng magnet link:
+info dict được xin từ các peer theo từng mảnh 16 KiB, song song trên nhiều kết nối,
+ghép lại và kiểm tra SHA-1 với info_hash trước khi dùng.
+"""
+
+
+def encode_metadata_message(msg_type, piece, data=b'', total_size=None):
+    message = {b'msg_type': msg_type, b'piece': piece}
+    if total_size is not None:
+        message[b'total_size'] = total_size
+    return Bencode.encode(message) + data
+
+
+def decode_metadata_message(payload):
+    """Trả về (dict header, dữ liệu thô phía sau header)."""
+    header, end = Bencode.decode_prefix(payload)
+    return header, payload[end:]
+
+
+class MetadataExchange:
+    def __init__(self, info_hash, metadata=None):
+        self.info_hash = info_hash
+        self.lock = threading.Lock()
+
+        # Info dict đã bencode (đã có nếu tải bằng .torrent hoặc đang seed)
+        self.metadata = metadata
+        self.size = len(metadata) if metadata else None
+        self.received = {}   # mảnh -> dữ liệu
+        self.requested = {}  # mảnh -> (peer_id, thời điểm gửi request)
+
+    def has_metadata(self):
+        return self.metadata is not None
+
+    def get_size(self):
+        return self.size
+
+    def num_pieces(self):
+        return (self.size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE if self.size else 0
+
+    def set_size(self, size):
+        """Nhận metadata_size từ extended handshake của peer, trả về False nếu không hợp lệ."""
+        with self.lock:
+            if self.metadata is not None or not isinstance(size, int):
+                return False
+            if size <= 0 or size > MAX_METADATA_SIZE:
+                return False
+            if self.size is None:
+                self.size = size
+            return self.size == size
+
+    def next_requests(self, peer_id):
+        """
+        Các mảnh cần xin từ peer này: mỗi mảnh chỉ được xin ở một peer tại một thời điểm,
+        nên nhiều peer cùng gửi các mảnh khác nhau song song.
+        """
+        with self.lock:
+            if self.metadata is not None or not self.size:
+                return []
+            now = time.monotonic()
+            outstanding = sum(1 for owner, _ in self.requested.values() if owner == peer_id)
+            pieces = []
+            for piece in range(self.num_pieces()):
+                if outstanding + len(pieces) >= MAX_METADATA_REQUESTS_PER_PEER:
+                    break
+                if piece in self.received:
+                    continue
+                request = self.requested.get(piece)
+                if request and now - request[1] < METADATA_REQUEST_TIMEOUT:
+                    continue
+                self.requested[piece] = (peer_id, now)
+                pieces.append(piece)
+            return pieces
+
+    def release(self, peer_id, piece=None):
+        """Peer từ chối hoặc ngắt kết nối: trả các mảnh đã giao cho nó để peer khác xin."""
+        with self.lock:
+            for index, (owner, _) in list(self.requested.items()):
+                if owner == peer_id and (piece is None or piece == index):
+                    del self.requested[index]
+
+    def add_piece(self, piece, data):
+        """
+        Lưu một mảnh metadata. Khi đủ mảnh thì ghép lại và kiểm tra SHA-1:
+        trả về metadata nếu khớp info_hash, sai thì bỏ hết và xin lại từ đầu.
+        """
+        with self.lock:
+            if self.metadata is not None or not self.size or not 0 <= piece < self.num_pieces():
+                return None
+            expected = min(METADATA_PIECE_SIZE, self.size - piece * METADATA_PIECE_SIZE)
+            if len(data) != expected:
+                return None
+            self.received[piece] = bytes(data)
+            self.requested.pop(piece, None)
+            if len(self.received) < self.num_pieces():
+                return None
+
+            metadata = b''.join(self.received[i] for i in range(self.num_pieces()))
+            self.received = {}
+            self.requested = {}
+            if hashlib.sha1(metadata).digest() != self.info_hash:
+                # Có peer gửi dữ liệu sai: bỏ hết và xin lại từ đầu
+                print("Metadata does not match info_hash, discarding")
+                return None
+            self.metadata = metadata
+            return metadata
+
+    def get_piece(self, piece):
+        """Mảnh metadata để trả lời request của peer khác, None nếu chưa có."""
+        if self.metadata is None or not 0 <= piece < self.num_pieces():
+            return None
+        return self.metadata[piece * METADATA_PIECE_SIZE:(piece + 1) * METADATA_PIECE_SIZE]
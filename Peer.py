@@ -5,29 +5,60 @@ import socket
 from threading import Thread
 import random
 import string
-import json
 
 
 
+import MerkleTree
 from PeerHandler import PeerHandler
 from FileManager import FileManager, Piece
+from PiecePicker import PiecePicker, STREAMING_WINDOW
 
 from PeerServer import PeerServer
+from DiskIO import DiskIOPool, JobType
+from MetadataExchange import MetadataExchange, UT_METADATA
+from PeerExchange import PeerExchange, UT_PEX, PEX_INTERVAL
+
 EVENT_STATE = ['STARTED', 'STOPPED', 'COMPLETED']
+DEFAULT_ANNOUNCE_INTERVAL = 120
+CONNECT_TIMEOUT = 5            # Ứng viên từ PEX có thể đã rời swarm, không chờ connect quá lâu
+MAX_PEER_CONNECTIONS = 50      # Giới hạn kết nối khi chạy không có Session
+STORAGE_CHECK_INTERVAL = 5     # Chu kỳ kiểm tra file gốc của torrent đang share
 
 class Peer:
-    def __init__(self, peer_ip, peer_port, info, file_manager):
+    def __init__(self, peer_ip, peer_port, torrent, file_manager, session=None):
         self.peer_id = self.generate_peer_id()
 
+        # Session dùng chung cổng lắng nghe, giới hạn tốc độ và số kết nối giữa các torrent
+        self.session = session
+        if session:
+            peer_ip, peer_port = session.ip, session.port
+
         self.peer_ip = peer_ip
         self.peer_port = peer_port
 
-        self.info_hash = info['info_hash']
-        self.total_length = info['length']
-        self.name = info['name']
-        self.trackers = info['trackers']
-
-        self.peer_server = PeerServer(self.peer_id, peer_ip, peer_port, self.info_hash)
+        self.torrent = torrent
+        self.info_hash = torrent.info_hash
+        self.total_length = torrent.length
+        self.name = torrent.name
+        self.trackers = torrent.trackers
+
+        # Info dict đã bencode: có sẵn nếu có .torrent, tải bằng magnet thì xin từ peer (BEP 9)
+        self.metadata = MetadataExchange(self.info_hash, torrent.info_bytes)
+
+        self.peer_server = PeerServer(self.peer_id, peer_ip, peer_port, self.info_hash, torrent.tiers)
+        # Tier trả lời chậm hơn tier đầu tiên vẫn đóng góp peer
+        self.peer_server.on_response = self.handle_announce_response
+
+        # Pool ứng viên kết nối chung cho peer từ tracker và từ PEX (BEP 11)
+        self.pex = PeerExchange()
+        self.pex_thread = None
+        self.connecting_lock = threading.Lock()
+        # IP của các peer tìm thấy qua local discovery: kết nối trước và không bị giới hạn tốc độ
+        self.local_peer_ips = set()
+        # peer_id -> địa chỉ kết nối: một peer có thể tìm thấy qua nhiều địa chỉ (tracker, PEX, LAN)
+        self.connected_ids = {}
+        # Kết nối đã hết piece để xin (pick() trả về None), được giao lại việc khi có piece quay về picker
+        self.idle_peers = set()
 
         self.is_running = False
         self.peer_handlers: dict[(str, int), PeerHandler] = {}
@@ -35,62 +66,250 @@ class Peer:
         self.peer_server_thread = None
         self.file_manager = file_manager
 
-        self.bitfields = {}  # Lưu trữ bitfield từ mỗi peer (peer_id -> bitfield)
-        self.piece_frequencies = {}  # Đếm tần suất xuất hiện của mỗi piece
-        self.lock = threading.Lock()
+        # Mỗi phần trạng thái dùng chung có lock riêng:
+        # piece picker (picker.lock), kho piece (file_manager.lock), danh sách kết nối (connections_lock)
+        self.picker = PiecePicker(file_manager)
+        # Piece hỏng đang được sửa theo block (torrent có piece layer): index -> {'data', 'peer', 'leaves', 'missing'}
+        self.partial_pieces = {}
+        self.partial_lock = threading.Lock()
+        self.connections_lock = threading.Lock()
+        self.complete_lock = threading.Lock()
+
+        # Công việc đĩa (hash, đọc piece, export) chạy trên pool riêng, không chạy trên thread mạng
+        self.disk_io = session.disk_io if session else DiskIOPool(num_workers=2)
+        self.completed = False
+        self.complete_thread = None
+        self.recheck_data = False
+        # Lỗi làm torrent không tải tiếp được (ví dụ độ ưu tiên cho file không có trong metadata)
+        self.error = None
 
         self.scrape_response = ""
+
+        # Announce định kỳ theo interval mà tracker trả về
+        self.announce_interval = DEFAULT_ANNOUNCE_INTERVAL
+        self.announce_thread = None
+        self.stop_event = threading.Event()
+
+        # Share từ file gốc: file bị sửa thì tạm dừng seed (choke mọi peer) tới khi file trở lại như cũ
+        self.seeding_paused = False
+        self.storage_thread = None
+
     def generate_peer_id(self):
         client_id = "PY"  # Two characters for client id (e.g., PY for Python)
         version = "0001"  # Four ascii digits for version number
         random_chars = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
         return f"-{client_id}{version}-{random_chars}"
 
-    def download(self):
+    def download(self, recheck=False):
         """
         Hàm sẽ tạo một thread cho việc lắng nghe yêu cầu từ các peer qua hàm start_server
         Sau đó nhận peer list từ Tracker Server
         Với mỗi peer sẽ tạo một thread chạy PeerHandler để communicate
+        :param recheck: kiểm tra dữ liệu đã có trong thư mục lưu trước, chỉ tải phần còn thiếu hoặc sai
         :return: void
         """
+        self.recheck_data = recheck
+        if recheck:
+            self.recheck()
+        # Piece đã có sẵn trong session (torrent khác, file giống hệt trên đĩa) không cần tải
+        self.reuse_content()
         # Tạo server để lắng nghe và phản hồi yêu cầu từ các peer khác
         self.start_server()
         # Gửi request và nhận về peer list từ tracker server
-        response = self.peer_server.announce_request("STARTED")
-        response = json.loads(response)
+        self.peer_server.left = self.get_bytes_left()
+        self.announce("STARTED")
+        self.start_announce_loop()
+        self.start_pex_loop()
+
+    def get_bytes_left(self):
+        # Chưa có metadata thì chưa biết còn thiếu bao nhiêu, nhưng chắc chắn chưa phải seeder
+        if not self.file_manager.has_metadata():
+            return self.total_length or 1
+        return self.file_manager.get_bytes_left()
+
+    def announce(self, event, connect=True):
+        """Announce và xử lý response, tracker lỗi thì chờ lần announce định kỳ tiếp theo."""
+        try:
+            response = self.peer_server.announce_request(event)
+        except (OSError, ValueError) as e:
+            print(f"Announce {event or 'update'} failed: {e}")
+            return
+        self.handle_announce_response(response, connect)
+
+    def handle_announce_response(self, response, connect=True):
         print(response)
+        if 'failure reason' in response:
+            return
 
-        peers = response['peers']
+        self.announce_interval = int(response.get('interval', self.announce_interval))
 
-        # Tạo PeerHandler để communicate với các peer khác
-        for peer in peers:
+        peers = [(peer["ip"], int(peer["port"])) for peer in response['peers']]
+        self.pex.add_candidates(peer for peer in peers if not self.is_self(*peer))
+        if not connect:
+            return
 
-            ip = peer["ip"]
-            port = int(peer["port"])
-
-            if ip == self.peer_ip and port == self.peer_port:
+        # Tạo PeerHandler để communicate với các peer khác
+        self.connect_candidates()
+
+    def start_announce_loop(self):
+        self.announce_thread = Thread(target=self.announce_loop, daemon=True)
+        self.announce_thread.start()
+
+    def announce_loop(self):
+        """Announce lại theo interval của tracker, nếu không tracker sẽ coi peer là đã chết."""
+        while not self.stop_event.wait(self.announce_interval):
+            self.peer_server.left = self.get_bytes_left()
+            self.announce("", connect=self.peer_server.left > 0)
+
+    def start_pex_loop(self):
+        self.pex_thread = Thread(target=self.pex_loop, daemon=True)
+        self.pex_thread.start()
+
+    def pex_loop(self):
+        """Mỗi PEX_INTERVAL gửi danh sách peer thay đổi cho các kết nối, rồi thử thêm ứng viên mới."""
+        while not self.stop_event.wait(PEX_INTERVAL):
+            self.send_pex()
+            self.connect_candidates()
+
+    def send_pex(self):
+        with self.connections_lock:
+            handlers = list(self.peer_handlers.values())
+        connected = [handler.listen_addr for handler in handlers if handler.listen_addr]
+
+        for handler in handlers:
+            if UT_PEX not in handler.extensions:
                 continue
-
-            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            message = self.pex.make_message(handler.client_id,
+                                            [addr for addr in connected if addr != handler.listen_addr])
+            if message:
+                handler.send_pex(*message)
+
+    def is_self(self, ip, port):
+        return port == self.peer_port and ip in (self.peer_ip, '127.0.0.1', '0.0.0.0')
+
+    def connect_candidates(self):
+        """Kết nối tới các ứng viên trong pool cho tới khi hết pool hoặc hết ngân sách kết nối."""
+        # Chỉ một thread lấy ứng viên tại một thời điểm, thread khác chỉ cần thêm vào pool
+        if not self.connecting_lock.acquire(blocking=False):
+            return
+        try:
+            while self.wants_peers():
+                with self.connections_lock:
+                    connected = {handler.listen_addr for handler in self.peer_handlers.values()}
+                    connected.update(self.peer_handlers)
+                    full = not self.session and len(self.peer_handlers) >= MAX_PEER_CONNECTIONS
+                if full:
+                    return
+
+                peer = self.pex.pop_candidate()
+                if peer is None:
+                    return
+                if peer in connected or self.is_self(*peer):
+                    continue
+                if self.connect_to_peer(*peer) is None:
+                    # Hết ngân sách: giữ lại ứng viên để thử khi có kết nối được giải phóng
+                    self.pex.add_candidates([peer])
+                    return
+        finally:
+            self.connecting_lock.release()
+
+    def add_local_peer(self, addr):
+        """Peer trong LAN (Session.local_discovery) được đưa lên đầu pool ứng viên."""
+        if self.is_self(*addr):
+            return
+        print(f"Found local peer {addr[0]}:{addr[1]}")
+        self.local_peer_ips.add(addr[0])
+        self.pex.add_candidates([addr], preferred=True)
+        self.connect_candidates_async()
+
+    def wants_peers(self):
+        # Seeder không chủ động kết nối, chỉ chờ leecher kết nối đến
+        return not self.completed and not self.stop_event.is_set() and self.get_bytes_left() > 0
+
+    def connect_candidates_async(self):
+        if self.pex.has_candidates() and self.wants_peers():
+            Thread(target=self.connect_candidates, daemon=True).start()
+
+    def connect_to_peer(self, ip, port):
+        """Trả về True nếu đã kết nối, False nếu kết nối lỗi, None nếu hết ngân sách kết nối."""
+        if self.session and not self.session.acquire_connection(self.info_hash):
+            print(f"Connection budget exhausted, skipping {ip}:{port}")
+            return None
+
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(CONNECT_TIMEOUT)
+        try:
             conn.connect((ip, port))
-            peer_handler = PeerHandler(conn, (ip, port), self.info_hash, self.peer_id, self.callback)
-            thread = Thread(target=peer_handler.run)
-
-            with self.lock:
-                self.peer_handlers.update({(ip, port): peer_handler})
-                self.threads.update({(ip, port): thread})
-
-                thread.start()
+        except OSError as e:
+            print(f"Failed to connect to {ip}:{port}: {e}")
+            conn.close()
+            if self.session:
+                self.session.release_connection(self.info_hash)
+            return False
+        conn.settimeout(None)
+        self.add_peer_handler(conn, (ip, port), listen_addr=(ip, port))
+        return True
+
+    def accept_connection(self, conn, addr, handshake=None):
+        """Nhận một kết nối đến, handshake có thể đã được Session đọc sẵn."""
+        self.add_peer_handler(conn, addr, handshake)
+
+    def add_peer_handler(self, conn, addr, handshake=None, listen_addr=None):
+        ip, port = addr
+        upload_limiter = self.session.upload_limiter if self.session else None
+        download_limiter = self.session.download_limiter if self.session else None
+        if ip in self.local_peer_ips:
+            # Băng thông trong LAN không cần giới hạn như kết nối ra ngoài
+            upload_limiter = download_limiter = None
+        peer_handler = PeerHandler(conn, addr, self.info_hash, self.peer_id, self.callback, handshake,
+                                   upload_limiter, download_limiter, listen_addr)
+        thread = Thread(target=peer_handler.run)
+
+        with self.connections_lock:
+            self.peer_handlers.update({(ip, port): peer_handler})
+            self.threads.update({(ip, port): thread})
+
+        thread.start()
 
 
     def upload(self):
 
         self.start_server()
-        respond = self.peer_server.announce_request("STARTED")
-        print(respond)
+        self.announce("STARTED", connect=False)
+        self.start_announce_loop()
+        self.start_pex_loop()
+        self.start_storage_monitor()
+
+    def start_storage_monitor(self):
+        if self.file_manager.storage is None or self.storage_thread is not None:
+            return
+        self.storage_thread = Thread(target=self.storage_monitor, daemon=True)
+        self.storage_thread.start()
+
+    def storage_monitor(self):
+        """Phát hiện file gốc thay đổi kể cả khi không có peer nào đang xin dữ liệu."""
+        while not self.stop_event.wait(STORAGE_CHECK_INTERVAL):
+            available = self.file_manager.check_storage()
+            if available != (not self.seeding_paused):
+                self.seeding_paused = not available
+                print(f"Seeding {'resumed' if available else 'paused: source files changed'} for {self.name}")
+
+            # Kiểm tra mọi kết nối ở mỗi lượt: peer có thể bị choke khi đọc piece thất bại
+            # mà file đã trở lại trước khi lượt kiểm tra này thấy nó thay đổi
+            with self.connections_lock:
+                handlers = list(self.peer_handlers.values())
+            for handler in handlers:
+                if not available and not handler.am_choking:
+                    handler.send_choke()
+                elif available and handler.am_choking and handler.peer_interested:
+                    handler.send_unchoke()
 
     def scrape_tracker(self):
-        response = self.peer_server.scrape_request()
+        try:
+            response = self.peer_server.scrape_request()
+        except (OSError, ValueError) as e:
+            print(f"Scrape failed: {e}")
+            return
         print("Scrape tracker: ", response)
         self.scrape_response = response
 
@@ -102,99 +321,420 @@ class Peer:
 
     def stop(self):
         self.is_running = False
+        self.stop_event.set()
+
+        self.announce("STOPPED", connect=False)
+        self.peer_server.close()
 
-        self.peer_server.announce_request("STOPPED")
+        with self.connections_lock:
+            handlers, self.peer_handlers = self.peer_handlers, {}
+            threads, self.threads = self.threads, {}
 
-        for (ip, port) in list(self.peer_handlers.keys()):
-            self.peer_handlers[(ip, port)].stop()
-            self.peer_handlers.pop((ip, port))
+        for handler in handlers.values():
+            handler.stop()
 
-        for (ip, port) in list(self.threads.keys()):
-            self.threads[(ip, port)].join()
-            self.threads.pop((ip, port))
+        for thread in threads.values():
+            if thread != threading.current_thread():
+                thread.join()
 
         if self.peer_server_thread:
             self.peer_server_thread.join()
+        if self.storage_thread:
+            self.storage_thread.join()
+        # Export đang chạy phải xong trước khi đóng file và dừng pool đĩa
+        if self.complete_thread and self.complete_thread != threading.current_thread():
+            self.complete_thread.join()
+        self.file_manager.close()
+
+        if self.session:
+            self.session.remove_torrent(self.info_hash)
+        else:
+            self.disk_io.stop()
 
     def stop_peer_handler(self, addr):
         """Stop and clean up a peer handler and its thread"""
         addr_key = (addr[0], addr[1])
 
-        with self.lock:
+        with self.connections_lock:
             # Only proceed if the peer handler exists
             if addr_key not in self.peer_handlers:
                 return
 
             print(f"Stopping connection to {addr}")
 
-            # Get the handler and thread
-            handler = self.peer_handlers[addr_key]
-            thread = self.threads.get(addr_key)
-
-            # Stop the handler first
-            handler.stop()
-
             # Remove from dictionaries
-            self.peer_handlers.pop(addr_key)
-
-            # If there's a thread and it's not the current thread
-            if thread and thread != threading.current_thread():
-                self.threads.pop(addr_key)
-                thread.join(timeout=5)
+            handler = self.peer_handlers.pop(addr_key)
+            thread = self.threads.pop(addr_key, None)
+
+        # Stop the handler outside the registry lock so other connections are not blocked
+        handler.stop()
+        with self.connections_lock:
+            # Kết nối trùng bị từ chối không được xoá trạng thái của kết nối đang dùng peer_id đó
+            owner = self.connected_ids.get(handler.client_id) == addr_key
+            if owner:
+                del self.connected_ids[handler.client_id]
+        if owner:
+            self.picker.remove_peer(handler.client_id)
+            self.pex.remove(handler.client_id)
+            self.abandon_partial_pieces(handler.client_id)
+        if not self.metadata.has_metadata():
+            # Mảnh metadata đã xin ở peer này được chuyển cho peer khác
+            self.metadata.release(handler.client_id)
+            self.request_metadata_from_peers()
+        if self.session:
+            self.session.release_connection(self.info_hash)
+        # Thay kết nối vừa mất bằng ứng viên trong pool
+        self.connect_candidates_async()
+
+        # If there's a thread and it's not the current thread
+        if thread and thread != threading.current_thread():
+            thread.join(timeout=5)
 
 
     def callback(self, peer_id, event_type, data=None)->dict:
         """
         Callback function để xử lý các sự kiện từ PeerHandler
         """
-        if event_type == 'bitfield_received':
+        if event_type == 'handshake':
+            # Chỉ giữ một kết nối cho mỗi peer_id
+            with self.connections_lock:
+                if peer_id in self.connected_ids:
+                    print(f"Already connected to {peer_id}, closing {data['addr']}")
+                    return {'accept': False}
+                self.connected_ids[peer_id] = tuple(data['addr'])
+            return {'accept': True}
+
+        elif event_type == 'bitfield_received':
             bitfield = bytes(data['bitfield'])
-            with self.lock:
-                # Lưu lại bitfield nhận được từ PeerHandler
-                self.bitfields[peer_id] = bitfield
-                self.update_piece_frequencies(bitfield)
-                interested = self.file_manager.is_interested(bitfield)
-                return {'interested' : interested}
+            # Lưu lại bitfield nhận được từ PeerHandler
+            self.picker.add_bitfield(peer_id, bitfield)
+            interested = self.file_manager.is_interested(bitfield)
+            return {'interested' : interested}
+
+        elif event_type == 'have_received':
+            self.picker.add_have(peer_id, int(data['index']))
 
         elif event_type == 'request_bitfield':
             return  {'bitfield' : self.file_manager.get_bitfield()}
 
         elif event_type == 'request_piece_index':
-            index = self.get_rarest_piece()
+            # Back-pressure: không xin thêm dữ liệu khi hàng đợi đĩa đang đầy
+            if self.disk_io.is_congested():
+                self.disk_io.wait_for_capacity()
+            index = self.picker.pick()
             print("Piece index: ", index)
+            with self.connections_lock:
+                if index is None:
+                    self.idle_peers.add(peer_id)
+                    return {'index': None}
+                self.idle_peers.discard(peer_id)
             length = self.file_manager.get_exact_piece_length(index)
 
             return {'index': index, 'begin': 0, 'length': length}
 
         elif event_type == 'request_piece':
             index = int(data['index'])
-            return self.file_manager.get_piece(index)
+            handler = self.get_handler(peer_id)
+            if handler is None:
+                return
+            begin, length = int(data['begin']), int(data['length'])
+            # Piece đang share được đọc từ file gốc trên pool đĩa, block được gửi khi đọc xong
+            self.disk_io.submit(JobType.READ, self.file_manager.read_piece, index,
+                                callback=lambda piece, error: handler.send_block(index, begin, length, piece))
 
         elif event_type == 'piece_received':
             index = int(data['index'])
             begin = int(data['begin'])
             data = data['block']
-            hash_value = hashlib.sha256(data).hexdigest()
-            piece = Piece(index, data, hash_value)
+            if index in self.partial_pieces:
+                self.repair_block(peer_id, index, begin, data)
+                return self.file_manager.check_complete()
+            if begin != 0 or not self.picker.begin_verify(index):
+                return self.file_manager.check_complete()
+
+            # Hash trên pool đĩa, kết quả xử lý trong on_piece_verified
+            self.disk_io.submit(JobType.HASH, self.file_manager.verify_piece, index, data,
+                                callback=lambda ok, error: self.on_piece_verified(index, data, ok, peer_id))
+            return self.file_manager.check_complete()
+        elif event_type == 'stop':
+            addr = data['addr']
+            self.stop_peer_handler(addr)
+
+        elif event_type == 'request_extended_handshake':
+            # 'p': cổng lắng nghe, để peer nhận kết nối đến vẫn quảng bá được mình qua PEX
+            extra = {'p': self.peer_port}
+            if self.metadata.has_metadata():
+                extra['metadata_size'] = self.metadata.get_size()
+            return extra
+
+        elif event_type == 'extended_handshake':
+            handshake = data['handshake']
+            if self.metadata.has_metadata() or UT_METADATA.encode() not in handshake.get(b'm', {}):
+                return {}
+            if not self.metadata.set_size(handshake.get(b'metadata_size')):
+                return {}
+            return {'metadata_pieces': self.metadata.next_requests(peer_id)}
+
+        elif event_type == 'metadata_request':
+            return {'data': self.metadata.get_piece(data['piece']), 'total_size': self.metadata.get_size()}
+
+        elif event_type == 'metadata_received':
+            metadata = self.metadata.add_piece(data['piece'], data['data'])
+            if metadata is not None:
+                self.on_metadata(metadata)
+                return {}
+            return {'metadata_pieces': self.metadata.next_requests(peer_id)}
+
+        elif event_type == 'metadata_rejected':
+            self.metadata.release(peer_id, data['piece'])
+            self.request_metadata_from_peers(exclude=peer_id)
+
+        elif event_type == 'hash_request':
+            index = int(data['index'])
+            handler = self.get_handler(peer_id)
+            if handler is None:
+                return
+            header = data['header']
+            layer = self.torrent.piece_layer
+            if layer is None or index >= len(layer) or data['root'] != layer[index] \
+                    or not self.file_manager.has_piece(index):
+                handler.send_hashes(header, None)
+                return
+            self.disk_io.submit(JobType.READ, self.read_block_hashes, index,
+                                callback=lambda hashes, error: handler.send_hashes(header, hashes))
 
-            self.file_manager.add_piece(piece)
+        elif event_type == 'hashes_received':
+            return {'requests': self.on_block_hashes(peer_id, int(data['index']), data['hashes'])}
 
-            is_complete = self.file_manager.check_complete()
+        elif event_type == 'hashes_rejected':
+            self.abandon_partial_piece(int(data['index']), peer_id)
 
-            if is_complete:
-                self.file_manager.export()
+        elif event_type == 'pex_received':
+            self.pex.discard_candidates(data['dropped'])
+            self.pex.add_candidates(peer for peer in data['added'] if not self.is_self(*peer))
+            # Không kết nối trên thread của PeerHandler để không chặn việc đọc message
+            self.connect_candidates_async()
 
-                self.peer_server.announce_request("COMPLETED")
-            return is_complete
-        elif event_type == 'stop':
-            addr = data['addr']
-            self.stop_peer_handler(addr)
 
+    def request_metadata_from_peers(self, exclude=None):
+        """Chia các mảnh metadata còn thiếu cho những peer hỗ trợ ut_metadata."""
+        with self.connections_lock:
+            handlers = list(self.peer_handlers.values())
+        for handler in handlers:
+            if handler.client_id == exclude or UT_METADATA not in handler.extensions:
+                continue
+            handler.request_metadata(self.metadata.next_requests(handler.client_id))
+
+    def on_metadata(self, metadata):
+        """Đã nhận đủ info dict (đã kiểm tra với info_hash): bắt đầu tải dữ liệu."""
+        print(f"Received metadata for {self.info_hash.hex()} ({len(metadata)} bytes)")
+        self.torrent.set_info(metadata)
+        try:
+            self.file_manager.load_info(self.torrent)
+        except KeyError as e:
+            # Không tải file người dùng không chọn: dừng ở đây, báo lỗi qua get_transfer_information
+            self.error = e.args[0]
+            print(f"Cannot start {self.torrent.name}: {self.error}")
+            return
+        self.total_length = self.torrent.length
+        self.name = self.torrent.name
+        # Recheck và đọc lại dữ liệu đã có chạy trên thread riêng, không chặn thread của PeerHandler
+        Thread(target=self.prepare_download, daemon=True).start()
+
+    def prepare_download(self):
+        """Đánh dấu các piece đã có (trong thư mục lưu hoặc trong session) rồi báo interested."""
+        if self.recheck_data:
+            self.recheck()
+        self.reuse_content()
+        self.peer_server.left = self.get_bytes_left()
+
+        # Bitfield nhận trước khi có metadata chưa được tính, tính lại và báo interested
+        self.picker.rebuild()
+        with self.connections_lock:
+            handlers = list(self.peer_handlers.values())
+        for handler in handlers:
+            bitfield = self.picker.get_bitfield(handler.client_id)
+            if bitfield and self.file_manager.is_interested(bitfield):
+                handler.send_interested()
+
+    def on_piece_verified(self, index, data, ok, peer_id=None):
+        """Chạy trên thread của DiskIOPool sau khi hash xong một piece."""
+        if not ok:
+            if self.request_block_hashes(index, data, peer_id):
+                return
+            print(f"Piece {index} failed hash check, discarding")
+            self.picker.end_verify(index)
+            self.request_from_idle_peers()
+            return
+        self.store_piece(index, data)
+
+    def get_handler(self, peer_id):
+        with self.connections_lock:
+            return self.peer_handlers.get(self.connected_ids.get(peer_id))
+
+    def read_block_hashes(self, index):
+        """Hash lá (block 16 KiB) của piece `index`, None nếu không đọc được piece."""
+        piece = self.file_manager.read_piece(index)
+        if piece is None:
+            return None
+        return MerkleTree.block_hashes(piece)
+
+    def request_from_idle_peers(self):
+        """
+        Piece hỏng được trả về picker sau khi các kết nối đã xin piece tiếp theo: kết nối nào đã hết việc
+        thì xin lại, nếu không piece cuối cùng sẽ không bao giờ được tải.
+        """
+        with self.connections_lock:
+            handlers = [self.peer_handlers.get(self.connected_ids.get(peer_id)) for peer_id in self.idle_peers]
+            self.idle_peers.clear()
+        for handler in handlers:
+            if handler is None or handler.peer_choking or not handler.am_interested:
+                continue
+            # Không dùng callback 'request_piece_index': có thể đang chạy trên thread của pool đĩa
+            index = self.picker.pick()
+            if index is None:
+                with self.connections_lock:
+                    self.idle_peers.add(handler.client_id)
+                continue
+            handler.send_request(index, 0, self.file_manager.get_exact_piece_length(index))
+
+    def request_block_hashes(self, index, data, peer_id):
+        """
+        Torrent có piece layer: thay vì bỏ cả piece hỏng, xin hash lá của piece từ peer đã gửi nó để tìm
+        và tải lại riêng các block sai. Piece vẫn nằm trong picker.verifying trong lúc sửa.
+        """
+        layer = self.torrent.piece_layer
+        if layer is None or peer_id is None:
+            return False
+        handler = self.get_handler(peer_id)
+        if handler is None or not handler.supports_hashes:
+            return False
+
+        length = self.file_manager.get_exact_piece_length(index)
+        buffer = bytearray(data[:length])
+        buffer.extend(bytes(length - len(buffer)))
+        with self.partial_lock:
+            self.partial_pieces[index] = {'data': buffer, 'peer': peer_id, 'leaves': None, 'missing': set()}
+        print(f"Piece {index} failed hash check, looking for bad blocks")
+        handler.send_hash_request(layer[index], index, MerkleTree.num_blocks(length))
+        return True
+
+    def on_block_hashes(self, peer_id, index, leaves):
+        """Nhận hash lá của piece đang sửa, trả về các (index, begin, length) cần tải lại."""
+        with self.partial_lock:
+            partial = self.partial_pieces.get(index)
+            if partial is None or partial['peer'] != peer_id or partial['leaves'] is not None:
+                return []
+            bad = self.file_manager.find_bad_blocks(index, partial['data'], leaves)
+            if bad:
+                partial['leaves'] = leaves
+                partial['missing'] = set(bad)
+        if not bad:
+            print(f"Peer {peer_id} sent invalid block hashes for piece {index}")
+            self.abandon_partial_piece(index, peer_id)
+            return []
+
+        print(f"Piece {index}: re-downloading {len(bad)} bad block(s)")
+        length = len(partial['data'])
+        return [(index, block * MerkleTree.BLOCK_SIZE,
+                 min(MerkleTree.BLOCK_SIZE, length - block * MerkleTree.BLOCK_SIZE)) for block in bad]
+
+    def repair_block(self, peer_id, index, begin, block):
+        """Ghép một block tải lại vào piece đang sửa, đủ block thì lưu piece."""
+        block_index = begin // MerkleTree.BLOCK_SIZE
+        with self.partial_lock:
+            partial = self.partial_pieces.get(index)
+            if partial is None or partial['peer'] != peer_id or begin % MerkleTree.BLOCK_SIZE \
+                    or block_index not in partial['missing']:
+                return
+            if MerkleTree.hash_block(block) != partial['leaves'][block_index]:
+                bad = True
+            else:
+                bad = False
+                partial['data'][begin:begin + len(block)] = block
+                partial['missing'].discard(block_index)
+                if partial['missing']:
+                    return
+                del self.partial_pieces[index]
+        if bad:
+            print(f"Block {block_index} of piece {index} is still bad, discarding piece")
+            self.abandon_partial_piece(index, peer_id)
+            return
+
+        # Mọi block đã khớp hash lá, và hash lá khớp piece layer
+        print(f"Piece {index} repaired")
+        self.store_piece(index, bytes(partial['data']))
+
+    def abandon_partial_piece(self, index, peer_id):
+        with self.partial_lock:
+            partial = self.partial_pieces.get(index)
+            if partial is None or partial['peer'] != peer_id:
+                return
+            del self.partial_pieces[index]
+        self.picker.end_verify(index)
+        self.request_from_idle_peers()
+
+    def abandon_partial_pieces(self, peer_id):
+        """Peer ngắt kết nối giữa chừng: trả các piece đang sửa dở về cho picker."""
+        with self.partial_lock:
+            indexes = [index for index, partial in self.partial_pieces.items() if partial['peer'] == peer_id]
+        for index in indexes:
+            self.abandon_partial_piece(index, peer_id)
+
+    def store_piece(self, index, data):
+        piece = Piece(index, data, hashlib.sha1(data).digest())
+        self.file_manager.add_piece(piece)
+        self.picker.end_verify(index)
+        self.check_completed()
+
+    def recheck(self):
+        """Kiểm tra song song các piece đã có ở thư mục lưu, piece đúng không cần tải lại."""
+        if not self.file_manager.has_metadata():
+            return
+        valid = self.file_manager.recheck(self.disk_io)
+        print(f"Recheck: {valid}/{self.file_manager.get_total_pieces()} piece(s) already on disk")
+        # Piece đúng sẵn được đọc từ thư mục lưu: theo dõi các file đó như khi share
+        self.start_storage_monitor()
+        self.check_completed()
+
+    def reuse_content(self):
+        if not self.file_manager.has_metadata():
+            return
+        reused = self.file_manager.reuse_content()
+        if reused:
+            print(f"Reused {reused} piece(s) already present in this session")
+            self.check_completed()
+
+    def check_completed(self):
+        # Chỉ một thread được export. Hàm này có thể chạy trong callback của pool đĩa:
+        # không submit chặn vào hàng đợi mà chính các worker phải xả, không announce trên worker
+        with self.complete_lock:
+            if self.completed or not self.file_manager.check_complete():
+                return
+            self.completed = True
+
+        self.complete_thread = Thread(target=self.on_complete, daemon=True)
+        self.complete_thread.start()
+
+    def on_complete(self):
+        """Thread riêng của peer: export trên pool đĩa, rồi báo tracker khi export xong."""
+        try:
+            self.disk_io.submit(JobType.FLUSH, self.file_manager.export).wait()
+        except Exception as e:
+            print(f"Export failed for {self.name}: {e}")
+            return
+        self.peer_server.left = 0
+        if not self.stop_event.is_set():
+            self.announce("COMPLETED", connect=False)
 
     def start_server(self):
         """Khởi chạy server để lắng nghe các yêu cầu từ peer khác."""
         if not self.is_running:
             self.is_running = True
+            if self.session:
+                # Session đã có cổng lắng nghe chung, chỉ cần đăng ký info_hash
+                self.session.add_torrent(self)
+                return
             self.peer_server_thread = threading.Thread(target=self.listen)
             self.peer_server_thread.start()
 
@@ -207,14 +747,7 @@ class Peer:
         while self.is_running:
             try:
                 conn, addr = server_socket.accept()
-                ip, port = addr
-                peer_handler = PeerHandler(conn, addr, self.info_hash, self.peer_id, self.callback)
-                thread = threading.Thread(target=peer_handler.run)
-                with self.lock:
-                    self.peer_handlers[(ip, port)] = peer_handler
-                    self.threads[(ip, port)] = thread
-
-                    thread.start()
+                self.accept_connection(conn, addr)
 
             except socket.timeout:
                 continue  # Kiểm tra lại `is_running` mỗi khi hết timeout
@@ -222,35 +755,21 @@ class Peer:
         server_socket.close()
 
 
-    def update_piece_frequencies(self, bitfield):
-        """
-        Cập nhật tần suất xuất hiện của mỗi piece dựa trên bitfield nhận được
-        """
-
-        for piece_index in range(self.file_manager.get_total_pieces()):
-            byte_index = piece_index // 8
-            bit_index = piece_index % 8
-
-            # Check if the bit is set (indicating the piece is available)
-            if bitfield[byte_index] & (1 << (7 - bit_index)):
-                if piece_index not in self.piece_frequencies:
-                    self.piece_frequencies[piece_index] = 0
-                self.piece_frequencies[piece_index] += 1
-
-    def get_rarest_piece(self):
-        """
-        Tìm ra piece hiếm nhất dựa trên tần suất xuất hiện trong các bitfield
-        """
-        rarest_piece = None
-        min_frequency = float('inf')
+    def set_streaming(self, enabled=True, window=STREAMING_WINDOW):
+        self.picker.set_streaming(enabled, window)
 
-        for piece_index, frequency in self.piece_frequencies.items():
-            if frequency < min_frequency and not self.file_manager.has_piece(piece_index):
-                min_frequency = frequency
-                rarest_piece = piece_index
+    def open_stream(self, file_name=None):
+        return self.file_manager.open_stream(file_name)
 
-        return rarest_piece
+    def set_file_priority(self, file_name, priority):
+        self.file_manager.set_file_priority(file_name, priority)
 
     def get_transfer_information(self):
-        progress = len(self.file_manager)/ self.file_manager.get_total_pieces() * 100
-        return {"progress": progress, "peers": len(self.peer_handlers), "speed": 0}
\ No newline at end of file
+        progress = self.file_manager.get_progress()
+        information = {"progress": progress, "peers": len(self.peer_handlers), "speed": 0}
+        checking = self.file_manager.get_recheck_progress()
+        if checking is not None:
+            information["checking"] = checking
+        if self.error is not None:
+            information["error"] = self.error
+        return information
\ No newline at end of file
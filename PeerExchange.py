@@ -0,0 +1,120 @@
+import socket
+import struct
+import threading
+
+import Bencode
+
+UT_PEX = 'ut_pex'
+
+PEX_INTERVAL = 60          # BEP 11: gửi tối đa một message PEX mỗi phút cho mỗi kết nối
+MAX_PEX_PEERS = 50         # Số peer added/dropped tối đa trong một message
+MAX_CANDIDATES = 500       # Giới hạn pool peer chờ kết nối
+
+"""
+Peer exchange (BEP 11 - ut_pex): các peer định kỳ gửi cho nhau danh sách peer mới kết nối (added)
+và vừa ngắt (dropped) kể từ lần gửi trước. Peer nhận được đưa vào pool ứng viên kết nối
+chung với peer lấy từ tracker, nên swarm lớn ít phải hỏi tracker và vẫn sống khi tracker lỗi.
+"""
+
+
+def pack_compact_peers(peers):
+    """(ip, port) -> 6 byte mỗi peer, bỏ qua địa chỉ không phải IPv4."""
+    data = b''
+    for ip, port in peers:
+        try:
+            data += socket.inet_aton(ip) + struct.pack('>H', port)
+        except (OSError, struct.error):
+            continue
+    return data
+
+
+def unpack_compact_peers(data, family=socket.AF_INET):
+    size = 6 if family == socket.AF_INET else 18
+    peers = []
+    if not isinstance(data, bytes):
+        return peers
+    for i in range(0, len(data) - size + 1, size):
+        ip = socket.inet_ntop(family, data[i:i + size - 2])
+        port = struct.unpack('>H', data[i + size - 2:i + size])[0]
+        if port > 0:
+            peers.append((ip, port))
+    return peers
+
+
+def encode_pex_message(added, dropped):
+    added = pack_compact_peers(added)
+    return Bencode.encode({
+        b'added': added,
+        b'added.f': bytes(len(added) // 6),
+        b'dropped': pack_compact_peers(dropped),
+    })
+
+
+def decode_pex_message(payload):
+    """Trả về (added, dropped), mỗi cái là list (ip, port)."""
+    message = Bencode.decode(payload)
+    added = unpack_compact_peers(message.get(b'added', b''))
+    added += unpack_compact_peers(message.get(b'added6', b''), socket.AF_INET6)
+    dropped = unpack_compact_peers(message.get(b'dropped', b''))
+    dropped += unpack_compact_peers(message.get(b'dropped6', b''), socket.AF_INET6)
+    return added[:MAX_PEX_PEERS], dropped[:MAX_PEX_PEERS]
+
+
+class PeerExchange:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Pool ứng viên (dict giữ thứ tự thêm vào, dùng như ordered set): (ip, port) -> None
+        self.candidates = {}
+        # Tập peer đã báo cho từng kết nối ở lần gửi trước: client_id -> set((ip, port))
+        self.sent = {}
+
+    def add_candidates(self, peers, preferred=False):
+        """`preferred`: đưa lên đầu pool (peer trong LAN được kết nối trước)."""
+        with self.lock:
+            if preferred:
+                front = dict.fromkeys(peers)
+                for peer in front:
+                    self.candidates.pop(peer, None)
+                self.candidates = {**front, **self.candidates}
+                return
+            for peer in peers:
+                if len(self.candidates) >= MAX_CANDIDATES:
+                    break
+                self.candidates[peer] = None
+
+    def discard_candidates(self, peers):
+        with self.lock:
+            for peer in peers:
+                self.candidates.pop(peer, None)
+
+    def pop_candidate(self):
+        with self.lock:
+            if not self.candidates:
+                return None
+            peer = next(iter(self.candidates))
+            del self.candidates[peer]
+            return peer
+
+    def has_candidates(self):
+        with self.lock:
+            return bool(self.candidates)
+
+    def make_message(self, client_id, connected):
+        """
+        Diff giữa các peer đang kết nối và những gì đã gửi cho `client_id` lần trước.
+        Trả về (added, dropped), hoặc None nếu không có gì thay đổi.
+        """
+        connected = set(connected)
+        with self.lock:
+            previous = self.sent.get(client_id, set())
+            added = list(connected - previous)[:MAX_PEX_PEERS]
+            dropped = list(previous - connected)[:MAX_PEX_PEERS]
+            if not added and not dropped:
+                return None
+            # Peer bị cắt bớt do giới hạn sẽ được gửi ở lần sau
+            self.sent[client_id] = (previous - set(dropped)) | set(added)
+            return added, dropped
+
+    def remove(self, client_id):
+        with self.lock:
+            self.sent.pop(client_id, None)
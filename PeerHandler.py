@@ -5,6 +5,25 @@ import time
 from enum import IntEnum
 from threading import Event
 
+import Bencode
+
+from MetadataExchange import (UT_METADATA, METADATA_REQUEST, METADATA_DATA, METADATA_REJECT,
+                              encode_metadata_message, decode_metadata_message)
+from PeerExchange import UT_PEX, encode_pex_message, decode_pex_message
+
+HANDSHAKE_LENGTH = 68
+EXTENSION_PROTOCOL_BIT = 0x10    # BEP 10: bit 0x10 của byte reserved thứ 5
+# HASH_REQUEST/HASHES/HASH_REJECT là extension riêng của client này, chỉ mượn id và khuôn message của BEP 52:
+# trường root là gốc của một piece trong 'x-piece layer' (không phải 'pieces root' của file), index là index
+# của piece, chỉ hỗ trợ base layer 0 và không có proof. Không bật bit v2 trong handshake; peer báo hỗ trợ
+# bằng key X_PIECE_HASHES trong extended handshake, và chỉ gửi các message này cho peer đã báo.
+X_PIECE_HASHES = 'x_piece_hashes'
+HASH_REQUEST_HEADER = struct.Struct('>32sIIII')  # piece root, base layer, index, length, proof layers
+EXTENDED_HANDSHAKE_ID = 0
+# Extended message id mà client này dùng cho từng extension (gửi trong extended handshake)
+EXTENSIONS = {UT_METADATA: 1, UT_PEX: 2}
+CLIENT_VERSION = 'PY0001'
+
 
 class MessageType(IntEnum):
     CHOKE = 0
@@ -16,17 +35,32 @@ class MessageType(IntEnum):
     REQUEST = 6
     PIECE = 7
     CANCEL = 8
+    EXTENDED = 20
+    HASH_REQUEST = 21     # Extension riêng X_PIECE_HASHES, xem ở trên
+    HASHES = 22
+    HASH_REJECT = 23
 
 
 class PeerHandler:
-    def __init__(self, conn, addr, info_hash, peer_id, callback):
+    def __init__(self, conn, addr, info_hash, peer_id, callback, handshake=None,
+                 upload_limiter=None, download_limiter=None, listen_addr=None):
         self.conn = conn
         self.addr = addr
+        # Địa chỉ lắng nghe của peer: biết trước nếu mình chủ động kết nối,
+        # với kết nối đến thì lấy cổng 'p' trong extended handshake
+        self.listen_addr = listen_addr
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.callback = callback
         self.client_id = None
 
+        # Handshake đã được Session đọc trước để tìm torrent (kết nối đến)
+        self.received_handshake = handshake
+
+        # Bộ giới hạn tốc độ dùng chung của Session (có thể None)
+        self.upload_limiter = upload_limiter
+        self.download_limiter = download_limiter
+
         # State flags
         self.am_choking = True
         self.am_interested = False
@@ -35,10 +69,20 @@ class PeerHandler:
 
         # Threading control
         self.running = True
+        # Message được gửi từ nhiều thread (thread của handler, PEX, pool đĩa, theo dõi file gốc...):
+        # mỗi message phải được ghi trọn vẹn, không xen vào giữa message khác.
+        # RLock: choke/unchoke giữ lock cả lúc gửi lẫn lúc đổi am_choking
+        self.send_lock = threading.RLock()
         self.stopped_externally = False  # New flag to track if stop was called externally
         self.listen_thread = None
         self.request_thread = None
 
+        # Extension protocol (BEP 10): tên extension -> message id mà peer bên kia dùng
+        self.supports_extensions = False
+        self.extensions = {}
+        # Peer hiểu hash request/hashes (extension riêng X_PIECE_HASHES), dùng để lấy hash lá khi piece hỏng
+        self.supports_hashes = False
+
         # Peer state
         self.bitfield = None
         self.pending_requests = {}
@@ -49,8 +93,10 @@ class PeerHandler:
         self.cleanup_done = False
 
     def run(self):
-        if self.two_way_handshake():
+        if self.two_way_handshake() and self.callback(self.client_id, "handshake", {'addr': self.addr})['accept']:
             self.send_bitfield()
+            if self.supports_extensions:
+                self.send_extended_handshake()
 
             # Start listening thread
             self.listen_thread = threading.Thread(target=self.listen)
@@ -63,13 +109,13 @@ class PeerHandler:
             self.request_thread.join()
         else:
             self._cleanup()
-            self.callback(self.peer_id, "stop", {"addr": self.addr})
+            self.callback(self.client_id, "stop", {"addr": self.addr})
 
     def listen(self):
         try:
             while self.running:
                 # First read the message length (4 bytes)
-                length_prefix = self.conn.recv(4)
+                length_prefix = self.recv_exact(4)
                 if not length_prefix:
                     break
 
@@ -81,7 +127,7 @@ class PeerHandler:
                     continue
 
                 # Read the message type
-                message_type = struct.unpack("B", self.conn.recv(1))[0]
+                message_type = struct.unpack("B", self.recv_exact(1))[0]
 
                 # Read the payload
                 payload = b""
@@ -93,13 +139,26 @@ class PeerHandler:
                     payload += chunk
                     remaining -= len(chunk)
 
+                if self.download_limiter:
+                    self.download_limiter.consume(length + 4)
+
                 self.handle_message(message_type, payload)
 
         except Exception as e:
             print(f"Error in listen loop: {e}")
         finally:
             self._cleanup()
-            self.callback(self.peer_id, "stop", {"addr": self.addr})
+            self.callback(self.client_id, "stop", {"addr": self.addr})
+
+    def recv_exact(self, size):
+        """Đọc đủ `size` byte từ socket, trả về b'' nếu kết nối bị đóng giữa chừng."""
+        data = b""
+        while len(data) < size:
+            chunk = self.conn.recv(size - len(data))
+            if not chunk:
+                return b""
+            data += chunk
+        return data
 
     def request(self):
         while self.running:
@@ -114,6 +173,11 @@ class PeerHandler:
         with self.cleanup_lock:
             if not self.cleanup_done:
                 self.running = False
+                try:
+                    # close() không đánh thức thread đang chặn trong recv(), shutdown() thì có
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
                 try:
                     self.conn.close()
                 except Exception:
@@ -133,7 +197,8 @@ class PeerHandler:
                 if self.am_interested:
                     data = self.callback(self.client_id, "request_piece_index")
                     print(data)
-                    self.send_request(data['index'], data['begin'], data['length'])
+                    if data['index'] is not None:
+                        self.send_request(data['index'], data['begin'], data['length'])
 
             elif message_type == MessageType.INTERESTED:
                 self.peer_interested = 1
@@ -147,8 +212,7 @@ class PeerHandler:
             elif message_type == MessageType.HAVE:
                 piece_index = struct.unpack(">I", payload)[0]
                 print(f"Peer {self.addr} has piece {piece_index}")
-                if self.bitfield:
-                    self.bitfield[piece_index] = 1
+                self.callback(self.client_id, "have_received", {'index': piece_index})
 
             elif message_type == MessageType.BITFIELD:
                 bitfield = bytearray(payload)
@@ -170,8 +234,11 @@ class PeerHandler:
                 index, begin, length = self.validate_request(payload)
                 print(f"Receive from {self.addr}, index: {index}, begin: {begin}, length: {length}")
 
-                piece = self.callback(self.client_id, "request_piece", {'index':index, 'begin':begin, 'length':length})
-                self.send_piece({'index' : index, 'begin': begin, 'block': piece.get_data()})
+                # Chờ token upload trên thread của kết nối, không chặn thread của pool đĩa
+                if self.upload_limiter:
+                    self.upload_limiter.consume(length + 8)
+                # Piece được đọc trên pool đĩa, block được gửi trong send_block khi đọc xong
+                self.callback(self.client_id, "request_piece", {'index':index, 'begin':begin, 'length':length})
 
             elif message_type == MessageType.PIECE:
                 # Handle received piece data
@@ -185,21 +252,121 @@ class PeerHandler:
                 is_complete = self.callback(self.client_id, "piece_received", {'index' : index,'begin': begin,'block': block})
                 if is_complete:
                     self.send_not_interested()
-                else:
+                elif begin == 0:
+                    # Block tải lại để sửa piece hỏng (begin != 0) không xin thêm piece mới
                     data = self.callback(self.client_id, "request_piece_index")
                     print(data)
-                    self.send_request(data['index'], data['begin'], data['length'])
+                    if data['index'] is not None:
+                        self.send_request(data['index'], data['begin'], data['length'])
+
+            elif message_type == MessageType.EXTENDED:
+                self.handle_extended_message(payload)
+
+            elif message_type == MessageType.HASH_REQUEST:
+                root, base_layer, index, length, proof_layers = HASH_REQUEST_HEADER.unpack_from(payload)
+                header = payload[:HASH_REQUEST_HEADER.size]
+                if base_layer != 0:
+                    self.send_hashes(header, None)
+                else:
+                    # Hash được tính trên pool đĩa, trả lời trong send_hashes khi xong
+                    self.callback(self.client_id, "hash_request",
+                                  {'root': root, 'index': index, 'length': length, 'header': header})
+
+            elif message_type == MessageType.HASHES:
+                root, base_layer, index, length, proof_layers = HASH_REQUEST_HEADER.unpack_from(payload)
+                body = payload[HASH_REQUEST_HEADER.size:]
+                hashes = [body[i:i + 32] for i in range(0, len(body) - 31, 32)]
+                print(f"Received {len(hashes)} block hashes of piece {index} from {self.addr}")
+                result = self.callback(self.client_id, "hashes_received", {'index': index, 'hashes': hashes})
+                for index, begin, length in result.get('requests', []):
+                    self.send_request(index, begin, length)
+
+            elif message_type == MessageType.HASH_REJECT:
+                root, base_layer, index, length, proof_layers = HASH_REQUEST_HEADER.unpack_from(payload)
+                print(f"Peer {self.addr} rejected hash request for piece {index}")
+                self.callback(self.client_id, "hashes_rejected", {'index': index})
 
         except Exception as e:
             print(f"Error handling message type {message_type}: {e}")
 
+    def handle_extended_message(self, payload):
+        if not payload:
+            return
+        extended_id = payload[0]
+        body = payload[1:]
+
+        if extended_id == EXTENDED_HANDSHAKE_ID:
+            handshake = Bencode.decode(body)
+            self.extensions = {name.decode(): remote_id for name, remote_id in handshake.get(b'm', {}).items()
+                               if isinstance(remote_id, int) and remote_id > 0}
+            self.supports_hashes = handshake.get(X_PIECE_HASHES.encode()) == 1
+            print(f"Peer {self.addr} supports extensions: {self.extensions}")
+            port = handshake.get(b'p')
+            if self.listen_addr is None and isinstance(port, int) and 0 < port < 65536:
+                self.listen_addr = (self.addr[0], port)
+            data = self.callback(self.client_id, "extended_handshake", {'handshake': handshake}) or {}
+            self.request_metadata(data.get('metadata_pieces', []))
+
+        elif extended_id == EXTENSIONS[UT_METADATA]:
+            header, data = decode_metadata_message(body)
+            msg_type = header.get(b'msg_type')
+            piece = header.get(b'piece')
+
+            if msg_type == METADATA_REQUEST:
+                result = self.callback(self.client_id, "metadata_request", {'piece': piece})
+                if result['data'] is None:
+                    self.send_extended(UT_METADATA, encode_metadata_message(METADATA_REJECT, piece))
+                else:
+                    self.send_extended(UT_METADATA, encode_metadata_message(METADATA_DATA, piece, result['data'],
+                                                                            result['total_size']))
+
+            elif msg_type == METADATA_DATA:
+                print(f"Received metadata piece {piece} from {self.addr}")
+                result = self.callback(self.client_id, "metadata_received", {'piece': piece, 'data': data})
+                self.request_metadata(result.get('metadata_pieces', []))
+
+            elif msg_type == METADATA_REJECT:
+                print(f"Peer {self.addr} rejected metadata piece {piece}")
+                self.callback(self.client_id, "metadata_rejected", {'piece': piece})
+
+        elif extended_id == EXTENSIONS[UT_PEX]:
+            added, dropped = decode_pex_message(body)
+            print(f"Received PEX from {self.addr}: {len(added)} added, {len(dropped)} dropped")
+            self.callback(self.client_id, "pex_received", {'added': added, 'dropped': dropped})
+
+    def send_extended_handshake(self):
+        handshake = {b'm': {name.encode(): local_id for name, local_id in EXTENSIONS.items()},
+                     b'v': CLIENT_VERSION.encode(), X_PIECE_HASHES.encode(): 1}
+        extra = self.callback(self.client_id, "request_extended_handshake") or {}
+        handshake.update({key.encode(): value for key, value in extra.items()})
+        self.send_message(MessageType.EXTENDED, bytes([EXTENDED_HANDSHAKE_ID]) + Bencode.encode(handshake))
+
+    def send_extended(self, name, payload):
+        """Gửi extended message, bỏ qua nếu peer không hỗ trợ extension này."""
+        remote_id = self.extensions.get(name)
+        if remote_id is None:
+            return False
+        self.send_message(MessageType.EXTENDED, bytes([remote_id]) + payload)
+        return True
+
+    def request_metadata(self, pieces):
+        for piece in pieces:
+            self.send_extended(UT_METADATA, encode_metadata_message(METADATA_REQUEST, piece))
+
+    def send_pex(self, added, dropped):
+        return self.send_extended(UT_PEX, encode_pex_message(added, dropped))
+
 
     def two_way_handshake(self):
 
         # Gửi thông điệp handshake tới peer client
         self.send_handshake()
-        # Nhận response từ peer (handshake message)
-        response = self.conn.recv(1024)  # Receive the handshake message
+        # Nhận response từ peer (handshake message), trừ khi Session đã đọc sẵn
+        if self.received_handshake:
+            response = self.received_handshake
+        else:
+            # Đọc đúng 68 byte, nếu đọc thừa sẽ nuốt mất message bitfield gửi ngay sau handshake
+            response = self.recv_exact(HANDSHAKE_LENGTH)
 
         # Phân tích thông điệp handshake nhận được
         if self.parse_handshake(response):
@@ -219,9 +386,15 @@ class PeerHandler:
             pstrlen = struct.unpack("B", response[0:1])[0]  # Length of the protocol string
             pstr = response[1:20].decode("utf-8")  # Protocol string (BitTorrent protocol)
             reserved = response[20:28]  # 8 bytes reserved
+            self.supports_extensions = bool(reserved[5] & EXTENSION_PROTOCOL_BIT)
             received_info_hash = response[28:48]  # 20 bytes info_hash (raw bytes)
             received_peer_id = response[48:68].decode("utf-8")  # 20 bytes peer_id (raw bytes)
             self.client_id = received_peer_id
+            own_peer_id = self.peer_id.decode('utf-8') if isinstance(self.peer_id, bytes) else self.peer_id
+            if received_peer_id == own_peer_id:
+                # Địa chỉ của chính mình (ví dụ nhận lại qua PEX)
+                print(f"Connected to self at {self.addr}, closing")
+                return False
             # Check protocol string and info_hash (compare raw bytes, no decoding)
             if pstr == "BitTorrent protocol" and received_info_hash == self.info_hash:
                 print(f"Handshake received successfully from {self.addr}")
@@ -241,7 +414,10 @@ class PeerHandler:
         try:
             pstr = "BitTorrent protocol"
             pstrlen = len(pstr)
-            reserved = b'\x00' * 8  # 8 bytes reserved (all zeros)
+            # 8 bytes reserved: bật bit extension protocol (BEP 10)
+            reserved = bytearray(8)
+            reserved[5] |= EXTENSION_PROTOCOL_BIT
+            reserved = bytes(reserved)
 
             # Ensure info_hash and peer_id are bytes (SHA-1 hash is 20 bytes)
             if isinstance(self.info_hash, str):
@@ -268,7 +444,8 @@ class PeerHandler:
 
             print(f"handshake message: {handshake_message}")
             # Send the handshake message
-            self.conn.send(handshake_message)
+            with self.send_lock:
+                self.conn.sendall(handshake_message)
             print(f"Handshake sent to {self.addr}")
         except Exception as e:
             print(f"Handshake send failed: {e}")
@@ -328,7 +505,8 @@ class PeerHandler:
             if message_type != MessageType.PIECE:
                 print("Packed message:", message)  # Debug packed message
 
-            self.conn.send(message)
+            with self.send_lock:
+                self.conn.sendall(message)
         except Exception as e:
             print(f"Error sending message type {message_type}: {e}")
 
@@ -339,15 +517,52 @@ class PeerHandler:
         self.send_message(MessageType.REQUEST, payload)
         print(f"Requested block - index: {index}, begin: {begin}, length: {length}")
 
+    def send_hash_request(self, root, index, length):
+        """
+        Xin `length` hash lá (lớp 0) của piece `index` có gốc `root` trong 'x-piece layer'.
+        Extension riêng, không phải hash request của BEP 52 (root ở đây là gốc của piece, không phải của file).
+        """
+        self.send_message(MessageType.HASH_REQUEST, HASH_REQUEST_HEADER.pack(root, 0, index, length, 0))
+        print(f"Requested block hashes of piece {index} from {self.addr}")
+
+    def send_hashes(self, header, hashes):
+        """Trả lời HASH_REQUEST có phần đầu `header`, từ chối nếu `hashes` là None."""
+        if hashes is None:
+            self.send_message(MessageType.HASH_REJECT, header)
+        else:
+            self.send_message(MessageType.HASHES, header + b''.join(hashes))
+
+    def send_choke(self):
+        """Send choke message to the peer."""
+        # Trạng thái am_choking phải khớp với message gửi sau cùng, kể cả khi hai thread cùng choke/unchoke,
+        # và đổi trước khi gửi: peer có thể xin ngay khi nhận unchoke
+        with self.send_lock:
+            self.am_choking = True
+            self.send_message(MessageType.CHOKE)
+
     def send_unchoke(self):
         """Send unchoke message to the peer."""
-        self.send_message(MessageType.UNCHOKE)
-        self.am_choking = False
+        with self.send_lock:
+            self.am_choking = False
+            self.send_message(MessageType.UNCHOKE)
 
     def validate_request(self, payload):
         index, begin, length = struct.unpack('>III', payload)
         return index, begin, length
 
+    def send_block(self, index, begin, length, data):
+        """Gửi block được xin từ piece `data` vừa đọc xong trên pool đĩa."""
+        if data is None:
+            # Không đọc được piece (file gốc đã thay đổi): choke, peer xin lại khi được unchoke
+            self.send_choke()
+            return
+        if self.am_choking:
+            # Đã choke trong lúc đọc: peer bỏ các request đang chờ và sẽ xin lại
+            return
+        # Chỉ gửi đúng đoạn được xin, peer có thể xin lại riêng một block hỏng
+        block = memoryview(data)[begin:begin + length]
+        self.send_piece({'index' : index, 'begin': begin, 'block': block})
+
     def send_piece(self, piece):
         try:
             # Đảm bảo piece chứa các trường cần thiết
@@ -1,16 +1,259 @@
+import http.client
 import urllib.parse
 import socket
+import struct
+import json
+import queue
+import random
+import threading
+import time
+
+import Bencode
 
 TRACKER_PORT = 5050
 TRACKER_HOST = 'localhost'
+DEFAULT_TRACKER = f"http://{TRACKER_HOST}:{TRACKER_PORT}/announce"  # Dùng khi torrent không có tracker nào
+DEFAULT_NUMWANT = 50
 EVENT_STATE = ['STARTED', 'STOPPED', 'COMPLETED']
 
+TRACKER_TIMEOUT = 5          # Timeout kết nối/đọc của một request HTTP tới tracker (giây)
+TRACKER_RETRY_DELAY = 60     # Tracker lỗi bị bỏ qua trong khoảng này, nhân đôi sau mỗi lần lỗi liên tiếp
+TRACKER_MAX_RETRY_DELAY = 1800
+
+# UDP tracker protocol (BEP 15)
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_ACTION_CONNECT = 0
+UDP_ACTION_ANNOUNCE = 1
+UDP_ACTION_SCRAPE = 2
+UDP_ACTION_ERROR = 3
+UDP_EVENTS = {'': 0, 'COMPLETED': 1, 'STARTED': 2, 'STOPPED': 3}
+UDP_TIMEOUT = 2              # Timeout lần gửi đầu, nhân đôi sau mỗi lần gửi lại
+UDP_MAX_RETRIES = 2
+UDP_CONNECTION_ID_LIFETIME = 60
+
 """
 Class dùng để communicate với server
 """
 
+
+class TrackerError(ConnectionError):
+    pass
+
+
+class TrackerTimeout(TrackerError):
+    pass
+
+
+class Tracker:
+    """
+    Một tracker trong announce-list. Giữ kết nối HTTP keep-alive (hoặc socket UDP và connection ID)
+    để các announce sau dùng lại, thay vì mở kết nối TCP mới cho mỗi request.
+    """
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme not in ('http', 'udp') or not parsed.hostname:
+            raise ValueError(f"Unsupported tracker URL {url!r}")
+
+        self.url = url
+        self.protocol = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (80 if parsed.scheme == 'http' else 6969)
+        self.announce_path = parsed.path or '/announce'
+
+        self.lock = threading.Lock()
+        self.http_connection = None
+        # Socket UDP cố định: connection ID được tracker gắn với địa chỉ nguồn (ip, port)
+        self.udp_socket = None
+        self.connection_id = None
+        self.connection_id_expires = 0
+
+        # Tracker lỗi liên tiếp bị tạm bỏ qua để không làm chậm các lần announce sau
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def __repr__(self):
+        return f"Tracker({self.url!r})"
+
+    def is_available(self):
+        return time.monotonic() >= self.retry_at
+
+    def mark_success(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def mark_failure(self):
+        self.failures += 1
+        delay = min(TRACKER_RETRY_DELAY * 2 ** (self.failures - 1), TRACKER_MAX_RETRY_DELAY)
+        self.retry_at = time.monotonic() + delay
+
+    def close(self):
+        with self.lock:
+            if self.http_connection:
+                self.http_connection.close()
+                self.http_connection = None
+            if self.udp_socket:
+                self.udp_socket.close()
+                self.udp_socket = None
+
+    def announce(self, params):
+        with self.lock:
+            if self.protocol == 'udp':
+                cached = self.connection_id is not None
+                try:
+                    return self.udp_announce(params)
+                except TrackerTimeout:
+                    raise
+                except TrackerError:
+                    # Connection ID cũ bị từ chối: connect lại và thử thêm một lần
+                    if not cached:
+                        raise
+                    return self.udp_announce(params)
+
+            body = self.http_get(f"{self.announce_path}?{urllib.parse.urlencode(params)}")
+            response = PeerServer.parse_announce_response(body)
+            if 'failure reason' in response:
+                raise TrackerError(response['failure reason'])
+            return response
+
+    def scrape(self, info_hashes):
+        with self.lock:
+            if self.protocol == 'udp':
+                return self.udp_scrape(info_hashes)
+
+            # Quy ước scrape: thay 'announce' cuối cùng trong path bằng 'scrape'
+            head, sep, tail = self.announce_path.rpartition('/announce')
+            if not sep:
+                raise TrackerError(f"{self.url} does not support scrape")
+            query_string = urllib.parse.urlencode([('info_hash', info_hash) for info_hash in info_hashes])
+            return self.http_get(f"{head}/scrape{tail}?{query_string}").decode('utf-8')
+
+    def http_get(self, path):
+        """GET qua kết nối keep-alive. Kết nối cũ bị tracker đóng thì mở lại và gửi lại một lần."""
+        for attempt in range(2):
+            if self.http_connection is None:
+                self.http_connection = http.client.HTTPConnection(self.host, self.port, timeout=TRACKER_TIMEOUT)
+            reused = self.http_connection.sock is not None
+            try:
+                self.http_connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = self.http_connection.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self.http_connection.close()
+                    self.http_connection = None
+                return body
+            except (OSError, http.client.HTTPException) as e:
+                self.http_connection.close()
+                self.http_connection = None
+                if not reused or attempt:
+                    raise TrackerError(f"{self.url}: {e}") from e
+
+    def udp_announce(self, params):
+        connection_id = self.udp_connect()
+
+        packet = struct.pack('>20s20sQQQIIIiH',
+                             params['info_hash'], params['peer_id'].encode('latin-1'),
+                             int(params['downloaded']), int(params['left']), int(params['uploaded']),
+                             UDP_EVENTS.get(params['event'], 0),
+                             self.udp_ip_field(params['ip']),
+                             params['key'], int(params['numwant']), int(params['port']))
+        response = self.udp_transaction(UDP_ACTION_ANNOUNCE, packet, connection_id)
+        if len(response) < 20:
+            raise TrackerError("Malformed UDP announce response")
+
+        interval, leechers, seeders = struct.unpack('>III', response[8:20])
+        peers = []
+        for i in range(20, len(response) - 5, 6):
+            ip = socket.inet_ntop(socket.AF_INET, response[i:i + 4])
+            port = struct.unpack('>H', response[i + 4:i + 6])[0]
+            peers.append({'ip': ip, 'port': port})
+        return {'interval': interval, 'complete': seeders, 'incomplete': leechers, 'peers': peers}
+
+    @staticmethod
+    def udp_ip_field(ip):
+        """Địa chỉ IPv4 của peer dạng số nguyên, 0 để tracker dùng địa chỉ nguồn của gói tin."""
+        try:
+            return struct.unpack('>I', socket.inet_aton(ip))[0]
+        except (OSError, TypeError):
+            return 0
+
+    def udp_scrape(self, info_hashes):
+        connection_id = self.udp_connect()
+        response = self.udp_transaction(UDP_ACTION_SCRAPE, b''.join(info_hashes), connection_id)
+
+        # Trả về cùng dạng JSON với scrape qua HTTP
+        files = {}
+        for i, info_hash in enumerate(info_hashes):
+            offset = 8 + i * 12
+            if offset + 12 > len(response):
+                break
+            complete, downloaded, incomplete = struct.unpack('>III', response[offset:offset + 12])
+            files[info_hash.hex()] = {'complete': complete, 'incomplete': incomplete, 'downloaded': downloaded}
+        result = {'tracker_id': self.url, 'files': files}
+        if len(info_hashes) == 1 and files:
+            stats = files[info_hashes[0].hex()]
+            result['info_hash'] = info_hashes[0].hex()
+            result['total_peers'] = stats['complete'] + stats['incomplete']
+        return json.dumps(result)
+
+    def udp_connect(self):
+        """Lấy connection ID từ tracker, dùng lại trong thời gian còn hiệu lực."""
+        if self.connection_id is not None and time.monotonic() < self.connection_id_expires:
+            return self.connection_id
+        response = self.udp_transaction(UDP_ACTION_CONNECT, b'', UDP_PROTOCOL_ID)
+        if len(response) < 16:
+            raise TrackerError("Malformed UDP connect response")
+        self.connection_id = struct.unpack('>Q', response[8:16])[0]
+        self.connection_id_expires = time.monotonic() + UDP_CONNECTION_ID_LIFETIME
+        return self.connection_id
+
+    def udp_transaction(self, action, payload, connection_id):
+        """
+        Gửi một request UDP và chờ response có cùng transaction id.
+        Mất gói thì gửi lại với timeout tăng gấp đôi (UDP_TIMEOUT * 2^n).
+        """
+        transaction_id = random.getrandbits(32)
+        packet = struct.pack('>QII', connection_id, action, transaction_id) + payload
+
+        if self.udp_socket is None:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket = self.udp_socket
+
+        for attempt in range(UDP_MAX_RETRIES):
+            udp_socket.sendto(packet, (self.host, self.port))
+            deadline = time.monotonic() + UDP_TIMEOUT * (2 ** attempt)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                udp_socket.settimeout(remaining)
+                try:
+                    response, _ = udp_socket.recvfrom(2048)
+                except socket.timeout:
+                    break
+                if len(response) < 8:
+                    continue
+                response_action, response_transaction = struct.unpack('>II', response[:8])
+                if response_transaction != transaction_id:
+                    # Response trễ của một lần gửi trước
+                    continue
+                if response_action == UDP_ACTION_ERROR:
+                    # Connection ID có thể đã hết hạn, lần sau phải connect lại
+                    self.connection_id = None
+                    raise TrackerError(response[8:].decode('utf-8', 'replace'))
+                if response_action != action:
+                    raise TrackerError(f"Unexpected UDP action {response_action}")
+                return response
+
+        self.connection_id = None
+        raise TrackerTimeout(f"{self.url} did not respond")
+
+
 class PeerServer:
-    def __init__(self, peer_id, peer_ip, peer_port, info_hash):
+    def __init__(self, peer_id, peer_ip, peer_port, info_hash, trackers=None):
+        """
+        :param trackers: danh sách tier theo announce-list (BEP 12), mỗi tier là list URL.
+        Các tracker trong một tier được thử lần lượt (failover), các tier được announce song song.
+        """
         self.peer_ip = peer_ip
         self.peer_port = peer_port
         self.info_hash = info_hash
@@ -21,11 +264,42 @@ class PeerServer:
         self.uploaded = 0
         self.downloaded = 0
         self.left = 0
-        self.compact = 0
+        self.compact = 1
         self.no_peer_id = 0
+        self.numwant = DEFAULT_NUMWANT
         self.event = EVENT_STATE[0]
+        self.key = random.getrandbits(32)
+
+        self.tiers = self.build_tiers(trackers or [[DEFAULT_TRACKER]])
+        self.lock = threading.Lock()
+        # Response của các tier trả lời sau tier nhanh nhất được chuyển cho callback này
+        self.on_response = None
+
+    @staticmethod
+    def build_tiers(trackers):
+        tiers = []
+        for tier in trackers:
+            urls = [tier] if isinstance(tier, str) else tier
+            tracker_tier = []
+            for url in urls:
+                try:
+                    tracker_tier.append(Tracker(url))
+                except ValueError as e:
+                    print(f"Skipping tracker: {e}")
+            if tracker_tier:
+                tiers.append(tracker_tier)
+        return tiers or [[Tracker(DEFAULT_TRACKER)]]
+
+    def close(self):
+        for tier in self.tiers:
+            for tracker in tier:
+                tracker.close()
 
     def announce_request(self, event_state):
+        """
+        Announce tới mọi tier song song và trả về response đầu tiên thành công,
+        để tracker chậm hoặc chết không làm chậm việc tham gia swarm.
+        """
         self.event = event_state
         params = {
             'info_hash': self.info_hash,
@@ -36,37 +310,132 @@ class PeerServer:
             'downloaded': str(self.downloaded),
             'left': str(self.left),
             'compact': str(self.compact),
+            'numwant': str(self.numwant),
             'event': self.event,
+            'key': self.key,
         }
 
-        query_string = urllib.parse.urlencode(params)
-        # Tạo thông điệp GET request
-        request = f"GET /announce?{query_string} HTTP/1.1\r\n"
-        request += f"Host: {TRACKER_HOST}\r\n"
-        request += "Connection: close\r\n\r\n"
+        if len(self.tiers) == 1:
+            return self.announce_tier(self.tiers[0], params)
 
-        response = self.send_request(request)
-        return response
+        results = queue.Queue()
+        state = {'delivered': False}
+        for tier in self.tiers:
+            threading.Thread(target=self.announce_tier_async, args=(tier, params, results, state),
+                             daemon=True).start()
 
-    def scrape_request(self):
-        # Mã hóa info_hash
-        encoded_info_hash = urllib.parse.quote(self.info_hash)
-        request = f"GET /scrape?info_hash={encoded_info_hash} HTTP/1.1\r\nHost: {TRACKER_HOST}\r\n\r\n"
+        errors = []
+        for _ in self.tiers:
+            result = results.get()
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                return result
+        raise TrackerError(f"All trackers failed: {errors}")
 
-        response = self.send_request(request)
-        return response
+    def announce_tier_async(self, tier, params, results, state):
+        try:
+            response = self.announce_tier(tier, params)
+        except Exception as e:
+            # Mỗi tier phải trả đúng một kết quả, nếu không announce_request chờ mãi trên results.get()
+            results.put(e)
+            return
 
-    def send_request(self, request):
-        # Mở kết nối TCP tới tracker
+        with self.lock:
+            first = not state['delivered']
+            state['delivered'] = True
+        if first:
+            results.put(response)
+        elif self.on_response:
+            try:
+                self.on_response(response)
+            except Exception as e:
+                print(f"Error handling late announce response: {e!r}")
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.connect((TRACKER_HOST, TRACKER_PORT))
-        server_socket.sendall(request.encode('utf-8'))
-        response = b""
-        while True:
-            data = server_socket.recv(4096)
-            if not data:
-                break
-            response += data
+    def announce_tier(self, tier, params):
+        """Thử lần lượt các tracker trong tier, tracker trả lời được đưa lên đầu tier (BEP 12)."""
+        errors = []
+        for tracker in self.candidates(tier):
+            try:
+                response = tracker.announce(params)
+            except (OSError, ValueError) as e:
+                print(f"Announce to {tracker.url} failed: {e}")
+                tracker.mark_failure()
+                errors.append(e)
+                continue
+            tracker.mark_success()
+            with self.lock:
+                tier.remove(tracker)
+                tier.insert(0, tracker)
+            return response
+        raise TrackerError(f"No tracker in tier answered: {errors}")
+
+    def candidates(self, tier):
+        """Các tracker nên thử trong tier: bỏ qua tracker vừa lỗi, trừ khi cả tier đều đang lỗi."""
+        with self.lock:
+            trackers = list(tier)
+        return [tracker for tracker in trackers if tracker.is_available()] or trackers
+
+    @staticmethod
+    def parse_announce_response(body):
+        """
+        Chuyển announce response (bencode với peer list compact, hoặc JSON) thành dict
+        dạng {'interval': ..., 'peers': [{'ip': ..., 'port': ...}, ...]}.
+        """
+        if not body.startswith(b'd'):
+            response = json.loads(body.decode('utf-8'))
+            if not isinstance(response, dict) or not isinstance(response.get('peers', []), list) \
+                    or not all(isinstance(peer, dict) for peer in response.get('peers', [])):
+                raise TrackerError("Malformed announce response")
+            return response
+
+        decoded = Bencode.decode(body)
+        if not isinstance(decoded, dict):
+            raise TrackerError("Malformed announce response")
+        response = {key.decode(): value for key, value in decoded.items()}
+        if 'failure reason' in response:
+            if not isinstance(response['failure reason'], bytes):
+                raise TrackerError("Malformed failure reason in announce response")
+            response['failure reason'] = response['failure reason'].decode('utf-8', 'replace')
+            return response
+
+        peers = []
+        compact_peers = response.get('peers', b'')
+        if isinstance(compact_peers, bytes):
+            for i in range(0, len(compact_peers) - 5, 6):
+                ip = socket.inet_ntop(socket.AF_INET, compact_peers[i:i + 4])
+                port = struct.unpack('>H', compact_peers[i + 4:i + 6])[0]
+                peers.append({'ip': ip, 'port': port})
+        elif isinstance(compact_peers, list):
+            # Tracker trả về danh sách không compact
+            for peer in compact_peers:
+                if not isinstance(peer, dict) or not isinstance(peer.get(b'ip'), bytes) \
+                        or not isinstance(peer.get(b'port'), int):
+                    raise TrackerError("Malformed peer in announce response")
+                peers.append({'ip': peer[b'ip'].decode('utf-8', 'replace'), 'port': peer[b'port']})
+        else:
+            raise TrackerError("Malformed peer list in announce response")
+
+        compact_peers6 = response.get('peers6', b'')
+        if not isinstance(compact_peers6, bytes):
+            raise TrackerError("Malformed peers6 in announce response")
+        for i in range(0, len(compact_peers6) - 17, 18):
+            ip = socket.inet_ntop(socket.AF_INET6, compact_peers6[i:i + 16])
+            port = struct.unpack('>H', compact_peers6[i + 16:i + 18])[0]
+            peers.append({'ip': ip, 'port': port})
+
+        response['peers'] = peers
+        response.pop('peers6', None)
+        return response
 
-        return response.decode('utf-8')
\ No newline at end of file
+    def scrape_request(self, info_hashes=None):
+        """Scrape torrent hiện tại, hoặc nhiều torrent một lúc nếu truyền danh sách info_hash."""
+        info_hashes = info_hashes or [self.info_hash]
+        errors = []
+        for tier in self.tiers:
+            for tracker in self.candidates(tier):
+                try:
+                    return tracker.scrape(info_hashes)
+                except (OSError, ValueError) as e:
+                    errors.append(e)
+        raise TrackerError(f"Scrape failed on every tracker: {errors}")
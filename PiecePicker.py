@@ -0,0 +1,139 @@
+import threading
+
+STREAMING_WINDOW = 16  # Số piece phía trước con trỏ đọc được xếp theo deadline
+
+
+class PiecePicker:
+    """
+    Chọn piece tiếp theo để tải (rarest-first hoặc theo deadline khi streaming).
+    Có lock riêng, tách khỏi lock của FileManager và của danh sách kết nối trong Peer.
+    """
+    def __init__(self, file_manager, streaming_window=STREAMING_WINDOW):
+        self.file_manager = file_manager
+        self.lock = threading.Lock()
+
+        self.bitfields = {}  # Lưu trữ bitfield từ mỗi peer (peer_id -> bitfield)
+        self.piece_frequencies = {}  # Đếm tần suất xuất hiện của mỗi piece
+        self.verifying = set()  # Các piece đã nhận và đang chờ hash
+
+        # Streaming mode: ưu tiên piece theo deadline so với con trỏ đọc thay vì rarest-first
+        self.streaming = False
+        self.streaming_window = streaming_window
+
+    def set_streaming(self, enabled=True, window=STREAMING_WINDOW):
+        with self.lock:
+            self.streaming = enabled
+            self.streaming_window = window
+
+    def add_bitfield(self, peer_id, bitfield):
+        with self.lock:
+            old_bitfield = self.bitfields.get(peer_id)
+            if old_bitfield is not None:
+                self._update_piece_frequencies(old_bitfield, -1)
+            self.bitfields[peer_id] = bitfield
+            self._update_piece_frequencies(bitfield, 1)
+
+    def add_have(self, peer_id, piece_index):
+        with self.lock:
+            bitfield = bytearray(self.bitfields.get(peer_id, b''))
+            byte_index = piece_index // 8
+            if byte_index >= len(bitfield):
+                bitfield.extend(b'\x00' * (byte_index + 1 - len(bitfield)))
+            mask = 1 << (7 - piece_index % 8)
+            if bitfield[byte_index] & mask:
+                return
+            bitfield[byte_index] |= mask
+            self.bitfields[peer_id] = bytes(bitfield)
+            self.piece_frequencies[piece_index] = self.piece_frequencies.get(piece_index, 0) + 1
+
+    def get_bitfield(self, peer_id):
+        with self.lock:
+            return self.bitfields.get(peer_id)
+
+    def rebuild(self):
+        """Tính lại tần suất từ các bitfield đã lưu (khi số piece thay đổi, ví dụ vừa nhận metadata)."""
+        with self.lock:
+            self.piece_frequencies = {}
+            for bitfield in self.bitfields.values():
+                self._update_piece_frequencies(bitfield, 1)
+
+    def remove_peer(self, peer_id):
+        with self.lock:
+            bitfield = self.bitfields.pop(peer_id, None)
+            if bitfield is not None:
+                self._update_piece_frequencies(bitfield, -1)
+
+    def _update_piece_frequencies(self, bitfield, delta):
+        """
+        Cập nhật tần suất xuất hiện của mỗi piece dựa trên bitfield nhận được
+        """
+        for piece_index in range(min(self.file_manager.get_total_pieces(), len(bitfield) * 8)):
+            byte_index = piece_index // 8
+            bit_index = piece_index % 8
+
+            # Check if the bit is set (indicating the piece is available)
+            if bitfield[byte_index] & (1 << (7 - bit_index)):
+                frequency = self.piece_frequencies.get(piece_index, 0) + delta
+                if frequency > 0:
+                    self.piece_frequencies[piece_index] = frequency
+                else:
+                    self.piece_frequencies.pop(piece_index, None)
+
+    def begin_verify(self, piece_index):
+        """Đánh dấu piece đang được hash, trả về False nếu piece đã có hoặc đang hash."""
+        with self.lock:
+            if piece_index in self.verifying or self.file_manager.has_piece(piece_index):
+                return False
+            self.verifying.add(piece_index)
+            return True
+
+    def end_verify(self, piece_index):
+        with self.lock:
+            self.verifying.discard(piece_index)
+
+    def pick(self):
+        with self.lock:
+            if self.streaming:
+                index = self._get_deadline_piece()
+                if index is not None:
+                    return index
+            return self._get_rarest_piece()
+
+    def _is_candidate(self, piece_index):
+        return (self.file_manager.is_wanted(piece_index)
+                and not self.file_manager.has_piece(piece_index)
+                and piece_index not in self.verifying)
+
+    def _get_deadline_piece(self):
+        """
+        Chọn piece còn thiếu có deadline gần nhất, tức là gần con trỏ đọc nhất
+        trong cửa sổ streaming_window piece phía sau con trỏ.
+        Ngoài cửa sổ thì quay lại rarest-first.
+        """
+        cursor = self.file_manager.read_cursor or 0
+        end = min(cursor + self.streaming_window, self.file_manager.get_total_pieces())
+
+        for piece_index in range(cursor, end):
+            if piece_index in self.piece_frequencies and self._is_candidate(piece_index):
+                return piece_index
+
+        return None
+
+    def _get_rarest_piece(self):
+        """
+        Tìm ra piece hiếm nhất dựa trên tần suất xuất hiện trong các bitfield.
+        Piece thuộc file có độ ưu tiên cao được chọn trước, piece của file bị SKIP thì bỏ qua.
+        """
+        rarest_piece = None
+        best_key = None
+
+        for piece_index, frequency in self.piece_frequencies.items():
+            if not self._is_candidate(piece_index):
+                continue
+            priority = self.file_manager.get_piece_priority(piece_index)
+            key = (-priority, frequency)
+            if best_key is None or key < best_key:
+                best_key = key
+                rarest_piece = piece_index
+
+        return rarest_piece
@@ -0,0 +1,252 @@
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from ContentIndex import ContentIndex
+from DiskIO import DiskIOPool, DEFAULT_WORKERS, DEFAULT_MAX_QUEUE
+from HashCache import HashCache
+from LocalDiscovery import LocalDiscovery
+
+HANDSHAKE_LENGTH = 68  # <pstrlen=19><pstr 19 bytes><reserved 8><info_hash 20><peer_id 20>
+HANDSHAKE_TIMEOUT = 10
+MIN_CONNECTIONS_PER_TORRENT = 4
+DEFAULT_HASH_CACHE_PATH = os.path.join('Torrents', '.hashcache')
+
+"""
+Session dùng chung cho tất cả các torrent của một User:
+một cổng lắng nghe, bộ giới hạn tốc độ, pool I/O đĩa, ngân sách kết nối, local peer discovery
+và chỉ mục nội dung (dùng lại piece/file giống nhau giữa các torrent) chung.
+"""
+
+
+class RateLimiter:
+    """
+    Token bucket giới hạn số byte/giây, dùng chung giữa các PeerHandler.
+    rate = 0 nghĩa là không giới hạn.
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def consume(self, amount):
+        """Chặn cho tới khi được phép truyền `amount` byte."""
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                # Cho phép nợ token để block lớn hơn rate vẫn đi qua được
+                if self.tokens > 0:
+                    self.tokens -= amount
+                    return
+                wait = -self.tokens / self.rate
+            time.sleep(min(wait, 1))
+
+
+class Session:
+    def __init__(self, ip=None, port=0, max_connections=200, max_upload_speed=0, max_download_speed=0,
+                 disk_workers=DEFAULT_WORKERS, max_disk_queue=DEFAULT_MAX_QUEUE,
+                 local_discovery=True, lsd_interface='0.0.0.0', hash_cache_path=DEFAULT_HASH_CACHE_PATH):
+        self.ip = ip or socket.gethostbyname(socket.gethostname())
+        self.port = port
+
+        self.torrents = {}  # info_hash -> Peer
+        self.lock = threading.Lock()
+
+        self.upload_limiter = RateLimiter(max_upload_speed)
+        self.download_limiter = RateLimiter(max_download_speed)
+
+        # Pool I/O đĩa dùng chung cho hash/đọc/export của mọi torrent
+        self.disk_io = DiskIOPool(disk_workers, max_disk_queue)
+
+        # Piece và file đã có của mọi torrent, để torrent mới không phải hash lại hay tải lại
+        self.content_index = ContentIndex()
+        # Hash piece của các lần share trước, lưu ra đĩa (None: chỉ giữ trong bộ nhớ)
+        self.hash_cache = HashCache(hash_cache_path)
+
+        # Ngân sách kết nối chung, chia đều cho các torrent đang chạy
+        self.max_connections = max_connections
+        self.connections = {}  # info_hash -> số kết nối đang mở
+
+        # Tìm peer trong LAN qua multicast (BEP 14), tạo khi start vì cần cổng lắng nghe thật
+        self.local_discovery_enabled = local_discovery
+        self.lsd_interface = lsd_interface
+        self.local_discovery = None
+
+        self.is_running = False
+        self.server_socket = None
+        self.listen_thread = None
+
+    def start(self):
+        """Bind cổng lắng nghe duy nhất của session và chạy vòng accept."""
+        if self.is_running:
+            return
+        # Pool đĩa không tự khởi động lại sau stop(): session chạy lại thì bật lại pool
+        self.disk_io.start()
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.server_socket.bind(('0.0.0.0', self.port))
+        except OSError:
+            # Cổng trong settings đã bị chiếm, để hệ điều hành chọn cổng khác
+            self.server_socket.bind(('0.0.0.0', 0))
+        self.port = self.server_socket.getsockname()[1]
+        self.server_socket.listen(128)
+        self.server_socket.setblocking(False)
+
+        self.is_running = True
+        self.listen_thread = threading.Thread(target=self.listen, daemon=True)
+        self.listen_thread.start()
+        print(f"Session listening on {self.ip}:{self.port}")
+
+        if self.local_discovery_enabled:
+            self.local_discovery = LocalDiscovery(self.port, self.on_local_peer, self.lsd_interface)
+            if not self.local_discovery.start():
+                self.local_discovery = None
+
+    def stop(self):
+        self.is_running = False
+        if self.listen_thread:
+            self.listen_thread.join()
+            self.listen_thread = None
+        if self.local_discovery:
+            self.local_discovery.stop()
+            self.local_discovery = None
+        self.disk_io.stop()
+
+    def add_torrent(self, peer):
+        with self.lock:
+            self.torrents[peer.info_hash] = peer
+            self.connections.setdefault(peer.info_hash, 0)
+        if self.local_discovery:
+            self.local_discovery.add(peer.info_hash)
+
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            self.torrents.pop(info_hash, None)
+            self.connections.pop(info_hash, None)
+        if self.local_discovery:
+            self.local_discovery.remove(info_hash)
+
+    def on_local_peer(self, info_hash, addr):
+        """LocalDiscovery nghe thấy peer trong LAN có cùng torrent."""
+        peer = self.get_torrent(info_hash)
+        if peer:
+            peer.add_local_peer(addr)
+
+    def get_torrent(self, info_hash):
+        with self.lock:
+            return self.torrents.get(info_hash)
+
+    def connection_quota(self, info_hash):
+        """
+        Số kết nối tối đa mà một torrent được dùng: phần chia đều của ngân sách,
+        cộng thêm phần các torrent khác đang không dùng tới.
+        """
+        active = max(len(self.torrents), 1)
+        fair_share = max(MIN_CONNECTIONS_PER_TORRENT, self.max_connections // active)
+        unused = self.max_connections - sum(self.connections.values())
+        return max(fair_share, self.connections.get(info_hash, 0) + unused)
+
+    def acquire_connection(self, info_hash):
+        with self.lock:
+            used = self.connections.get(info_hash, 0)
+            if sum(self.connections.values()) >= self.max_connections:
+                return False
+            if used >= self.connection_quota(info_hash):
+                return False
+            self.connections[info_hash] = used + 1
+            return True
+
+    def release_connection(self, info_hash):
+        with self.lock:
+            if self.connections.get(info_hash, 0) > 0:
+                self.connections[info_hash] -= 1
+
+    def listen(self):
+        """
+        Một vòng lặp duy nhất nhận kết nối cho mọi torrent.
+        Handshake được đọc không chặn, sau đó chuyển kết nối cho Peer có info_hash tương ứng.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ, data=None)
+        pending = {}  # socket -> (addr, buffer, deadline)
+
+        while self.is_running:
+            for key, _ in selector.select(timeout=1):
+                if key.data is None:
+                    self._accept(selector, pending)
+                else:
+                    self._read_handshake(selector, pending, key.fileobj)
+
+            # Đóng các kết nối không gửi handshake kịp
+            now = time.monotonic()
+            for conn in [c for c, (_, _, deadline) in pending.items() if deadline < now]:
+                selector.unregister(conn)
+                pending.pop(conn)
+                conn.close()
+
+        for conn in pending:
+            conn.close()
+        selector.close()
+        self.server_socket.close()
+
+    def _accept(self, selector, pending):
+        try:
+            conn, addr = self.server_socket.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        pending[conn] = (addr, b'', time.monotonic() + HANDSHAKE_TIMEOUT)
+        selector.register(conn, selectors.EVENT_READ, data=addr)
+
+    def _read_handshake(self, selector, pending, conn):
+        addr, buffer, deadline = pending[conn]
+        try:
+            data = conn.recv(HANDSHAKE_LENGTH - len(buffer))
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            selector.unregister(conn)
+            pending.pop(conn)
+            conn.close()
+            return
+
+        buffer += data
+        if len(buffer) < HANDSHAKE_LENGTH:
+            pending[conn] = (addr, buffer, deadline)
+            return
+
+        selector.unregister(conn)
+        pending.pop(conn)
+        conn.setblocking(True)
+        self.dispatch(conn, addr, buffer)
+
+    def dispatch(self, conn, addr, handshake):
+        """Chuyển kết nối tới torrent dựa trên info_hash trong handshake."""
+        pstrlen = struct.unpack("B", handshake[0:1])[0]
+        info_hash = handshake[1 + pstrlen + 8:1 + pstrlen + 8 + 20]
+
+        peer = self.get_torrent(info_hash)
+        if peer is None or not self.acquire_connection(info_hash):
+            print(f"Rejecting connection from {addr}: unknown torrent or connection limit reached")
+            conn.close()
+            return
+
+        peer.accept_connection(conn, addr, handshake)
@@ -0,0 +1,381 @@
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+SNAPSHOT_MAGIC = b'TRKS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('>4sBd')       # magic, version, thời điểm ghi (wall clock)
+SNAPSHOT_SWARM = struct.Struct('>QI')          # downloaded, số peer
+SNAPSHOT_PEER = struct.Struct('>HQQQ?f')       # port, uploaded, downloaded, left, completed, tuổi (giây)
+
+"""
+Registry các swarm của tracker: mỗi info_hash có một Swarm, trong đó peer được
+đánh chỉ mục theo peer_id và chia thành tập seeder / leecher.
+Mọi thao tác thêm/cập nhật/xoá đều O(1) và được bảo vệ bởi một lock.
+"""
+
+
+class IndexedSet:
+    """Tập hợp hỗ trợ add/remove O(1) và lấy mẫu ngẫu nhiên O(k) (list + chỉ mục vị trí)."""
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def add(self, item):
+        if item in self.positions:
+            return
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def remove(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        # Đưa phần tử cuối vào chỗ trống để không phải dịch list
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def sample(self, k):
+        if k >= len(self.items):
+            return list(self.items)
+        return random.sample(self.items, k)
+
+
+def encode_compact_peer(ip: str, port) -> Optional[bytes]:
+    """Địa chỉ peer dạng compact: 4 byte IPv4 (hoặc 16 byte IPv6) + 2 byte port, big-endian."""
+    try:
+        port_bytes = struct.pack('>H', int(port))
+    except (ValueError, struct.error):
+        return None
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip) + port_bytes
+        except (OSError, TypeError):
+            continue
+    return None
+
+
+class PeerRecord:
+    __slots__ = ('peer_id', 'ip', 'port', 'uploaded', 'downloaded', 'left', 'completed', 'last_seen', 'compact')
+
+    def __init__(self, peer_id: str, ip: str, port: str):
+        self.peer_id = peer_id
+        self.ip = ip
+        self.port = port
+        self.compact = encode_compact_peer(ip, port)
+        self.uploaded = 0
+        self.downloaded = 0
+        self.left = 0
+        self.completed = False
+        self.last_seen = 0.0
+
+    def is_seeder(self) -> bool:
+        return self.completed or self.left == 0
+
+    def to_dict(self) -> Dict[str, str]:
+        return {'peer_id': self.peer_id, 'ip': self.ip, 'port': self.port}
+
+
+class Swarm:
+    def __init__(self):
+        self.peers: Dict[str, PeerRecord] = {}
+        self.seeders = IndexedSet()
+        self.leechers = IndexedSet()
+        self.downloaded = 0  # Số lần peer báo COMPLETED
+
+    @property
+    def complete(self) -> int:
+        return len(self.seeders)
+
+    @property
+    def incomplete(self) -> int:
+        return len(self.leechers)
+
+    def __len__(self):
+        return len(self.peers)
+
+    def upsert(self, peer_id: str, ip: str, port: str) -> PeerRecord:
+        record = self.peers.get(peer_id)
+        if record is None:
+            record = PeerRecord(peer_id, ip, port)
+            self.peers[peer_id] = record
+        elif record.ip != ip or record.port != port:
+            record.ip = ip
+            record.port = port
+            record.compact = encode_compact_peer(ip, port)
+        return record
+
+    def classify(self, record: PeerRecord):
+        """Đặt peer vào đúng tập seeder hoặc leecher theo trạng thái hiện tại."""
+        if record.is_seeder():
+            self.leechers.remove(record.peer_id)
+            self.seeders.add(record.peer_id)
+        else:
+            self.seeders.remove(record.peer_id)
+            self.leechers.add(record.peer_id)
+
+    def remove(self, peer_id: str) -> Optional[PeerRecord]:
+        record = self.peers.pop(peer_id, None)
+        if record is not None:
+            self.seeders.remove(peer_id)
+            self.leechers.remove(peer_id)
+        return record
+
+
+class SwarmRegistry:
+    def __init__(self):
+        self.swarms: Dict[str, Swarm] = {}
+        self.lock = threading.RLock()
+        # (info_hash, peer_id) theo thứ tự last_seen tăng dần: peer vừa announce được đưa về cuối,
+        # nên peer hết hạn luôn nằm ở đầu và reap() chỉ cần cắt phần đầu (O(1) khấu hao)
+        self.expiry: OrderedDict = OrderedDict()
+
+    def add_peer(self, info_hash: str, peer_id: str, ip: str, port: str,
+                 uploaded: int = 0, downloaded: int = 0, left: int = 0) -> PeerRecord:
+        """Thêm peer hoặc cập nhật peer đã có (announce STARTED lặp lại không tạo bản ghi trùng)."""
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            if swarm is None:
+                swarm = self.swarms[info_hash] = Swarm()
+            record = swarm.upsert(peer_id, ip, port)
+            record.uploaded = uploaded
+            record.downloaded = downloaded
+            record.left = left
+            swarm.classify(record)
+            self.touch(info_hash, record)
+            return record
+
+    def touch(self, info_hash: str, record: PeerRecord, now: Optional[float] = None):
+        record.last_seen = time.monotonic() if now is None else now
+        key = (info_hash, record.peer_id)
+        self.expiry[key] = record.last_seen
+        self.expiry.move_to_end(key)
+
+    def reap(self, timeout: float, now: Optional[float] = None) -> int:
+        """Xoá các peer không announce trong `timeout` giây, trả về số peer đã xoá."""
+        now = time.monotonic() if now is None else now
+        removed = 0
+        with self.lock:
+            while self.expiry:
+                (info_hash, peer_id), last_seen = next(iter(self.expiry.items()))
+                if now - last_seen < timeout:
+                    break
+                self.remove_peer(info_hash, peer_id)
+                removed += 1
+        return removed
+
+    def remove_peer(self, info_hash: str, peer_id: str) -> Optional[PeerRecord]:
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            if swarm is None:
+                return None
+            record = swarm.remove(peer_id)
+            self.expiry.pop((info_hash, peer_id), None)
+            # Giữ swarm rỗng nếu còn số liệu 'downloaded' cho scrape
+            if not swarm.peers and not swarm.downloaded:
+                del self.swarms[info_hash]
+            return record
+
+    def update_peer(self, info_hash: str, peer_id: str, completed: bool = False) -> Optional[PeerRecord]:
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            record = swarm.peers.get(peer_id) if swarm else None
+            if record is None:
+                return None
+            if completed and not record.completed:
+                swarm.downloaded += 1
+                record.left = 0
+            record.completed = completed
+            swarm.classify(record)
+            return record
+
+    def get_peer(self, info_hash: str, peer_id: str) -> Optional[PeerRecord]:
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            return swarm.peers.get(peer_id) if swarm else None
+
+    def get_peers(self, info_hash: str) -> List[Dict[str, str]]:
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            if swarm is None:
+                return []
+            return [record.to_dict() for record in swarm.peers.values()]
+
+    def sample_peers(self, info_hash: str, numwant: int, requester_id: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Lấy ngẫu nhiên tối đa `numwant` peer, không gồm chính người hỏi.
+        Leecher được ưu tiên trả về seeder, seeder được ưu tiên trả về leecher.
+        Chi phí O(numwant), không phụ thuộc kích thước swarm.
+        """
+        return [record.to_dict() for record in self.sample_records(info_hash, numwant, requester_id)]
+
+    def sample_compact_peers(self, info_hash: str, numwant: int, requester_id: Optional[str] = None):
+        """
+        Như sample_peers nhưng trả về (peers, peers6) dạng compact: 6 byte mỗi peer IPv4, 18 byte mỗi peer IPv6.
+        Chuỗi compact của từng peer được tính sẵn khi peer announce, ở đây chỉ việc nối lại.
+        """
+        peers, peers6 = [], []
+        for record in self.sample_records(info_hash, numwant, requester_id):
+            if record.compact is None:
+                continue
+            (peers if len(record.compact) == 6 else peers6).append(record.compact)
+        return b''.join(peers), b''.join(peers6)
+
+    def sample_records(self, info_hash: str, numwant: int, requester_id: Optional[str] = None) -> List[PeerRecord]:
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            if swarm is None or numwant <= 0:
+                return []
+
+            requester = swarm.peers.get(requester_id) if requester_id else None
+            if requester is not None and requester.is_seeder():
+                preferred, others = swarm.leechers, swarm.seeders
+            else:
+                preferred, others = swarm.seeders, swarm.leechers
+
+            result = []
+            for group in (preferred, others):
+                needed = numwant - len(result)
+                if needed <= 0:
+                    break
+                # Lấy dư một phần tử phòng trường hợp trúng chính người hỏi
+                for peer_id in group.sample(needed + 1):
+                    if peer_id != requester_id and len(result) < numwant:
+                        result.append(swarm.peers[peer_id])
+            return result
+
+    def get_stats(self, info_hash: str) -> Dict[str, int]:
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            if swarm is None:
+                return {'complete': 0, 'incomplete': 0, 'downloaded': 0}
+            return {'complete': swarm.complete, 'incomplete': swarm.incomplete, 'downloaded': swarm.downloaded}
+
+    def get_all_stats(self) -> Dict[str, Dict[str, int]]:
+        """Số liệu của mọi swarm (dùng cho full scrape), O(số swarm)."""
+        with self.lock:
+            return {info_hash: {'complete': swarm.complete, 'incomplete': swarm.incomplete,
+                                'downloaded': swarm.downloaded}
+                    for info_hash, swarm in self.swarms.items()}
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(swarm) for swarm in self.swarms.values())
+
+    def snapshot(self):
+        """
+        Chụp trạng thái registry thành list tuple thuần. Chỉ phần copy này giữ lock,
+        việc mã hoá và ghi file được làm sau đó nên không chặn announce.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [(info_hash, swarm.downloaded,
+                     [(r.peer_id, r.ip, r.port, r.uploaded, r.downloaded, r.left, r.completed, now - r.last_seen)
+                      for r in swarm.peers.values()])
+                    for info_hash, swarm in self.swarms.items()]
+
+    def save_snapshot(self, path: str) -> int:
+        """Ghi snapshot ra file (ghi file tạm rồi os.replace để không bao giờ để lại file dở dang)."""
+        swarms = self.snapshot()
+        chunks = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time()), struct.pack('>I', len(swarms))]
+        saved = 0
+        for info_hash, downloaded, peers in swarms:
+            # Bỏ qua peer có port không hợp lệ (client HTTP gửi tuỳ ý)
+            peers = [peer for peer in peers if str(peer[2]).isdigit() and int(peer[2]) <= 0xFFFF]
+            saved += len(peers)
+            chunks.append(_pack_str(info_hash))
+            chunks.append(SNAPSHOT_SWARM.pack(downloaded, len(peers)))
+            for peer_id, ip, port, uploaded, peer_downloaded, left, completed, age in peers:
+                chunks.append(_pack_str(peer_id))
+                chunks.append(_pack_str(ip))
+                chunks.append(SNAPSHOT_PEER.pack(int(port), uploaded, peer_downloaded, left, completed, age))
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return saved
+
+    def load_snapshot(self, path: str, timeout: float) -> int:
+        """
+        Nạp snapshot lúc khởi động. Tuổi của peer được cộng thêm thời gian tracker đã tắt,
+        peer đã quá `timeout` bị bỏ qua, peer còn lại giữ nguyên thời hạn còn lại của nó.
+        """
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+
+        magic, version, saved_at = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot format in {path}")
+        downtime = max(0.0, time.time() - saved_at)
+        offset = SNAPSHOT_HEADER.size
+        (swarm_count,) = struct.unpack_from('>I', data, offset)
+        offset += 4
+
+        now = time.monotonic()
+        restored = []
+        for _ in range(swarm_count):
+            info_hash, offset = _unpack_str(data, offset)
+            downloaded, peer_count = SNAPSHOT_SWARM.unpack_from(data, offset)
+            offset += SNAPSHOT_SWARM.size
+            for _ in range(peer_count):
+                peer_id, offset = _unpack_str(data, offset)
+                ip, offset = _unpack_str(data, offset)
+                port, uploaded, peer_downloaded, left, completed, age = SNAPSHOT_PEER.unpack_from(data, offset)
+                offset += SNAPSHOT_PEER.size
+                age += downtime
+                if age < timeout:
+                    restored.append((now - age, info_hash, peer_id, ip, str(port),
+                                     uploaded, peer_downloaded, left, completed))
+            if downloaded:
+                restored.append((None, info_hash, downloaded))
+
+        # Nạp theo last_seen tăng dần để giữ đúng thứ tự của hàng đợi hết hạn
+        restored.sort(key=lambda item: item[0] if item[0] is not None else float('-inf'))
+        with self.lock:
+            for item in restored:
+                if item[0] is None:
+                    _, info_hash, downloaded = item
+                    swarm = self.swarms.setdefault(info_hash, Swarm())
+                    swarm.downloaded = downloaded
+                    continue
+                last_seen, info_hash, peer_id, ip, port, uploaded, peer_downloaded, left, completed = item
+                swarm = self.swarms.setdefault(info_hash, Swarm())
+                record = swarm.upsert(peer_id, ip, port)
+                record.uploaded = uploaded
+                record.downloaded = peer_downloaded
+                record.left = left
+                record.completed = completed
+                swarm.classify(record)
+                self.touch(info_hash, record, now=last_seen)
+        return sum(1 for item in restored if item[0] is not None)
+
+
+def _pack_str(value: str) -> bytes:
+    # info_hash / peer_id là chuỗi latin-1 của byte thô nên mã hoá lại bằng latin-1
+    raw = value.encode('latin-1', 'replace')[:0xFF]
+    return struct.pack('>B', len(raw)) + raw
+
+
+def _unpack_str(data, offset: int):
+    length = data[offset]
+    offset += 1
+    return bytes(data[offset:offset + length]).decode('latin-1'), offset + length
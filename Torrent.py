@@ -0,0 +1,153 @@
+import binascii
+import hashlib
+import os
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+import Bencode
+import MerkleTree
+from TorrentUtils import TorrentUtils
+
+PIECE_HASH_HEX_LENGTH = 40   # info[b'pieces'] lưu SHA-1 của mỗi piece dạng hex
+MAX_CACHED_TORRENTS = 1024
+
+"""
+Metadata của một torrent, được dựng một lần từ một lần đọc file .torrent (hoặc từ magnet link,
+khi đó info dict được bổ sung sau qua ut_metadata). Peer và FileManager dùng chung object này
+thay vì tự parse lại file hay magnet link.
+"""
+
+
+class PieceHashes:
+    """View trên info[b'pieces']: chỉ giải mã hash của piece khi được hỏi tới."""
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def __len__(self):
+        return len(self.pieces) // PIECE_HASH_HEX_LENGTH
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Piece index {index} out of range")
+        start = index * PIECE_HASH_HEX_LENGTH
+        return binascii.unhexlify(self.pieces[start:start + PIECE_HASH_HEX_LENGTH])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class PieceLayer:
+    """View trên info[b'x-piece layer'] (key riêng, không phải BEP 52): gốc Merkle SHA-256 32 byte của từng piece."""
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __len__(self):
+        return len(self.layer) // MerkleTree.HASH_SIZE
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(f"Piece index {index} out of range")
+        start = index * MerkleTree.HASH_SIZE
+        return bytes(self.layer[start:start + MerkleTree.HASH_SIZE])
+
+
+class Torrent:
+    # Cache các file .torrent đã parse: đường dẫn -> (mtime_ns, size, Torrent)
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, info_hash, name='', length=None, tiers=None, info_bytes=None, info=None):
+        self.info_hash = info_hash
+        self.name = name
+        self.length = length
+        # Danh sách tier tracker (BEP 12)
+        self.tiers = tiers or []
+
+        # Các trường dưới đây chỉ có khi đã có info dict
+        self.info_bytes = None
+        self.info = None
+        self.piece_length = None
+        self.piece_hashes = None
+        self.piece_layer = None   # Chỉ có với torrent do client này tạo (key 'x-piece layer')
+        self.files = []
+        if info_bytes is not None:
+            self.set_info(info_bytes, info)
+
+    def __repr__(self):
+        return f"Torrent({self.info_hash.hex()}, {self.name!r})"
+
+    @property
+    def trackers(self):
+        return [tracker for tier in self.tiers for tracker in tier]
+
+    def has_info(self):
+        return self.info is not None
+
+    def has_piece_layer(self):
+        return self.piece_layer is not None
+
+    def set_info(self, info_bytes, info=None):
+        """Gắn info dict (byte gốc, đã khớp info_hash), `info` là bản đã decode nếu có sẵn."""
+        info = Bencode.decode(info_bytes) if info is None else info
+        self.info_bytes = info_bytes
+        self.info = info
+        self.name = info[b'name'].decode('utf-8')
+        self.piece_length = info[b'pieceLength']
+        self.piece_hashes = PieceHashes(info[b'pieces'])
+        layer = info.get(b'x-piece layer')
+        if layer is not None and len(layer) == len(self.piece_hashes) * MerkleTree.HASH_SIZE:
+            self.piece_layer = PieceLayer(layer)
+        # 'pieces_root' (key riêng 'x-pieces root') nhận diện nội dung file, file giống nhau ở các torrent khác nhau có cùng root
+        if b'files' in info:
+            self.files = [{'file': '/'.join(part.decode() for part in file[b'path']), 'length': file[b'length'],
+                           'pieces_root': file.get(b'x-pieces root')}
+                          for file in info[b'files']]
+        else:
+            self.files = [{'file': self.name, 'length': info[b'length'], 'pieces_root': info.get(b'x-pieces root')}]
+        self.length = info.get(b'length', sum(file['length'] for file in self.files))
+
+    @classmethod
+    def from_bytes(cls, data):
+        metadata, info_bytes = Bencode.decode_torrent(data)
+        return cls(hashlib.sha1(info_bytes).digest(), tiers=TorrentUtils.get_tracker_tiers(metadata),
+                   info_bytes=info_bytes, info=metadata[b'info'])
+
+    @classmethod
+    def from_file(cls, path):
+        """Đọc file .torrent, dùng lại kết quả đã parse nếu file chưa thay đổi (cùng mtime và kích thước)."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with cls._cache_lock:
+            cached = cls._cache.get(path)
+            if cached and cached[0] == key:
+                cls._cache.move_to_end(path)
+                return cached[1]
+
+        with open(path, 'rb') as file:
+            torrent = cls.from_bytes(file.read())
+
+        with cls._cache_lock:
+            cls._cache[path] = (key, torrent)
+            cls._cache.move_to_end(path)
+            while len(cls._cache) > MAX_CACHED_TORRENTS:
+                cls._cache.popitem(last=False)
+        return torrent
+
+    @classmethod
+    def from_magnet(cls, magnet_link):
+        """Torrent chưa có info dict, chỉ có info_hash, tên, kích thước (nếu có) và tracker."""
+        info = TorrentUtils.get_info_from_magnet(magnet_link)
+        return cls(info['info_hash'], info['name'], info['length'], info['tiers'])
+
+    def get_magnet_link(self):
+        link = 'magnet:?xt=urn:btih:' + self.info_hash.hex() + '&dn=' + urllib.parse.quote(self.name)
+        for tracker in self.trackers:
+            link += '&tr=' + urllib.parse.quote(tracker)
+        if self.length is not None:
+            link += '&xl=' + str(self.length)
+        return link
@@ -1,15 +1,16 @@
-import bencodepy
 import hashlib
 import base64
 import urllib.parse
 
+import Bencode
+
 
 class TorrentUtils:
 
     @staticmethod
     def get_info_from_file(torrent_file):
         with open(torrent_file, 'rb') as file:
-            torrent_content = bencodepy.decode(file.read())
+            torrent_content = Bencode.decode(file.read())
         return torrent_content
 
     @staticmethod
@@ -25,17 +26,32 @@ class TorrentUtils:
         # Trích xuất từng thông tin
         info_hash = bytes.fromhex(params.get('xt', [''])[0].split(':')[-1])  # Thông tin hash
         name = params.get('dn', [''])[0]  # Tên file/torrent
-        length = int(params.get('xl', [''])[0])  # Kích thước file
+        length = params.get('xl', [''])[0]  # Kích thước file (không bắt buộc)
         trackers = params.get('tr', [])  # Danh sách trackers
 
-        # Đưa ra các thông tin đã trích xuất
+        # Đưa ra các thông tin đã trích xuất. Magnet không có tier nên các tracker 'tr'
+        # được xem là một tier, thử lần lượt theo thứ tự xuất hiện
         return {
             "info_hash": info_hash,
             "name": name,
             "length": int(length) if length else None,
-            "trackers": trackers
+            "trackers": trackers,
+            "tiers": [trackers] if trackers else []
         }
 
+    @staticmethod
+    def is_magnet(link):
+        return link.startswith('magnet:')
+
+    @staticmethod
+    def get_tracker_tiers(metadata):
+        """Danh sách tier tracker theo announce-list (BEP 12), nếu không có thì dùng announce."""
+        announce_list = metadata.get(b'announce-list')
+        if announce_list:
+            return [[tracker.decode() for tracker in tier] for tier in announce_list if tier]
+        announce = metadata.get(b'announce')
+        return [[announce.decode()]] if announce else []
+
     @staticmethod
     def create_torrent_file(encoded_data, file_path):
 
@@ -55,8 +71,15 @@ class TorrentUtils:
         :param bencode_data: bencoded torrent file data
         :return: magnet_link
         """
-        # Decode the bencoded data
-        metadata = bencodepy.decode(bencode_data)
+        metadata, info_bytes = Bencode.decode_torrent(bencode_data)
+        return TorrentUtils.make_magnet(metadata, info_bytes)
+
+    @staticmethod
+    def make_magnet(metadata, info_bytes):
+        """
+        Create magnet link from decoded torrent metadata.
+        :param info_bytes: raw bytes of the info dict, hashed as-is
+        """
         subj = metadata[b'info']
         
         # If torrent is a directory, 'files' will exist instead of 'length'
@@ -67,9 +90,8 @@ class TorrentUtils:
             # If it's not a directory, use the 'length' of the single file
             total_length = subj[b'length']
 
-        # Encode the 'info' part and generate the SHA-1 hash
-        hash_contents = bencodepy.encode(subj)
-        info_hash = hashlib.sha1(hash_contents).digest()
+        # info_hash là SHA-1 của đúng các byte info dict trong file, không encode lại
+        info_hash = hashlib.sha1(info_bytes).digest()
         print(f"info_hash from magnet: {info_hash}")
         info_hash_hex = info_hash.hex()
 
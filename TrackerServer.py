@@ -1,49 +1,419 @@
 import socket
+import selectors
+import struct
+import time
 import json
+import hmac
+import hashlib
+import os
+import random
 from urllib.parse import urlparse, parse_qs
 from typing import Dict, List, Optional
 import uuid
 import threading
+
+import Bencode
+
+from SwarmRegistry import SwarmRegistry
+from TrackerShards import ShardChannel
+
+MAX_CONNECTIONS = 1024          # Số kết nối đồng thời tối đa, vượt quá sẽ trả về 503
+MAX_REQUEST_SIZE = 16384        # Kích thước tối đa của phần header một request
+MAX_BODY_SIZE = 65536           # Tracker chỉ nhận GET, body lớn hơn mức này bị từ chối (413)
+KEEP_ALIVE_TIMEOUT = 15         # Đóng kết nối keep-alive không hoạt động sau số giây này
+MAX_REQUESTS_PER_CONNECTION = 1000
+
+ANNOUNCE_INTERVAL = 120         # Khoảng thời gian client nên announce lại (giây)
+MIN_ANNOUNCE_INTERVAL = 30      # Client không được announce dày hơn mức này
+ANNOUNCE_JITTER = 0.1           # Interval trả về dao động ±10% để các client không announce cùng lúc
+PEER_TIMEOUT = ANNOUNCE_INTERVAL * 2 + 30  # Peer không announce quá lâu bị coi là đã chết
+REAP_PERIOD = 10
+
+DEFAULT_NUMWANT = 50            # Số peer trả về mặc định trong một announce
+MAX_NUMWANT = 200
+
+MAX_SCRAPE_HASHES = 1000        # Số info_hash tối đa trong một scrape request
+FULL_SCRAPE_INTERVAL = 60       # Full scrape (không có info_hash) được cache và làm mới theo chu kỳ này
+SNAPSHOT_INTERVAL = 30          # Chu kỳ ghi snapshot registry ra đĩa (nếu có snapshot_path)
+
+# UDP tracker protocol (BEP 15)
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_ACTION_CONNECT = 0
+UDP_ACTION_ANNOUNCE = 1
+UDP_ACTION_SCRAPE = 2
+UDP_ACTION_ERROR = 3
+UDP_EVENTS = {0: '', 1: 'COMPLETED', 2: 'STARTED', 3: 'STOPPED'}
+UDP_CONNECTION_ID_LIFETIME = 60  # Connection ID hợp lệ trong bucket hiện tại và bucket trước (~2 phút)
+UDP_MAX_SCRAPE_HASHES = 74       # Giới hạn của BEP 15 để response vừa một gói tin
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+                431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class Connection:
+    """Trạng thái của một kết nối HTTP trong vòng lặp selector."""
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        self.last_active = time.monotonic()
+        self.requests = 0
+        self.close_after_write = False
+
+
 class TrackerServer:
-    def __init__(self, host: str = 'localhost', port: int = 5050):
+    def __init__(self, host: str = 'localhost', port: int = 5050, max_connections: int = MAX_CONNECTIONS,
+                 verbose: bool = False, snapshot_path: Optional[str] = None,
+                 shards: Optional[ShardChannel] = None, udp_secret: Optional[bytes] = None,
+                 tracker_id: Optional[str] = None):
         self.host = host
         self.port = port
-        self.peers: Dict[str, List[Dict[str, str]]] = {}  # {info_hash: [peer_info, ...]}
-        self.tracker_id = str(uuid.uuid4())
+        self.registry = SwarmRegistry()  # {info_hash: Swarm}, đánh chỉ mục theo peer_id
+        self.tracker_id = tracker_id or str(uuid.uuid4())
+
+        self.max_connections = max_connections
+        self.verbose = verbose
+        self.connections: Dict[socket.socket, Connection] = {}
+        self.selector = None
+        self.is_running = False
+
+        self.announce_interval = ANNOUNCE_INTERVAL
+        self.min_announce_interval = MIN_ANNOUNCE_INTERVAL
+        self.peer_timeout = PEER_TIMEOUT
+        self.reaper_thread = None
+
+        # Chế độ nhiều process: registry chỉ chứa các swarm thuộc shard của worker này
+        self.shards = shards
+        self.background_shards = None
+        if shards is not None:
+            # Kênh riêng cho thread nền (full scrape) để không tranh socket với vòng selector
+            self.background_shards = ShardChannel(shards.cluster_id, shards.index, shards.num_shards, suffix='-bg')
+            if snapshot_path:
+                snapshot_path = f"{snapshot_path}.{shards.index}"
+
+        # Snapshot registry để khởi động lại không làm mất swarm
+        self.snapshot_path = snapshot_path
+        self.snapshot_time = 0.0
+        self.snapshot_lock = threading.Lock()
+
+        self.full_scrape_cache = None
+        self.full_scrape_time = 0.0
+        self.full_scrape_lock = threading.Lock()
+
+        # Connection ID của UDP được suy ra bằng HMAC nên không cần lưu trạng thái cho từng client
+        self.udp_secret = udp_secret or os.urandom(16)
+        self.udp_socket = None
 
     def start(self):
+        """
+        Một thread duy nhất phục vụ mọi kết nối bằng selectors (không tạo thread cho mỗi kết nối).
+        Hỗ trợ HTTP/1.1 keep-alive và pipelining.
+        """
+        self.load_snapshot()
+        self.selector = selectors.DefaultSelector()
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.shards is not None:
+                # Các worker cùng bind một cổng, kernel chia đều kết nối giữa chúng
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             s.bind(('0.0.0.0', self.port))
-            s.listen()
-            print(f"Tracker server listening on {self.host}:{self.port}")
-            while True:
-                conn, addr = s.accept()
-                """ with conn: """
+            s.listen(1024)
+            s.setblocking(False)
+            self.selector.register(s, selectors.EVENT_READ, data=None)
+
+            # UDP tracker dùng chung số cổng với HTTP
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.shards is not None:
+                self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.bind(('0.0.0.0', self.port))
+            self.udp_socket.setblocking(False)
+            self.selector.register(self.udp_socket, selectors.EVENT_READ, data=None)
+            if self.shards is not None:
+                self.selector.register(self.shards.sock, selectors.EVENT_READ, data=None)
+                print(f"Tracker worker {self.shards.index}/{self.shards.num_shards} "
+                      f"listening on {self.host}:{self.port} (TCP/UDP)")
+            else:
+                print(f"Tracker server listening on {self.host}:{self.port} (TCP/UDP)")
+
+            self.is_running = True
+            self.reaper_thread = threading.Thread(target=self.reap_peers, daemon=True)
+            self.reaper_thread.start()
+            last_sweep = time.monotonic()
+            while self.is_running:
+                for key, events in self.selector.select(timeout=1):
+                    if key.fileobj is self.udp_socket:
+                        self.receive_datagrams()
+                    elif self.shards is not None and key.fileobj is self.shards.sock:
+                        self.shards.serve_pending(self.serve_shard)
+                    elif key.data is None:
+                        self.accept_connections(key.fileobj)
+                    else:
+                        self.service_connection(key.data, events)
+
+                now = time.monotonic()
+                if now - last_sweep >= 1:
+                    self.close_idle_connections(now)
+                    last_sweep = now
+
+            for conn in list(self.connections.values()):
+                self.close_connection(conn)
+            self.selector.close()
+            self.udp_socket.close()
+            if self.shards is not None:
+                self.shards.close()
+                self.background_shards.close()
+            self.save_snapshot()
+
+    def stop(self):
+        self.is_running = False
+
+    def reap_peers(self):
+        """Thread nền xoá các peer đã quá PEER_TIMEOUT mà không announce (crash, mất mạng...)."""
+        while self.is_running:
+            time.sleep(REAP_PERIOD)
+            removed = self.registry.reap(self.peer_timeout)
+            if removed and self.verbose:
+                print(f"Reaped {removed} expired peers")
+            if time.monotonic() - self.full_scrape_time >= FULL_SCRAPE_INTERVAL:
+                try:
+                    self.refresh_full_scrape()
+                except OSError as e:
+                    # Shard khác không trả lời hoặc báo lỗi: giữ snapshot cũ, thử lại ở lượt sau
+                    print(f"Error refreshing full scrape: {e}")
+            if time.monotonic() - self.snapshot_time >= SNAPSHOT_INTERVAL:
+                self.save_snapshot()
+
+    def load_snapshot(self):
+        """
+        Nạp lại registry từ snapshot: client không cần announce lại ngay sau khi tracker khởi động lại,
+        peer vẫn hết hạn đúng thời điểm như khi tracker chưa tắt.
+        """
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            restored = self.registry.load_snapshot(self.snapshot_path, self.peer_timeout)
+            print(f"Restored {restored} peers from {self.snapshot_path}")
+        except (OSError, ValueError, struct.error) as e:
+            print(f"Error loading snapshot {self.snapshot_path}: {e}")
+        self.snapshot_time = time.monotonic()
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self.snapshot_lock:
+            try:
+                saved = self.registry.save_snapshot(self.snapshot_path)
+                if self.verbose:
+                    print(f"Saved {saved} peers to {self.snapshot_path}")
+            except OSError as e:
+                print(f"Error saving snapshot {self.snapshot_path}: {e}")
+            self.snapshot_time = time.monotonic()
+
+    def next_announce_interval(self) -> int:
+        jitter = int(self.announce_interval * ANNOUNCE_JITTER)
+        return self.announce_interval + random.randint(-jitter, jitter)
+
+    def refresh_full_scrape(self, background: bool = True) -> str:
+        """Tạo lại snapshot full scrape ngoài luồng xử lý request."""
+        files = {self.encode_info_hash(info_hash): stats
+                 for info_hash, stats in self.get_all_stats(background).items()}
+        body = json.dumps({'tracker_id': self.tracker_id, 'files': files})
+        with self.full_scrape_lock:
+            self.full_scrape_cache = body
+            self.full_scrape_time = time.monotonic()
+        return body
+
+    @staticmethod
+    def encode_info_hash(info_hash: str) -> str:
+        # info_hash là chuỗi latin-1 của 20 byte thô, hex cho dễ đọc trong JSON
+        return info_hash.encode('latin-1').hex()
+
+    def accept_connections(self, server_socket):
+        # Nhận hết các kết nối đang chờ trong backlog
+        while True:
+            try:
+                sock, addr = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+
+            if len(self.connections) >= self.max_connections:
+                # Quá tải: trả lời 503 ngay và đóng, thay vì để client chờ
+                try:
+                    sock.send(self.build_http_response(self.create_error_response("Tracker overloaded"),
+                                                       status=503, keep_alive=False))
+                except OSError:
+                    pass
+                sock.close()
+                continue
+
+            if self.verbose:
                 print(f"Connected by {addr}")
-                threading.Thread(target=self.handle_connection, args=(conn, addr)).start()
-                
-
-    def handle_connection(self, conn, addr):
-        with conn:
-            data = conn.recv(1024).decode('utf-8')
-            print(f"Data received: {data} from {addr}")
-            # Data received
-            response = self.handle_request(data)
-            conn.sendall(response.encode('utf-8'))
-        
-    def handle_request(self, request: str) -> str:
+            conn = Connection(sock, addr)
+            self.connections[sock] = conn
+            self.selector.register(sock, selectors.EVENT_READ, data=conn)
+
+    def service_connection(self, conn: Connection, events):
+        if events & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+
+            if data == b'':
+                self.close_connection(conn)
+                return
+            if data:
+                conn.in_buffer += data
+                conn.last_active = time.monotonic()
+                self.process_requests(conn)
+
+        if events & selectors.EVENT_WRITE or conn.out_buffer:
+            self.flush(conn)
+
+    def process_requests(self, conn: Connection):
+        """Tách và xử lý mọi request hoàn chỉnh đang có trong buffer (hỗ trợ pipelining)."""
+        while not conn.close_after_write:
+            header_end = conn.in_buffer.find(b'\r\n\r\n')
+            if header_end < 0:
+                if len(conn.in_buffer) > MAX_REQUEST_SIZE:
+                    self.queue_response(conn, self.create_error_response("Request too large"), 431, False)
+                return
+
+            header_block = bytes(conn.in_buffer[:header_end]).decode('latin-1')
+            headers = self.parse_headers(header_block)
+            body_length = self.parse_content_length(headers)
+            if body_length is None:
+                self.queue_response(conn, self.create_error_response("Invalid Content-Length"), 400, False)
+                return
+            if body_length > MAX_BODY_SIZE:
+                self.queue_response(conn, self.create_error_response("Request body too large"), 413, False)
+                return
+            request_end = header_end + 4 + body_length
+            if len(conn.in_buffer) < request_end:
+                return
+            del conn.in_buffer[:request_end]
+
+            conn.requests += 1
+            keep_alive = self.wants_keep_alive(header_block, headers) \
+                and conn.requests < MAX_REQUESTS_PER_CONNECTION
+            try:
+                response = self.handle_request(header_block)
+                status = 200
+            except ValueError:
+                response = self.create_error_response("Malformed request")
+                status = 400
+                keep_alive = False
+            except OSError as e:
+                # Shard sở hữu swarm không trả lời kịp hoặc báo lỗi
+                response = self.create_error_response(f"Tracker unavailable: {e}")
+                status = 503
+            except Exception as e:
+                # Không request nào được làm dừng vòng lặp selector
+                print(f"Error handling request from {conn.addr}: {e!r}")
+                response = self.create_error_response("Internal error")
+                status = 500
+                keep_alive = False
+            self.queue_response(conn, response, status, keep_alive)
+
+    @staticmethod
+    def parse_content_length(headers: Dict[str, str]) -> Optional[int]:
+        """Content-Length hợp lệ (số nguyên không âm), None nếu sai định dạng."""
+        value = headers.get('content-length', '').strip()
+        if not value:
+            return 0
+        if not (value.isascii() and value.isdigit()):
+            return None
+        return int(value)
+
+    @staticmethod
+    def parse_headers(header_block: str) -> Dict[str, str]:
+        headers = {}
+        for line in header_block.split('\r\n')[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    @staticmethod
+    def wants_keep_alive(header_block: str, headers: Dict[str, str]) -> bool:
+        connection = headers.get('connection', '').lower()
+        request_line = header_block.split('\r\n', 1)[0]
+        if request_line.endswith('HTTP/1.1'):
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def queue_response(self, conn: Connection, body, status: int, keep_alive: bool):
+        conn.out_buffer += self.build_http_response(body, status, keep_alive)
+        if not keep_alive:
+            conn.close_after_write = True
+        self.flush(conn)
+
+    def flush(self, conn: Connection):
+        if conn.out_buffer:
+            try:
+                sent = conn.sock.send(conn.out_buffer)
+                del conn.out_buffer[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.close_connection(conn)
+                return
+
+        if conn.out_buffer:
+            # Socket đầy: chờ EVENT_WRITE, tạm ngừng đọc để giới hạn bộ nhớ của kết nối
+            self.selector.modify(conn.sock, selectors.EVENT_WRITE, data=conn)
+        elif conn.close_after_write:
+            self.close_connection(conn)
+        else:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, data=conn)
+
+    def close_idle_connections(self, now: float):
+        for conn in [c for c in self.connections.values() if now - c.last_active > KEEP_ALIVE_TIMEOUT]:
+            self.close_connection(conn)
+
+    def close_connection(self, conn: Connection):
+        if self.connections.pop(conn.sock, None) is None:
+            return
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def build_http_response(self, body, status: int = 200, keep_alive: bool = True) -> bytes:
+        # Body là str (JSON) hoặc bytes (bencode)
+        if isinstance(body, bytes):
+            payload, content_type = body, 'text/plain'
+        else:
+            payload, content_type = body.encode('utf-8'), 'application/json'
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        return head.encode('latin-1') + payload
+
+    def handle_request(self, request: str):
         # Split the request into lines
         request_lines = request.split('\r\n')
         
         # Parse the first line to get the method and full path
-        method, full_path, _ = request_lines[0].split(' ')
+        parts = request_lines[0].split(' ')
+        if len(parts) != 3:
+            raise ValueError(f"Malformed request line: {request_lines[0]!r}")
+        method, full_path, _ = parts
         
         if method != 'GET':
             return self.create_error_response("Only GET requests are supported")
         
         # Parse the URL and query parameters
         parsed_url = urlparse(full_path)
-        params = parse_qs(parsed_url.query)
+        # latin-1 giữ nguyên từng byte của info_hash (utf-8 sẽ thay byte lạ bằng U+FFFD)
+        params = parse_qs(parsed_url.query, encoding='latin-1')
         request_type = parsed_url.path
 
         info_hash = params.get('info_hash', [None])[0]
@@ -54,66 +424,276 @@ class TrackerServer:
             ip = params.get('ip', [None])[0]
             port = params.get('port', [None])[0]
             event = params.get('event', [None])[0]
-            downloaded = params.get('downloaded', [None])[0]
+            uploaded = params.get('uploaded', ['0'])[0]
+            downloaded = params.get('downloaded', ['0'])[0]
+            left = params.get('left', ['0'])[0]
+            numwant = params.get('numwant', [str(DEFAULT_NUMWANT)])[0]
+            compact = params.get('compact', ['0'])[0] == '1'
 
-            print(f"Test {info_hash} {peer_id} {ip} {port} {event} {downloaded}")
+            if self.verbose:
+                print(f"Test {info_hash} {peer_id} {ip} {port} {event} {downloaded}")
 
             if not all([info_hash, peer_id, ip, port]):
                 return self.create_error_response("Missing required parameters")
 
-            # Handle different events
-            if event == 'STARTED':
-                self.add_peer(info_hash, peer_id, ip, port, downloaded)
-            elif event == 'STOPPED':
-                self.remove_peer(info_hash, peer_id)
-            elif event == 'COMPLETED':
+            try:
+                uploaded, downloaded, left = int(uploaded), int(downloaded), int(left)
+                numwant = min(max(int(numwant), 0), MAX_NUMWANT)
+            except ValueError:
+                return self.create_error_response("Invalid uploaded/downloaded/left/numwant")
+
+            swarm = self.announce(info_hash, peer_id, ip, port, event, uploaded, downloaded, left, numwant, compact)
+
+            # Create and return the response
+            if compact:
+                response = self.create_compact_response(swarm)
+            else:
+                response = self.create_response(info_hash, swarm)
+
+        elif request_type == '/scrape':
+            return self.create_scrape_response(params.get('info_hash', []))
+
+        else:
+            return self.create_error_response(f"Unknown request {request_type}")
+
+        if self.verbose:
+            print(response)
+        return response
+
+    def announce(self, info_hash: str, peer_id: str, ip: str, port, event: str,
+                 uploaded: int = 0, downloaded: int = 0, left: int = 0,
+                 numwant: int = DEFAULT_NUMWANT, compact: bool = True) -> dict:
+        """
+        Xử lý announce (HTTP hoặc UDP) trên shard sở hữu swarm, trả về
+        {'complete', 'incomplete', 'peers'} với peers là list dict, hoặc (peers, peers6) nếu compact.
+        """
+        args = [info_hash, peer_id, ip, port, event, uploaded, downloaded, left, numwant, compact]
+        if self.shards is None or self.shards.is_local(info_hash):
+            return self.local_announce(*args)
+
+        swarm = self.shards.call(self.shards.owner(info_hash), 'announce', args, serve=self.serve_shard)
+        if compact:
+            swarm['peers'] = tuple(peers.encode('latin-1') for peers in swarm['peers'])
+        return swarm
+
+    def local_announce(self, info_hash: str, peer_id: str, ip: str, port, event: str,
+                       uploaded: int, downloaded: int, left: int, numwant: int, compact: bool) -> dict:
+        # Handle different events. Mọi announce khác STOPPED đều làm mới last_seen của peer
+        if event == 'STOPPED':
+            self.remove_peer(info_hash, peer_id)
+        else:
+            self.add_peer(info_hash, peer_id, ip, port, uploaded, downloaded, left)
+            if event == 'COMPLETED':
                 self.update_peer(info_hash, peer_id, completed=True)
 
-        # Create and return the response
-        response = self.create_response(info_hash, request_type)
-                
-        print(response)
+        swarm = self.registry.get_stats(info_hash)
+        if compact:
+            swarm['peers'] = self.registry.sample_compact_peers(info_hash, numwant, peer_id)
+        else:
+            swarm['peers'] = self.registry.sample_peers(info_hash, numwant, peer_id)
+        return swarm
+
+    def get_stats(self, info_hashes: List[str], background: bool = False) -> Dict[str, Dict[str, int]]:
+        """Số liệu scrape của nhiều swarm, gom từ các shard sở hữu (scatter-gather)."""
+        if self.shards is None:
+            return {info_hash: self.registry.get_stats(info_hash) for info_hash in info_hashes}
+
+        by_shard: Dict[int, List[str]] = {}
+        for info_hash in info_hashes:
+            by_shard.setdefault(self.shards.owner(info_hash), []).append(info_hash)
+
+        stats = {}
+        for shard, hashes in by_shard.items():
+            if shard == self.shards.index:
+                stats.update({info_hash: self.registry.get_stats(info_hash) for info_hash in hashes})
+            else:
+                stats.update(self.call_shard(shard, 'stats', [hashes], background))
+        return stats
+
+    def get_all_stats(self, background: bool = True) -> Dict[str, Dict[str, int]]:
+        stats = self.registry.get_all_stats()
+        if self.shards is not None:
+            for shard in range(self.shards.num_shards):
+                if shard != self.shards.index:
+                    stats.update(self.call_shard(shard, 'all_stats', [], background))
+        return stats
+
+    def call_shard(self, shard: int, method: str, args: list, background: bool = False):
+        """
+        Lượt hỏi-đáp đồng bộ với shard khác. Trên thread selector (background=False), shard chậm làm
+        mọi kết nối của worker này chờ theo, tối đa SHARD_TIMEOUT.
+        """
+        if background:
+            return self.background_shards.call(shard, method, args)
+        return self.shards.call(shard, method, args, serve=self.serve_shard)
+
+    def serve_shard(self, method: str, args: list):
+        """Phục vụ request chuyển tiếp từ worker khác, chỉ đụng tới registry của shard này."""
+        if method == 'announce':
+            swarm = self.local_announce(*args)
+            if args[-1]:
+                # JSON không chứa được bytes: chuyển compact peers sang chuỗi latin-1
+                swarm['peers'] = [peers.decode('latin-1') for peers in swarm['peers']]
+            return swarm
+        if method == 'stats':
+            return {info_hash: self.registry.get_stats(info_hash) for info_hash in args[0]}
+        if method == 'all_stats':
+            return self.registry.get_all_stats()
+        raise ValueError(f"Unknown shard method {method}")
+
+    def receive_datagrams(self):
+        while True:
+            try:
+                data, addr = self.udp_socket.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            # Lỗi của một gói tin không được làm dừng vòng lặp
+            try:
+                response = self.handle_udp_request(data, addr)
+            except OSError as e:
+                response = self.create_udp_error(struct.unpack('>I', data[12:16])[0], f"Tracker unavailable: {e}")
+            except Exception as e:
+                print(f"Error handling UDP request from {addr}: {e!r}")
+                response = self.create_udp_error(struct.unpack('>I', data[12:16])[0], "Internal error")
+            if response:
+                try:
+                    self.udp_socket.sendto(response, addr)
+                except OSError:
+                    pass
+
+    def make_connection_id(self, addr, bucket: Optional[int] = None) -> int:
+        if bucket is None:
+            bucket = int(time.time()) // UDP_CONNECTION_ID_LIFETIME
+        message = f"{addr[0]}:{addr[1]}:{bucket}".encode()
+        return struct.unpack('>Q', hmac.new(self.udp_secret, message, hashlib.sha256).digest()[:8])[0]
+
+    def check_connection_id(self, connection_id: int, addr) -> bool:
+        bucket = int(time.time()) // UDP_CONNECTION_ID_LIFETIME
+        return connection_id in (self.make_connection_id(addr, bucket), self.make_connection_id(addr, bucket - 1))
+
+    def handle_udp_request(self, data: bytes, addr) -> Optional[bytes]:
+        """Xử lý một gói tin UDP tracker (BEP 15), trả về gói tin phản hồi."""
+        if len(data) < 16:
+            return None
+        connection_id, action, transaction_id = struct.unpack('>QII', data[:16])
+
+        if action == UDP_ACTION_CONNECT:
+            if connection_id != UDP_PROTOCOL_ID:
+                return None
+            return struct.pack('>IIQ', UDP_ACTION_CONNECT, transaction_id, self.make_connection_id(addr))
+
+        if not self.check_connection_id(connection_id, addr):
+            return self.create_udp_error(transaction_id, "Invalid connection id")
+
+        if action == UDP_ACTION_ANNOUNCE:
+            if len(data) < 98:
+                return self.create_udp_error(transaction_id, "Malformed announce")
+            (info_hash, peer_id, downloaded, left, uploaded, event, ip, _key, numwant,
+             port) = struct.unpack('>20s20sQQQIIIiH', data[16:98])
+
+            info_hash = info_hash.decode('latin-1')
+            peer_id = peer_id.decode('latin-1')
+            ip = socket.inet_ntoa(struct.pack('>I', ip)) if ip else addr[0]
+            numwant = DEFAULT_NUMWANT if numwant < 0 else min(numwant, MAX_NUMWANT)
+
+            swarm = self.announce(info_hash, peer_id, ip, str(port), UDP_EVENTS.get(event, ''),
+                                  uploaded, downloaded, left, numwant)
+            return self.create_udp_announce_response(transaction_id, swarm)
+
+        if action == UDP_ACTION_SCRAPE:
+            info_hashes = [data[i:i + 20].decode('latin-1') for i in range(16, len(data) - 19, 20)]
+            return self.create_udp_scrape_response(transaction_id, info_hashes[:UDP_MAX_SCRAPE_HASHES])
+
+        return self.create_udp_error(transaction_id, "Unknown action")
+
+    def create_udp_announce_response(self, transaction_id: int, swarm: dict) -> bytes:
+        peers, _ = swarm['peers']
+        return struct.pack('>IIIII', UDP_ACTION_ANNOUNCE, transaction_id, self.next_announce_interval(),
+                           swarm['incomplete'], swarm['complete']) + peers
+
+    def create_udp_scrape_response(self, transaction_id: int, info_hashes: List[str]) -> bytes:
+        response = struct.pack('>II', UDP_ACTION_SCRAPE, transaction_id)
+        all_stats = self.get_stats(info_hashes)
+        for info_hash in info_hashes:
+            stats = all_stats[info_hash]
+            response += struct.pack('>III', stats['complete'], stats['downloaded'], stats['incomplete'])
         return response
 
-    def add_peer(self, info_hash: str, peer_id: str, ip: str, port: str, downloaded: str):
-        if info_hash not in self.peers:
-            self.peers[info_hash] = []
-        self.peers[info_hash].append({
-            'peer_id': peer_id,
-            'ip': ip,
-            'port': port,
-            'downloaded': downloaded
-        })
+    @staticmethod
+    def create_udp_error(transaction_id: int, reason: str) -> bytes:
+        return struct.pack('>II', UDP_ACTION_ERROR, transaction_id) + reason.encode()
+
+    def add_peer(self, info_hash: str, peer_id: str, ip: str, port: str,
+                 uploaded: int = 0, downloaded: int = 0, left: int = 0):
+        self.registry.add_peer(info_hash, peer_id, ip, port, uploaded, downloaded, left)
 
     def remove_peer(self, info_hash: str, peer_id: str):
-        if info_hash in self.peers:
-            self.peers[info_hash] = [p for p in self.peers[info_hash] if p['peer_id'] != peer_id]
+        self.registry.remove_peer(info_hash, peer_id)
 
     def update_peer(self, info_hash: str, peer_id: str, completed: bool = False):
-        if info_hash in self.peers:
-            for peer in self.peers[info_hash]:
-                if peer['peer_id'] == peer_id:
-                    peer['completed'] = completed
-                    break
-
-    def create_response(self, info_hash: str, type: str) -> str:
-        if type == '/announce':
-            response = {
-                'tracker_id': self.tracker_id,
-                'info_hash': info_hash,
-                'peers': self.peers.get(info_hash, [])
-            }
-        elif type == '/scrape':
-            response = {
-                'tracker_id': self.tracker_id,
-                'info_hash': info_hash,
-                'total_peers': len(self.peers.get(info_hash, []))
-            }
+        self.registry.update_peer(info_hash, peer_id, completed)
+
+    def create_response(self, info_hash: str, swarm: dict) -> str:
+        response = {
+            'tracker_id': self.tracker_id,
+            'info_hash': info_hash,
+            'interval': self.next_announce_interval(),
+            'min interval': self.min_announce_interval,
+            'complete': swarm['complete'],
+            'incomplete': swarm['incomplete'],
+            'peers': swarm['peers']
+        }
+        return json.dumps(response)
+
+    def create_scrape_response(self, info_hashes: List[str]) -> str:
+        """
+        Scrape nhiều info_hash trong một request, số liệu lấy từ bộ đếm của từng swarm.
+        Không có info_hash thì trả về full scrape đã cache.
+        """
+        if not info_hashes:
+            with self.full_scrape_lock:
+                body = self.full_scrape_cache
+            return body if body is not None else self.refresh_full_scrape(background=False)
+
+        if len(info_hashes) > MAX_SCRAPE_HASHES:
+            return self.create_error_response(f"Too many info_hash values (max {MAX_SCRAPE_HASHES})")
+
+        files = {self.encode_info_hash(info_hash): stats
+                 for info_hash, stats in self.get_stats(info_hashes).items()}
+        response = {'tracker_id': self.tracker_id, 'files': files}
+        if len(info_hashes) == 1:
+            # Giữ các trường cũ cho client chỉ scrape một torrent
+            stats = files[self.encode_info_hash(info_hashes[0])]
+            response['info_hash'] = info_hashes[0]
+            response['total_peers'] = stats['complete'] + stats['incomplete']
         return json.dumps(response)
 
+    def create_compact_response(self, swarm: dict) -> bytes:
+        """Announce response dạng bencode với danh sách peer compact (BEP 23, BEP 7)."""
+        peers, peers6 = swarm['peers']
+        return Bencode.encode({
+            b'tracker id': self.tracker_id.encode(),
+            b'interval': self.next_announce_interval(),
+            b'min interval': self.min_announce_interval,
+            b'complete': swarm['complete'],
+            b'incomplete': swarm['incomplete'],
+            b'peers': peers,
+            b'peers6': peers6,
+        })
+
     def create_error_response(self, reason: str) -> str:
         return json.dumps({'failure reason': reason})
 
 if __name__ == "__main__":
-    tracker = TrackerServer()
-    tracker.start()
+    import sys
+    from TrackerShards import run_workers
+
+    # python TrackerServer.py [số worker]: chạy nhiều process chia sẻ cổng 5050
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if num_workers > 1:
+        run_workers(num_workers, snapshot_path='tracker_state.bin')
+    else:
+        tracker = TrackerServer(snapshot_path='tracker_state.bin')
+        tracker.start()
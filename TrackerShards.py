@@ -0,0 +1,230 @@
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import uuid
+import zlib
+from typing import Callable, Optional
+
+SHARD_TIMEOUT = 2               # Thời gian chờ tối đa một shard khác trả lời (giây)
+SHARD_CHUNK_SIZE = 32 * 1024    # Dữ liệu tối đa trong một datagram, dưới giới hạn SO_SNDBUF của Unix socket
+MAX_SHARD_MESSAGE = 64 << 20    # Kích thước tối đa của một message sau khi ghép các phần
+
+"""
+Chạy tracker trên nhiều process: các worker cùng lắng nghe một cổng (SO_REUSEPORT),
+swarm được chia theo info_hash, mỗi swarm chỉ nằm trong registry của một worker (shard).
+Worker nhận request của swarm không thuộc mình thì chuyển tiếp cho shard sở hữu
+qua Unix datagram socket (abstract namespace), nên announce/scrape luôn nhất quán.
+
+Chi phí: announce/scrape chuyển tiếp là một lượt hỏi-đáp đồng bộ trên thread selector của worker,
+nên một shard chậm hoặc treo làm mọi kết nối của worker đó chờ theo (tối đa SHARD_TIMEOUT).
+Full scrape định kỳ dùng kênh riêng trên thread nền nên không chặn vòng selector.
+"""
+
+
+def shard_of(info_hash: str, num_shards: int) -> int:
+    # Không dùng hash() vì mỗi process có seed ngẫu nhiên khác nhau
+    return zlib.crc32(info_hash.encode('latin-1', 'replace')) % num_shards
+
+
+def shard_address(cluster_id: str, index: int, suffix: str = '') -> bytes:
+    return f"\0tracker-{cluster_id}-{index}{suffix}".encode()
+
+
+class ShardError(OSError):
+    """Shard sở hữu swarm không xử lý được request chuyển tiếp."""
+
+
+class ShardChannel:
+    """
+    Kênh Unix datagram giữa các worker. Request và response là JSON:
+    {'id': ..., 'method': ..., 'args': [...]} / {'id': ..., 'result': ...} hoặc {'id': ..., 'error': ...}.
+    Message lớn hơn SHARD_CHUNK_SIZE (ví dụ all_stats của hàng nghìn swarm) được chia thành nhiều datagram
+    dạng header JSON {'id', 'reply', 'part', 'parts'}, một ký tự xuống dòng rồi một đoạn của message, bên nhận ghép lại.
+    """
+    def __init__(self, cluster_id: str, index: int, num_shards: int, suffix: str = ''):
+        self.cluster_id = cluster_id
+        self.index = index
+        self.num_shards = num_shards
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(shard_address(cluster_id, index, suffix))
+        self.sock.setblocking(False)
+        self.next_id = 0
+        # (địa chỉ gửi, id, là response) -> các phần đã nhận của message đang được chia nhỏ
+        self.partial = {}
+
+    def close(self):
+        self.sock.close()
+
+    def owner(self, info_hash: str) -> int:
+        return shard_of(info_hash, self.num_shards)
+
+    def is_local(self, info_hash: str) -> bool:
+        return self.owner(info_hash) == self.index
+
+    def call(self, shard: int, method: str, args: list, serve: Optional[Callable] = None,
+             timeout: float = SHARD_TIMEOUT):
+        """
+        Gửi request tới shard khác và chờ kết quả, ném ShardError nếu shard đó báo lỗi.
+        Trong lúc chờ vẫn phục vụ request đến từ các shard khác (nếu có `serve`),
+        để hai worker chuyển tiếp cho nhau cùng lúc không bị deadlock.
+        """
+        self.next_id += 1
+        request_id = self.next_id
+        self.send({'id': request_id, 'method': method, 'args': args}, shard_address(self.cluster_id, shard))
+
+        deadline = time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Shard {shard} did not answer {method}")
+                if not selector.select(remaining):
+                    continue
+                while (received := self.receive()) is not None:
+                    message, addr = received
+                    if 'method' in message:
+                        if serve is not None:
+                            self.reply(addr, message, serve)
+                    elif message.get('id') == request_id:
+                        if 'error' in message:
+                            raise ShardError(f"Shard {shard} failed {method}: {message['error']}")
+                        return message['result']
+                    # Còn lại là response trễ của request đã timeout, bỏ qua
+
+    def serve_pending(self, serve: Callable):
+        """Phục vụ mọi request đang chờ trong socket (gọi từ vòng selector của worker)."""
+        while (received := self.receive()) is not None:
+            message, addr = received
+            if 'method' in message:
+                self.reply(addr, message, serve)
+
+    def reply(self, addr, message: dict, serve: Callable):
+        try:
+            response = {'id': message['id'], 'result': serve(message['method'], message['args'])}
+        except Exception as e:
+            # Báo lỗi rõ ràng thay vì result rỗng, worker chuyển tiếp trả 503 cho client
+            print(f"Error serving shard request {message['method']}: {e}")
+            response = {'id': message['id'], 'error': str(e) or type(e).__name__}
+        try:
+            self.send(response, addr)
+        except OSError as e:
+            # Không gửi được kết quả: báo lỗi ngắn để bên gọi trả 503 ngay thay vì chờ tới timeout
+            print(f"Error replying to shard {addr!r}: {e}")
+            try:
+                self.send({'id': message['id'], 'error': f"Cannot send reply: {e}"}, addr)
+            except OSError:
+                pass
+
+    def send(self, message: dict, addr):
+        """Gửi một message, chia thành nhiều datagram nếu lớn hơn SHARD_CHUNK_SIZE."""
+        data = json.dumps(message).encode()
+        if len(data) <= SHARD_CHUNK_SIZE:
+            self.send_datagram(data, addr)
+            return
+        if len(data) > MAX_SHARD_MESSAGE:
+            raise ShardError(f"Shard message too large ({len(data)} bytes)")
+        parts = (len(data) + SHARD_CHUNK_SIZE - 1) // SHARD_CHUNK_SIZE
+        deadline = time.monotonic() + SHARD_TIMEOUT
+        for part in range(parts):
+            header = json.dumps({'id': message['id'], 'reply': 'method' not in message,
+                                 'part': part, 'parts': parts}).encode()
+            chunk = data[part * SHARD_CHUNK_SIZE:(part + 1) * SHARD_CHUNK_SIZE]
+            self.send_datagram(header + b'\n' + chunk, addr, deadline)
+
+    def send_datagram(self, data: bytes, addr, deadline: Optional[float] = None):
+        # Hàng đợi của socket nhận đầy (message nhiều phần): chờ bên nhận đọc bớt, tối đa tới deadline
+        deadline = deadline or time.monotonic() + SHARD_TIMEOUT
+        while True:
+            try:
+                self.sock.sendto(data, addr)
+                return
+            except (BlockingIOError, InterruptedError):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Shard {addr!r} is not reading its socket")
+                time.sleep(0.001)
+
+    def receive(self):
+        """(message, địa chỉ gửi) của message hoàn chỉnh tiếp theo, None nếu socket không còn gì để đọc."""
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(SHARD_CHUNK_SIZE + 1024)
+            except (BlockingIOError, InterruptedError):
+                return None
+            header, separator, chunk = data.partition(b'\n')
+            if not separator:
+                # JSON của json.dumps không chứa ký tự xuống dòng: message nằm trọn trong một datagram
+                return json.loads(data), addr
+
+            header = json.loads(header)
+            if header['parts'] * SHARD_CHUNK_SIZE > MAX_SHARD_MESSAGE:
+                continue
+            key = (addr, header['id'], header['reply'])
+            now = time.monotonic()
+            if key not in self.partial:
+                # Bỏ các message mà bên gửi đã bỏ dở (timeout giữa chừng)
+                for stale in [k for k, (started, _) in self.partial.items() if now - started > 2 * SHARD_TIMEOUT]:
+                    del self.partial[stale]
+                self.partial[key] = (now, [])
+            chunks = self.partial[key][1]
+            chunks.append(chunk)
+            if len(chunks) == header['parts']:
+                del self.partial[key]
+                return json.loads(b''.join(chunks)), addr
+
+
+def _run_worker(channels: list, index: int, udp_secret: bytes, kwargs: dict):
+    from TrackerServer import TrackerServer
+    # Chỉ giữ kênh của chính mình, các kênh khác được kế thừa khi fork
+    for i, channel in enumerate(channels):
+        if i != index:
+            channel.close()
+    tracker = TrackerServer(shards=channels[index], udp_secret=udp_secret, **kwargs)
+    # terminate() từ process cha: dừng vòng lặp để worker kịp ghi snapshot
+    signal.signal(signal.SIGTERM, lambda *_: tracker.stop())
+    try:
+        tracker.start()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(num_workers: int = 0, **kwargs):
+    """
+    Chạy `num_workers` process tracker (mặc định bằng số core) cùng chia sẻ một cổng.
+    Các worker dùng chung secret để connection ID của UDP hợp lệ ở mọi worker.
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    cluster_id = f"{os.getpid()}-{os.urandom(4).hex()}"
+    udp_secret = os.urandom(16)
+    kwargs.setdefault('tracker_id', str(uuid.uuid4()))
+
+    # Bind mọi kênh trước khi fork để worker khởi động trước không gửi vào địa chỉ chưa tồn tại
+    channels = [ShardChannel(cluster_id, i, num_workers) for i in range(num_workers)]
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_run_worker, args=(channels, i, udp_secret, kwargs),
+                               name=f"tracker-worker-{i}")
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for channel in channels:
+        channel.close()
+    print(f"Started {num_workers} tracker workers")
+
+    # Bị terminate thì cũng dừng các worker thay vì để chúng chạy mồ côi
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
@@ -1,5 +1,6 @@
 from datetime import datetime
 import os
+from pathlib import Path
 
 from threading import Thread
 
@@ -8,9 +9,15 @@ from FileManager import FileManager
 from info import *
 from MetaInfo import MetaInfo
 from TorrentUtils import TorrentUtils
+from Torrent import Torrent
 from Peer import Peer
+from Session import Session
 import socket
 
+TRACKER_ANNOUNCE = 'http://localhost:5050/announce'
+# Cùng một tracker qua UDP (BEP 15) và HTTP: UDP được thử trước, lỗi thì chuyển sang HTTP
+TRACKER_TIERS = [['udp://localhost:5050', TRACKER_ANNOUNCE]]
+
 class Status:
     def __init__(self):
         self.connected = 1
@@ -20,29 +27,39 @@ class Status:
 
 
 class User:
-    def __init__(self, userId, name: str = "Anonymous"):
+    def __init__(self, userId, name: str = "Anonymous", session: Session = None):
         self.name = name
         self.peers: dict[str, Peer] = {}
         self.threads: dict[str, Thread] = {}
         self.userId = userId
 
-    def download(self, file_path, save_path):
-        # if self.isTorrent(file):
-        info_torrent = TorrentUtils.get_info_from_file(file_path)
-        # else:
-        #     info = TorrentUtils.get_info_from_magnet(file)
-
-        ip, port = self._get_ip_port()
-        file_manager = FileManager(save_path, info_torrent[b'info'])
-
-        with open(file_path, 'rb') as file:
-            bencode_info = file.read()
-        magnet = TorrentUtils.make_magnet_from_bencode(bencode_info)
-        info = TorrentUtils.get_info_from_magnet(magnet)
+        # Một Session (một cổng lắng nghe) dùng chung cho mọi torrent của user
+        self.session = session or Session()
 
-        peer = Peer(ip, port, info, file_manager)
+    def download(self, file_path, save_path, file_priorities=None, streaming=False, recheck=False):
+        """
+        :param file_path: đường dẫn file .torrent hoặc magnet link
+        :param file_priorities: dict {file name: FilePriority}, file không có trong dict giữ NORMAL.
+            Tên file sai thì raise KeyError; với magnet thì kiểm tra khi nhận được metadata, sai thì
+            torrent không tải và lỗi nằm trong get_transfer_information()['error']
+        :param streaming: tải theo thứ tự đọc để có thể open_stream() khi chưa tải xong
+        :param recheck: save_path đã có sẵn dữ liệu: kiểm tra và chỉ tải các piece còn thiếu hoặc sai
+        """
+        if TorrentUtils.is_magnet(file_path):
+            # Magnet không có piece hash: FileManager chờ info dict nhận từ peer (ut_metadata)
+            torrent = Torrent.from_magnet(file_path)
+            file_manager = FileManager(save_path, content_index=self.session.content_index)
+        else:
+            torrent = Torrent.from_file(file_path)
+            file_manager = FileManager(save_path, torrent, self.session.content_index)
+        if file_priorities:
+            file_manager.set_file_priorities(file_priorities)
+
+        self.session.start()
+        peer = Peer(self.session.ip, self.session.port, torrent, file_manager, self.session)
+        peer.set_streaming(streaming)
         print(f"Peer ID: {peer.peer_id}")
-        thread = Thread(target=peer.download)
+        thread = Thread(target=peer.download, kwargs={'recheck': recheck})
 
         self.peers.update({peer.peer_id: peer})
         self.threads.update({peer.peer_id: thread})
@@ -53,23 +70,24 @@ class User:
 
     def share(self, path):
 
-        file_manager = FileManager()
+        # Piece và file đã có trong session (share/tải trước đó) được dùng lại thay vì lưu thêm bản nữa
+        file_manager = FileManager(content_index=self.session.content_index, hash_cache=self.session.hash_cache)
 
         if os.path.isdir(path):
             file_manager.split_dir(path)
-            magnet_link = self._input_directory(path, file_manager)
+            torrent_data = self._input_directory(path, file_manager)
         elif os.path.isfile(path):
             file_manager.split_file(path)
-            magnet_link = self._input_file(path, file_manager)
+            torrent_data = self._input_file(path, file_manager)
         else:
             raise "Invalid path"
 
-        print(f"Magnet link: {magnet_link}")
+        # Torrent giữ info dict để gửi cho peer tải bằng magnet (ut_metadata)
+        torrent = Torrent.from_bytes(torrent_data)
+        print(f"Magnet link: {torrent.get_magnet_link()}")
+        self.session.start()
 
-        info = TorrentUtils.get_info_from_magnet(magnet_link)
-        ip, port = self._get_ip_port()
-
-        peer = Peer(ip, port, info, file_manager)
+        peer = Peer(self.session.ip, self.session.port, torrent, file_manager, self.session)
         print(f"Peer ID: {peer.peer_id}")
         thread = Thread(target=peer.upload)
 
@@ -83,19 +101,14 @@ class User:
     def scrape_tracker(self, file):
 
         # if self.isTorrent(file):
-        info_torrent = TorrentUtils.get_info_from_file(file)
+        torrent = Torrent.from_file(file)
         # else:
-        #     info = TorrentUtils.get_info_from_magnet(file)
+        #     torrent = Torrent.from_magnet(file)
 
         ip, port = self._get_ip_port()
-        file_manager = FileManager(info=info_torrent[b'info'])
-
-        with open(file, 'rb') as file:
-            bencode_info = file.read()
-        magnet = TorrentUtils.make_magnet_from_bencode(bencode_info)
-        info = TorrentUtils.get_info_from_magnet(magnet)
+        file_manager = FileManager(torrent=torrent)
 
-        peer = Peer(ip, port, info, file_manager)
+        peer = Peer(ip, port, torrent, file_manager)
         thread = Thread(target=peer.scrape_tracker)
 
 
@@ -114,37 +127,42 @@ class User:
         self.threads.pop(peer_id)
 
     def stop_all(self):
-
-        for peer_id in self.peers:
+        # Dừng hẳn mọi torrent trước (announce STOPPED, job đĩa, đóng file) rồi mới dừng
+        # listener, local discovery và pool đĩa dùng chung của session
+        for peer_id in list(self.peers):
             self.peers[peer_id].stop()
             self.peers.pop(peer_id)
 
-        for peer_id in self.threads:
+        for peer_id in list(self.threads):
             self.threads[peer_id].join()
             self.threads.pop(peer_id)
 
+        self.session.stop()
+
 
     def _input_directory(self, dir_path, file_manager):
         """
         Cho phép người dùng nhập vào một directory và chuyển nó thành bencode.
         """
         # Lấy các file trong directory và chuyển thành danh sách File
+        # Duyệt file theo đúng thứ tự mà FileManager.split_dir dùng để cắt piece,
+        # nếu không piece_file_map sẽ lệch so với dữ liệu thật ở các boundary piece
         directory_name = os.path.basename(os.path.normpath(dir_path))
         files = []
-        for root, dirs, file_names in os.walk(dir_path):
-            for file_name in file_names:
-                file_path = os.path.join(root, file_name)
-                file_size = os.path.getsize(file_path)
-                file_relative_path = os.path.relpath(file_path, dir_path).split(os.sep)
-                files.append(File(file_size, file_relative_path))
-
-        # Tạo InfoMultiFile cho directory
+        for file_path in sorted(Path(dir_path).rglob('*')):
+            if file_path.is_file():
+                file_size = file_path.stat().st_size
+                file_relative_path = list(file_path.relative_to(dir_path).parts)
+                pieces_root = file_manager.get_file_root('/'.join(file_relative_path))
+                files.append(File(file_size, file_relative_path, pieces_root))
+
+        # Tạo InfoMultiFile cho directory, kèm piece layer để kiểm tra từng block 16 KiB
         piece_length = file_manager.get_piece_length()
         pieces = file_manager.get_pieces_code()
-        info = InfoMultiFile(piece_length, pieces, os.path.basename(dir_path), files)
+        info = InfoMultiFile(piece_length, pieces, os.path.basename(dir_path), files, file_manager.get_piece_layer())
 
         # Tạo MetaInfo cho torrent file
-        meta_info = MetaInfo(info, 'http://localhost:5050', datetime.now(), 'No comment', self.name)
+        meta_info = MetaInfo(info, TRACKER_ANNOUNCE, datetime.now(), 'No comment', self.name, TRACKER_TIERS)
         encoded = meta_info.get_bencode()
 
         torrent_dir = "Torrents"
@@ -153,9 +171,7 @@ class User:
             os.makedirs(torrent_dir)
         TorrentUtils.create_torrent_file(encoded, full_path)
 
-        magnet_link = TorrentUtils.make_magnet_from_bencode(encoded)
-
-        return magnet_link
+        return encoded
 
 
 
@@ -166,13 +182,14 @@ class User:
         file_name = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
 
-        # Tạo InfoSingleFile cho file
+        # Tạo InfoSingleFile cho file, kèm piece layer để kiểm tra từng block 16 KiB
         piece_length = file_manager.get_piece_length()
         pieces = file_manager.get_pieces_code()
-        info = InfoSingleFile(piece_length, pieces, file_name, file_size)
+        info = InfoSingleFile(piece_length, pieces, file_name, file_size,
+                              file_manager.get_piece_layer(), file_manager.get_file_root(file_name))
 
         # Tạo MetaInfo cho torrent file
-        meta_info = MetaInfo(info, 'http://localhost:5050', datetime.now(), 'No comment', self.name)
+        meta_info = MetaInfo(info, TRACKER_ANNOUNCE, datetime.now(), 'No comment', self.name, TRACKER_TIERS)
         encoded = meta_info.get_bencode()
 
         torrent_dir = "Torrents"
@@ -181,9 +198,7 @@ class User:
             os.makedirs(torrent_dir)
         TorrentUtils.create_torrent_file(encoded, full_path)
 
-        magnet_link = TorrentUtils.make_magnet_from_bencode(encoded)
-
-        return magnet_link
+        return encoded
 
 
     def _get_ip_port(self):
@@ -239,6 +254,15 @@ class User:
     def get_scrape_information(self, peer_id):
         return self.peers[peer_id].get_scrape_response()
 
+    def get_files(self, transfer_id):
+        return self.peers[transfer_id].file_manager.get_files()
+
+    def set_file_priority(self, transfer_id, file_name, priority):
+        self.peers[transfer_id].set_file_priority(file_name, priority)
+
+    def open_stream(self, transfer_id, file_name=None):
+        return self.peers[transfer_id].open_stream(file_name)
+
     def get_file_size(self, transfer_id):
         """Get the total file size for a transfer"""
         # Return the file size in bytes
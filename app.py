@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
 import uuid
 from User import User
+from Session import Session
 from typing import Optional
 import logging
 from datetime import datetime
@@ -328,7 +329,13 @@ class BitTorrentApp:
                 raise ValueError("Username and password are required")
 
             # Here you would typically verify credentials with your User library
-            self.user = User(str(uuid.uuid4()), username)
+            session = Session(
+                port=int(self.settings["port"]),
+                max_connections=int(self.settings["max_connections"]),
+                max_upload_speed=int(self.settings["max_upload_speed"]) * 1024,  # KB/s -> B/s
+                max_download_speed=int(self.settings["max_download_speed"]) * 1024
+            )
+            self.user = User(str(uuid.uuid4()), username, session)
 
             # Save login state if remember me is checked
             if self.remember_var.get():
@@ -389,6 +396,12 @@ class BitTorrentApp:
             command=self.add_torrent
         ).pack(side="left", padx=2)
 
+        ttk.Button(
+            toolbar,
+            text="Add Magnet",
+            command=self.add_magnet
+        ).pack(side="left", padx=2)
+
         # Transfers table
         columns = ("Name", "Status", "Progress", "Speed", "Peers", "Time")
         self.transfers_tree = ttk.Treeview(
@@ -680,39 +693,39 @@ class BitTorrentApp:
             logging.error(f"Failed to add torrent: {e}")
             messagebox.showerror("Error", "Failed to add torrent")
 
-    # def add_magnet(self):
-    #     """Add a new magnet link"""
-    #     try:
-    #         magnet_link = simpledialog.askstring(
-    #             "Add Magnet Link",
-    #             "Enter magnet link:",
-    #             parent=self.root
-    #         )
-    #
-    #         if magnet_link:
-    #             save_path = filedialog.askdirectory(
-    #                 title="Select Save Location",
-    #                 initialdir=self.settings["default_save_path"]
-    #             )
-    #
-    #             if save_path:
-    #                 transfer_id = str(uuid.uuid4())
-    #                 self.transfers[transfer_id] = TransferRecord(
-    #                     id=transfer_id,
-    #                     type="download",
-    #                     path=magnet_link,
-    #                     status=TransferStatus.PENDING,
-    #                     start_time=datetime.now()
-    #                 )
-    #
-    #                 # Start the download using User library
-    #                 self.user.download(magnet_link, save_path)
-    #                 self.update_transfers_view()
-    #                 self.log_activity("Started downloading from magnet link")
-    #
-    #     except Exception as e:
-    #         logging.error(f"Failed to add magnet link: {e}")
-    #         messagebox.showerror("Error", "Failed to add magnet link")
+    def add_magnet(self):
+        """Add a new magnet link"""
+        try:
+            magnet_link = simpledialog.askstring(
+                "Add Magnet Link",
+                "Enter magnet link:",
+                parent=self.root
+            )
+
+            if magnet_link:
+                save_path = filedialog.askdirectory(
+                    title="Select Save Location",
+                    initialdir=self.settings["default_save_path"]
+                )
+
+                if save_path:
+                    # Start the download using User library
+                    transfer_id = self.user.download(magnet_link, save_path)
+
+                    self.transfers[transfer_id] = TransferRecord(
+                        id=transfer_id,
+                        type="download",
+                        path=magnet_link,
+                        status=TransferStatus.PENDING,
+                        start_time=datetime.now()
+                    )
+
+                    self.update_transfers_view()
+                    self.log_activity("Started downloading from magnet link")
+
+        except Exception as e:
+            logging.error(f"Failed to add magnet link: {e}")
+            messagebox.showerror("Error", "Failed to add magnet link")
 
     def update_transfers_view(self):
         """Update the transfers treeview with current transfer information"""
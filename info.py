@@ -2,40 +2,52 @@ from typing import List
 from abc import ABC, abstractmethod
 
 class Info(ABC):
-    def __init__(self, pieceLength: int, pieces):
+    def __init__(self, pieceLength: int, pieces, pieceLayer: bytes = None):
         self.pieceLength = pieceLength  #number of bytes in each piece
         self.pieces = pieces            #string consisting of the concatenation of all 20-byte SHA1 hash values, one per piece (byte string, i.e. not urlencoded)
+        self.pieceLayer = pieceLayer    #private 'x-piece layer': concatenation of the 32-byte SHA-256 merkle roots of every piece (16 KiB leaves)
+                                        #not BEP 52 metadata: pieces are not file-aligned and there is no 'file tree'
 
     @abstractmethod
     def get_all_info(self) -> dict:
-        return {'pieceLength':self.pieceLength, 'pieces':self.pieces}
+        dic = {'pieceLength':self.pieceLength, 'pieces':self.pieces}
+        if self.pieceLayer is not None:
+            dic['x-piece layer'] = self.pieceLayer
+        return dic
 
 class InfoSingleFile(Info):
-    def __init__(self, pieceLength, pieces, name: str, length: int):
-        super().__init__(pieceLength, pieces)
+    def __init__(self, pieceLength, pieces, name: str, length: int, pieceLayer: bytes = None, piecesRoot: bytes = None):
+        super().__init__(pieceLength, pieces, pieceLayer)
         self.name = name                #the filename
         self.length = length            #length of the file in bytes
+        self.piecesRoot = piecesRoot    #private 'x-pieces root': SHA-256 merkle root of the file (16 KiB leaves)
 
     def get_all_info(self) -> dict:
         dic = super().get_all_info()
         dic.update({'name':self.name, 'length':self.length})
+        if self.piecesRoot is not None:
+            dic['x-pieces root'] = self.piecesRoot
         return dic
 
     def get_total_length(self) -> int:
         return self.length
 
 class File:
-    def __init__(self, length, path):
+    def __init__(self, length, path, piecesRoot: bytes = None):
         self.length = length            #length of the file in bytes
         self.path = path                #a list containing one or more string elements that together represent the path and filename
                                         #"dir1/dir2/file.ext" -> l4:dir14:dir28:file.exte
+        self.piecesRoot = piecesRoot    #private 'x-pieces root': SHA-256 merkle root of the file, identical files share it
 
     def get_all_info(self) -> dict:
-        return {'length':self.length, 'path':self.path}
+        dic = {'length':self.length, 'path':self.path}
+        if self.piecesRoot is not None:
+            dic['x-pieces root'] = self.piecesRoot
+        return dic
 
 class InfoMultiFile(Info):
-    def __init__(self, pieceLength, pieces, name, files: List[File]):
-        super().__init__(pieceLength, pieces)
+    def __init__(self, pieceLength, pieces, name, files: List[File], pieceLayer: bytes = None):
+        super().__init__(pieceLength, pieces, pieceLayer)
         self.name = name                #the name of the directory
         self.files = files              #a list of dictionaries
 